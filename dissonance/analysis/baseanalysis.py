@@ -1,6 +1,8 @@
+import logging
 from pathlib import Path
-from typing import List, Tuple, Union, Dict, Any
+from typing import List, Tuple, Union, Dict, Any, Iterator
 from abc import ABC, abstractproperty
+from contextlib import contextmanager
 
 import pandas as pd
 import numpy as np
@@ -9,21 +11,112 @@ from functools import reduce
 import h5py
 
 from .trees import Node, Tree
-from ..epochtypes import groupby, EpochBlock, IEpoch, epoch_factory
+from ..epochtypes import groupby, EpochBlock, EpochTable, IEpoch, epoch_factory, table_epochs
+from ..io import epochindex, paramscache
+from ..io.access import open_readonly, writable
+from ..io.archive import Archive, refresh_archive
 from .charting import MplCanvas
 from .analysistree import AnalysisTree
 
+logger = logging.getLogger(__name__)
+
 
 class EpochIO(ABC):
 
-    def __init__(self, params: pd.DataFrame, experimentpaths: List[Path], unchecked: set = None):
-        self.files = {
-            path: h5py.File(str(path),"a")["experiment"] for path in experimentpaths
-        }
+    def __init__(self, params: pd.DataFrame, experimentpaths: List[Path], unchecked: set = None, mode: str = "r", archive: Path = None, cachedir: Path = None):
+        """
+        Args:
+            mode (str, optional): "r" opens files read only, edits reopen the
+                edited file for writing for the duration of the edit. "a" keeps every file
+                open for writing as before. Defaults to "r".
+            archive (Path, optional): Archive over the experiment files, see dissonance.io.archive.
+                Only the archive is opened, day files are opened through it when their epochs are
+                queried. experimentpaths is ignored and mode must be "r".
+            cachedir (Path, optional): Params table cache the params came from, edited files are
+                dropped from it. Defaults to the default cache.
+        """
+        self.mode = mode
+        self.cachedir = cachedir
+        self.archive = None
+        if archive is not None:
+            if mode != "r":
+                raise ValueError("Archives are read only, use mode='r'")
+            self.archive = archive if isinstance(archive, Archive) else Archive(archive)
+            self.files = self.archive
+        else:
+            self.files = {
+                path: self._open(path) for path in experimentpaths
+            }
+        # METADATA OF EVERY EPOCH, QUERIES HAND OUT HANDLES ON ITS ROWS
+        # FILES ARE ONLY READ INTO IT WHEN ONE OF THEIR EPOCHS IS FIRST QUERIED
+        if self.archive is not None:
+            self.table = EpochTable.from_frame(self.archive.index, self.archive)
+        else:
+            self.table = EpochTable.from_files(self.files)
         # GROUP EPOCHS INTO FLAT LIST
         self.unchecked = set() if unchecked is None else unchecked
         self.set_frame(params)
         
+    def _open(self, path: Path) -> h5py.Group:
+        if self.mode == "r":
+            return open_readonly(path)["experiment"]
+        return h5py.File(str(path), self.mode)["experiment"]
+
+    @classmethod
+    def from_archive(cls, archivepath: Path, paramnames: List[str], filters: Dict = None, unchecked: set = None, refresh: bool = True) -> "EpochIO":
+        """EpochIO over an archive with its params table read from the archive index.
+        If day files changed since the archive was built it is rebuilt first, or only
+        warned about if refresh is False."""
+        archive = Archive(archivepath)
+        changed = archive.stale()
+        if len(changed) > 0 and refresh:
+            archive.close()
+            refresh_archive(archivepath)
+            archive = Archive(archivepath)
+        elif len(changed) > 0:
+            logger.warning(f"{archivepath}: {len(changed)} files changed since the archive was built, its index may be out of date")
+        return cls(archive.to_params(paramnames, filters), None, unchecked=unchecked, archive=archive)
+
+    def close(self) -> None:
+        if self.archive is not None:
+            self.archive.close()
+            return
+        for experiment in self.files.values():
+            if experiment.file:
+                experiment.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @contextmanager
+    def session(self, exppath: Path) -> Iterator[h5py.Group]:
+        """Writable experiment group of one file for the duration of an edit.
+
+        Read only files are closed, reopened for writing and reopened read only afterwards, so
+        epochs from earlier queries of that file need querying again.
+        """
+        if self.mode != "r":
+            yield self.files[exppath]
+            self.files[exppath].file.flush()
+            return
+
+        if self.archive is not None:
+            # THE DAY FILE IS REOPENED THROUGH ITS LINK ON THE NEXT QUERY
+            self.archive.forget(exppath)
+            with writable(self.archive.filepath(exppath)) as f:
+                yield f["experiment"]
+            return
+
+        self.files[exppath].file.close()
+        try:
+            with writable(exppath) as f:
+                yield f["experiment"]
+        finally:
+            self.files[exppath] = self._open(exppath)
+
     def to_tree(self, name, splits) -> AnalysisTree:
         return AnalysisTree(name, splits, self.frame)
 
@@ -36,11 +129,25 @@ class EpochIO(ABC):
         newframe = self.frame
 
         for _, row in eframe.iterrows():
-            row["epoch"].update(paramname, value)
             if paramname in newframe.columns:
                 newframe.loc[newframe.startdate == row["startdate"], paramname] = value
 
-        eframe.epoch.iloc[0]._response_ds.flush()
+        # ONE WRITABLE SESSION PER EDITED FILE
+        # KEEP CONSOLIDATED EPOCH INDEX AND PARAMS CACHE IN STEP WITH THE EDIT
+        for exppath, frame in eframe.groupby("exppath"):
+            numbers = frame.number.astype(int).values
+            with self.session(exppath) as experiment:
+                current = epochindex.mark_edited(experiment.file)
+                for number in numbers:
+                    epoch_factory(experiment[f"epoch{number}"]).update(paramname, value)
+                epochindex.update_index(experiment.file, numbers, paramname, value, current)
+            paramscache.invalidate(exppath, self.cachedir)
+            if paramname in set(["genotype", "celltype"]):
+                self.table.set(paramname, self.table.rows([exppath] * len(numbers), numbers), value)
+                if self.archive is not None:
+                    self.archive.set(exppath, numbers, paramname, value)
+        if self.archive is not None:
+            self.archive.flush()
 
         self.set_frame(newframe)
 
@@ -92,16 +199,8 @@ class EpochIO(ABC):
             df = df.drop_duplicates(keep="first")
 
         if df.shape[0] != 0:
-            def func(row):
-                try:
-                    return epoch_factory(self.files[row.exppath][f"epoch{int(row.number)}"])
-                except Exception as e:
-                    print(row.exppath)
-                    raise e
-
-            df["epoch"] = df.apply(lambda x: 
-                func(x),
-                axis=1)
+            rows = self.table.rows(df.exppath.values, df.number.values)
+            df["epoch"] = table_epochs(self.table, rows)
         else:
             raise Exception("No epochs returns")
 
@@ -11,8 +11,19 @@ import pandas as pd
 from matplotlib.pyplot import Axes
 from scipy.stats import sem, ttest_ind
 
-from ...epochtypes import IEpoch, WholeEpoch, WholeEpochs, SpikeEpoch, SpikeEpochs
+from ...epochtypes import IEpoch, WholeEpoch, WholeEpochs, SpikeEpoch, SpikeEpochs, spike_psths, whole_metrics
 from ...funks import HillEquation, WeberEquation
+from ...funks.psth import DEFAULT_PARAMS, PsthParams
+
+
+def metric_values(epochs, metric: str) -> np.array:
+    """One metric per epoch or block. Whole cell items and spike blocks are computed together in one pass."""
+    epochs = list(epochs)
+    if len(epochs) > 0 and all(isinstance(epoch, (WholeEpoch, WholeEpochs)) for epoch in epochs):
+        return whole_metrics(epochs)[metric].values.astype(float)
+    if len(epochs) > 0 and all(isinstance(epoch, SpikeEpochs) for epoch in epochs):
+        spike_psths(epoch for epoch in epochs if epoch._psths is None)
+    return np.array([getattr(epoch, metric) for epoch in epochs], dtype=float)
 
 
 def p_to_star(p):
@@ -87,13 +98,14 @@ class PlotBase(ABC):
 
 class PlotPsth(PlotBase):
 
-    def __init__(self, ax: Axes, epochs:Union[SpikeEpoch, SpikeEpochs]=None, label=None, igor=False):
+    def __init__(self, ax: Axes, epochs:Union[SpikeEpoch, SpikeEpochs]=None, label=None, igor=False, psthparams: PsthParams = DEFAULT_PARAMS):
         self.ax: Axes = ax
+        self.psthparams = psthparams
 
         self.ax.grid(False)
         self.ax.margins(x=0, y=0)
         self.ax.set_ylabel("Hz / s")
-        self.ax.set_xlabel("10ms bins")
+        self.ax.set_xlabel(f"{1000 * psthparams.inc / psthparams.samplerate:g}ms bins")
 
         self.colors = Pallette(igor)
 
@@ -111,15 +123,19 @@ class PlotPsth(PlotBase):
             n = 1
         else:
             n = len(epochs)
-        psth = epochs.psth
+        if isinstance(epochs, IEpoch):
+            psth = epochs.get_psth(self.psthparams)
+        else:
+            psth = np.mean(epochs.get_psths(self.psthparams), axis=0)
 
         name = epochs.get_unique("genotype")[0]
         stimtime = epochs.get_unique("stimtime")[0]
 
         # CALCULATE TTP AND MAX PEAK
-        seconds_conversion = 10000 / 100
-        ttp = (np.argmax(psth) + 1 - stimtime/100) / (seconds_conversion)
-        X = (np.arange(len(psth)) + 1 - stimtime/100) / (seconds_conversion)
+        inc = self.psthparams.inc
+        seconds_conversion = self.psthparams.samplerate / inc
+        ttp = (np.argmax(psth) + 1 - stimtime/inc) / (seconds_conversion)
+        X = (np.arange(len(psth)) + 1 - stimtime/inc) / (seconds_conversion)
 
         # PLOT VALUES SHIFT BY STIM TIME
         self.ax.axvline(ttp, linestyle='--', color=self.colors[name], alpha=0.4)
@@ -489,16 +505,10 @@ class PlotSwarm(PlotBase):
             celltraces = frame.epoch.values
 
             if self.metric == "peakamplitude":
-                values = np.array([
-                    cell.peakamplitude
-                    for cell in celltraces
-                ], dtype=float)
+                values = metric_values(celltraces, "peakamplitude")
 
             elif self.metric == "timetopeak":
-                values = np.array([
-                    cell.timetopeak / 10000
-                    for cell in celltraces
-                ], dtype=float)
+                values = metric_values(celltraces, "timetopeak") / 10000
 
             meanval = np.mean(values)
             semval = sem(values)
@@ -641,10 +651,9 @@ class PlotCRF(PlotBase):
                 contrast = lightamp / lightmean
 
                 # GET PEAK AMPLITUDE FROM EACH PSTH - USED IN SEM
-                peakamps = np.array([
-                    epoch.peakamplitude if self.metric == "peakamplitude" else epoch.timetopeak
-                    for epoch in frame.epoch.values
-                ])
+                peakamps = metric_values(
+                    frame.epoch.values,
+                    "peakamplitude" if self.metric == "peakamplitude" else "timetopeak")
 
                 X.append(contrast)
                 Y.append(np.mean(peakamps))
@@ -745,12 +754,16 @@ class PlotHill(PlotBase):
         genotype = eframe.genotype.iloc[0]
         self.lightmean = eframe.lightmean.iloc[0]
 
+        # PEAK AMPLITUDES OF EVERY ROW IN ONE PASS
+        df = eframe.copy()
+        df["peakamp"] = metric_values(eframe.epoch.values, "peakamplitude")
+
         # TODO will this be done on epoch level?
         # FIT HILL TO EACH CELL - ONLY PLOT PEAK AMOPLITUDES
-        for cellname, frame in eframe.groupby(["cellname"]):
+        for cellname, frame in df.groupby(["cellname"]):
             frame = frame.sort_values(["lightamplitude"])
             X = frame.lightamplitude.values
-            Y = frame.epoch.apply(lambda x: x.peakamplitude).values
+            Y = frame.peakamp.values
 
             Y = -1 * Y if max(Y) < 0 else Y
 
@@ -759,8 +772,6 @@ class PlotHill(PlotBase):
             self.fits[cellname] = hill
 
         # FIT HILL TO AVERAGE OF PEAK AMPLITUDES
-        df = eframe.copy()
-        df["peakamp"] = eframe.epoch.apply(lambda x: x.peakamplitude).values
         dff = df.groupby("lightamplitude").peakamp.mean().reset_index()
 
         # PLOT LINE AND AVERAGES
@@ -813,11 +824,15 @@ class PlotWeber(PlotBase):
         genotype = eframe.genotype.iloc[0]
         self.lightmean = eframe.genotype.iloc[0]
 
+        # PEAK AMPLITUDES OF EVERY ROW IN ONE PASS
+        df = eframe.copy()
+        df["peakamp"] = metric_values(eframe.epoch.values, "peakamplitude")
+
         # FIT HILL TO EACH CELL - ONLY PLOT PEAK AMPLITUDES
-        for cellname, frame in eframe.groupby(["cellname"]):
+        for cellname, frame in df.groupby(["cellname"]):
             frame = frame.sort_values(["lightamplitude"])
             X = frame.lightamplitude.values
-            Y = frame.epoch.apply(lambda x: x.peakamplitude).values
+            Y = frame.peakamp.values
 
             weber = WeberEquation()
             weber.fit(X, Y)
@@ -825,8 +840,6 @@ class PlotWeber(PlotBase):
             self.fits[cellname] = weber
 
         # FIT HILL TO AVERAGE OF PEAK AMPLITUDES
-        df = eframe.copy()
-        df["peakamp"] = eframe.epoch.apply(lambda x: x.peakamplitude)
         dff = df.groupby("lightamplitude").peakamp.mean().reset_index()
 
         # FIT WEBER TO AVERAGE PEAK AMPLITUDES
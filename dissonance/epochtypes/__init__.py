@@ -1,5 +1,7 @@
-from .spikeepoch import SpikeEpoch, SpikeEpochs
-from .wholeepoch import WholeEpoch, WholeEpochs
+from .spikeepoch import SpikeEpoch, SpikeEpochs, spike_psths
+from .spiketrains import SpikeTrains
+from .wholeepoch import WholeEpoch, WholeEpochs, whole_metrics
 from .baseepoch import IEpoch, EpochBlock 
 from .ns_epochtypes import groupby,  filter
-from .epochfactory import epoch_factory
+from .epochfactory import epoch_factory, table_epochs
+from .epochtable import EpochTable
@@ -1,55 +1,99 @@
+import logging
 from abc import ABC, abstractproperty
 from collections import defaultdict
-from pathlib import Path
-from typing import Dict, Iterable, Iterator, List, Tuple
+from typing import Dict, Iterable, List, Tuple
 
 import h5py
 import numpy as np
-import pandas as pd
 
-# RSTARR MAPPING
-rstarrdf = pd.read_csv(Path(__file__).parent.parent.parent / "data/rstarrmap.txt", "\t",
-                       parse_dates=["startdate", "enddate"])
-RSTARRMAP = defaultdict(list)
-for _, row in rstarrdf.iterrows():
-    RSTARRMAP[(row["protocolname"], row["led"], row["lightamplitude"], row["lightmean"])] = (
-        row["lightamplitude_rstarr"], row["lightmean_rstarr"])
+from ..io import mapped, packed
+from . import tracecache
+from .epochtable import Column, EpochTable
+from .paramview import ParamView
+
+logger = logging.getLogger(__name__)
 
 
 class IEpoch(ABC):
+    """Handle on a row of an EpochTable. Attributes are read from the table when used and the
+    epoch's h5 group is only opened when its trace or spikes are read.
+
+    Args:
+        epochgrp (h5py.Group, optional): Epoch group, read into a one row table.
+        table (EpochTable, optional): Shared table the epoch is a row of.
+        row (int, optional): Row of the epoch in table.
+    """
+    __slots__ = ("_table", "_row", "_group", "_response_view", "_packedtraces")
+
+    protocolname = Column()
+    cellname = Column()
+    celltype = Column()
+    genotype = Column()
+    tracetype = Column()
+    path = Column()
+    amp = Column()
+    interpulseinterval = Column()
+    led = Column()
+    lightamplitude = Column()
+    lightmean = Column()
+    numberofaverages = Column()
+    samplerate = Column()
+    pretime = Column(scale=10)
+    stimtime = Column(scale=10)
+    tailtime = Column(scale=10)
+    startdate = Column()
+    enddate = Column()
+
+    def __init__(self, epochgrp: h5py.Group = None, table: EpochTable = None, row: int = 0):
+        if table is None:
+            table = EpochTable.from_group(epochgrp)
+        self._table = table
+        self._row = row
+        self._group = epochgrp
+        self._response_view = None
+        self._packedtraces = None
+
+    @property
+    def number(self) -> int:
+        return int(self._table.value("number", self._row))
 
-    def __init__(self, epochgrp: h5py.Group):
-
-        self._epochpath: str = epochgrp.name
-        self._response_ds = epochgrp["Amp1"]
-
-        self.protocolname = epochgrp.attrs.get("protocolname")
-        self.cellname = epochgrp.attrs.get("cellname")
-        self.celltype = epochgrp.attrs.get("celltype")
-        self.genotype = epochgrp.attrs.get("genotype")
-        self.tracetype = epochgrp.attrs.get("tracetype")
-        self.path = epochgrp.attrs.get("path")
-        self.amp = epochgrp.attrs.get("amp")
-        self.interpulseinterval = epochgrp.attrs.get("interpulseinterval")
-        self.led = epochgrp.attrs.get("led")
-        self.lightamplitude = epochgrp.attrs.get("lightamplitude")
-        self.lightmean = epochgrp.attrs.get("lightmean")
-        self.numberofaverages = epochgrp.attrs.get("numberofaverages")
-        self.samplerate = epochgrp.attrs.get("samplerate")
-        self.pretime = epochgrp.attrs.get("pretime") * 10
-        self.stimtime = epochgrp.attrs.get("stimtime") * 10
-        self.tailtime = epochgrp.attrs.get("tailtime") * 10
-        self.startdate = epochgrp.attrs.get("startdate")
-        self.enddate = epochgrp.attrs.get("enddate")
-        self.number = int(epochgrp.name.split("/")[-1][5:])
-        #self.stimuli = {key: val for key,
-        #                val in epochgrp[self.led].attrs.items()}
+    @property
+    def pctcontrast(self) -> float:
         # DERIVE RSTARR VALUES
-        self.pctcontrast = (
+        return (
             self.lightamplitude / self.lightmean
             if self.lightmean != 0.0
             else 0.0)
 
+    @property
+    def _epochgrp(self) -> h5py.Group:
+        # LOOKED UP AGAIN IF ITS FILE WAS CLOSED, ARCHIVES CLOSE DAY FILES NOT RECENTLY USED
+        if self._group is None or not self._group.id.valid:
+            self._group = self._table.group(self._row)
+            self._packedtraces = None
+        return self._group
+
+    @property
+    def _epochpath(self) -> str:
+        return self._epochgrp.name
+
+    @property
+    def _response_ds(self) -> h5py.Dataset:
+        return self._epochgrp.get("Amp1")
+
+    @property
+    def _filekey(self) -> str:
+        # TRACES DON'T CHANGE ONCE WRITTEN, SO THE PATH IS ENOUGH TO KEY CACHED TRACES
+        return str(self._table.columns["exppath"][self._row])
+
+    @property
+    def _packed(self) -> packed.PackedTraces:
+        # USE PACKED TRACES IF THE FILE HAS THEM, FALSE ONCE KNOWN NOT TO
+        if self._packedtraces is None or (self._packedtraces is not False and not self._packedtraces.group.id.valid):
+            pck = packed.read_packed(self._epochgrp.file)
+            self._packedtraces = pck if pck is not None and self.number in pck else False
+        return self._packedtraces if self._packedtraces is not False else None
+
     def __hash__(self):
         return hash(self.startdate)
 
@@ -60,25 +104,41 @@ class IEpoch(ABC):
         try:
             return int(self.pretime + self.stimtime + self.tailtime)
         except TypeError as e:
-            print(e)
+            logger.warning(f"{self}: no length, {e}")
             return 0.0
 
     def update(self, paramname, value):
         if paramname in set(["genotype", "celltype"]):
-            parent = self._response_ds.parent
-            parent.attrs[paramname] = value
+            self._epochgrp.attrs[paramname] = value
             try:
                 setattr(self, paramname, value)
-            except:
-                #print(f"Couldn't set {paramname, value} on object {self}.")
-                ...
+            except AttributeError:
+                logger.debug(f"Couldn't set {paramname, value} on object {self}.")
             return
         else:
             print(f"Can't change {paramname} to {value}")
 
+    def flush(self):
+        self._epochgrp.file.flush()
+
+    def _read_trace(self) -> np.array:
+        if self._packed is not None:
+            return self._packed.trace(self.number)
+        # READ ONLY VIEW OF THE MAPPED FILE, FALSE IF THE DATASET CAN'T BE MAPPED
+        if self._response_view is None:
+            view = mapped.dataset_view(self._response_ds)
+            self._response_view = False if view is None else view
+        if self._response_view is not False:
+            return self._response_view
+        return self._response_ds[:]
+
+    def _process_trace(self, values: np.array) -> np.array:
+        """Applied to raw values on every read. Overridden for baseline subtraction."""
+        return values
+
     @property
     def trace(self):
-        return self._response_ds[:]
+        return self._process_trace(self._read_trace())
 
     @property
     @abstractproperty
@@ -108,6 +168,8 @@ class EpochBlock(ABC):
 
         # DUMMY PROPERTIES
         self._trace_len: int = None
+        self._traces_key: Tuple = None
+        self._paramview: ParamView = None
 
     def __str__(self):
         return "EpochBlock"
@@ -134,6 +196,8 @@ class EpochBlock(ABC):
 
     def append(self, epoch) -> None:
         self._trace_len = None
+        self._traces_key = None
+        self._paramview = None
         self._epochs.append(epoch)
 
 
@@ -147,30 +211,65 @@ class EpochBlock(ABC):
 
     @property
     def traces(self) -> np.array:
-        # PAD ALL VALUES TO STRETCH INTO FULL ARRAY
-        return np.vstack(
-            [
-                np.pad(epoch.trace, (0, self.trace_len - len(epoch)))
-                for epoch in self._epochs
-            ])
+        """Padded (epochs, trace_len) matrix, read only. Shared through the process wide trace cache."""
+        if self._traces_key is None:
+            # ROWS ARE IN EPOCH ORDER AND PROCESSED BY EPOCH TYPE
+            self._traces_key = (self.trace_len, tuple(
+                (epoch._filekey, epoch.number, type(epoch)) for epoch in self._epochs))
+        out = tracecache.CACHE.get(self._traces_key)
+        if out is None:
+            out = self._read_traces()
+            tracecache.CACHE.put(self._traces_key, out)
+        return out
+
+    def _read_traces(self) -> np.array:
+        # ALLOCATED ONCE AT THE FULL SHAPE AND FILLED IN PLACE
+        out = np.zeros((len(self._epochs), self.trace_len))
+
+        # PACKED FILES ARE READ IN BULK, ONE SET OF RANGE READS PER FILE
+        byfile = defaultdict(list)
+        for ii, epoch in enumerate(self._epochs):
+            if epoch._packed is not None:
+                byfile[id(epoch._packed)].append(ii)
+            else:
+                trace = epoch.trace
+                n = min(len(trace), self.trace_len)
+                out[ii, :n] = trace[:n]
+
+        for rows in byfile.values():
+            pck = self._epochs[rows[0]]._packed
+            numbers = [self._epochs[ii].number for ii in rows]
+            # FILL OUT DIRECTLY WHEN EVERY EPOCH COMES FROM THIS FILE
+            values = out if len(rows) == len(self._epochs) else np.zeros((len(rows), self.trace_len))
+            lengths = pck.read_traces(numbers, values)
+            for jj, ii in enumerate(rows):
+                n = lengths[jj]
+                out[ii, :n] = self._epochs[ii]._process_trace(values[jj, :n])
+        return out
+
+    @property
+    def params(self) -> ParamView:
+        """Typed parameter arrays, uniques and group codes of the block's epochs"""
+        if self._paramview is None:
+            self._paramview = ParamView(self._epochs)
+        return self._paramview
 
     def get(self, paramname) -> np.array:
-        try:
-            return np.array(
-                [
-                    getattr(e, paramname)
-                    for e in self._epochs
-                ],
-                dtype=float)
-        except:
-            return np.array(
-                [
-                    getattr(e, paramname)
-                    for e in self._epochs
-                ],
-                dtype=str)
+        """Read only values, floats or strings if any value isn't numeric"""
+        return self.params.get(paramname)
 
     def get_unique(self, paramname) -> np.array:
-        return np.unique(self.get(paramname))
+        return self.params.unique(paramname)
+
+    def groupby(self, paramnames: List[str]) -> Dict[Tuple, "EpochBlock"]:
+        """Block of each combination of values of paramnames, in sorted key order"""
+        return {
+            key: type(self)([self._epochs[ii] for ii in positions])
+            for key, positions in self.params.groups(paramnames).items()}
+
+    def filter(self, **kwargs) -> "EpochBlock":
+        """Block of the epochs whose values equal every keyword"""
+        mask = self.params.mask(**kwargs)
+        return type(self)([epoch for epoch, keep in zip(self._epochs, mask) if keep])
 
 
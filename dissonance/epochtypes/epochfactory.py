@@ -1,11 +1,24 @@
+from typing import List
+
 import h5py
+import numpy as np
 
+from .epochtable import EpochTable
 from .spikeepoch import SpikeEpoch
 from .wholeepoch import WholeEpoch
 
+EPOCH_TYPES = {"spiketrace": SpikeEpoch, "wholetrace": WholeEpoch}
+
+
 def epoch_factory(epochgrp: h5py.Group):
     tracetype = epochgrp.attrs["tracetype"]
     if tracetype == "spiketrace":
         return SpikeEpoch(epochgrp)
     elif tracetype == "wholetrace":
-        return WholeEpoch(epochgrp)
\ No newline at end of file
+        return WholeEpoch(epochgrp)
+
+
+def table_epochs(table: EpochTable, rows: np.array) -> List:
+    """Epoch handles on rows of a table, typed by the tracetype column"""
+    tracetypes = table.columns["tracetype"]
+    return [EPOCH_TYPES[tracetypes[row]](table=table, row=int(row)) for row in rows]
@@ -0,0 +1,142 @@
+"""
+Columnar epoch metadata.
+
+An EpochTable holds the attributes of many epochs as one array per attribute,
+with exppath and number columns locating each epoch. Epoch objects are thin
+handles on a row of a table; their attributes are looked up in the table when
+used and their h5 group is only opened when the trace or spikes are read.
+
+EpochIO builds one table over every file and hands out handles on its rows,
+so a query builds epochs without reading any attributes. A file's rows are
+read from its epoch index the first time one of its epochs is queried, an
+archive's come from the archive index up front. epoch_factory on a single
+group still works and builds a one row table from the group's attributes.
+"""
+from typing import Dict, Iterable, Mapping
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from ..io import epochindex
+
+
+class EpochTable:
+    """
+    Args:
+        columns (Dict[str, np.array]): Attribute name to one value per epoch. Must include
+            exppath and number.
+        files (Mapping, optional): exppath to the file's experiment group, such as EpochIO.files
+            or an Archive. Looked up again on every group open so reopened files are picked up.
+    """
+
+    def __init__(self, columns: Dict[str, np.array], files: Mapping = None):
+        self.columns = columns
+        self.files = files
+        self.n = len(columns["number"])
+        self.version = 0
+        self._rows: Dict = None
+        # FILES WHOSE ROWS AREN'T READ YET, str(exppath) TO THE KEY IN files
+        self._unloaded: Dict = dict()
+
+    def __len__(self):
+        return self.n
+
+    @classmethod
+    def from_frame(cls, frame: pd.DataFrame, files: Mapping = None) -> "EpochTable":
+        return cls({column: frame[column].values for column in frame.columns}, files)
+
+    @classmethod
+    def from_group(cls, epochgrp: h5py.Group) -> "EpochTable":
+        """One row table from an epoch group's attributes"""
+        columns = {
+            key: np.array([val], dtype=object)
+            for key, val in epochgrp.attrs.items()}
+        columns["number"] = np.array([int(epochgrp.name.split("/")[-1][5:])])
+        columns["exppath"] = np.array([epochgrp.file.filename], dtype=object)
+        return cls(columns, {epochgrp.file.filename: epochgrp.parent})
+
+    @classmethod
+    def from_files(cls, files: Mapping) -> "EpochTable":
+        """Table over every epoch of every file. Nothing is read until rows asks for a file's epochs,
+        then that file's epoch index is read, or its attributes if it has none."""
+        table = cls({"exppath": np.array([], dtype=object), "number": np.array([], dtype=int)}, files)
+        table._unloaded = {str(exppath): exppath for exppath in files}
+        return table
+
+    def _load(self, exppath) -> None:
+        """Append the rows of one file. Rows already handed out keep their positions."""
+        experiment = self.files[exppath]
+        index = epochindex.read_index(experiment.file)
+        if index is None:
+            index = epochindex.index_to_frame(epochindex.build_index(experiment))
+        index["exppath"] = pd.Series([exppath] * index.shape[0], dtype=object)
+        if self.n > 0:
+            index = pd.concat([pd.DataFrame(self.columns), index], ignore_index=True)
+        self.columns = {column: index[column].values for column in index.columns}
+        self.n = index.shape[0]
+        self.version += 1
+        self._rows = None
+
+    def value(self, name: str, row: int):
+        """Attribute of one epoch, None if no epoch has it"""
+        column = self.columns.get(name)
+        if column is None:
+            return None
+        return column[row]
+
+    def set(self, name: str, rows, value) -> None:
+        """Set an attribute of rows, widening the column to object if the value doesn't fit"""
+        self.version += 1
+        column = self.columns.get(name)
+        if column is None:
+            column = np.full(self.n, None, dtype=object)
+            self.columns[name] = column
+        try:
+            column[rows] = value
+        except (TypeError, ValueError):
+            column = column.astype(object)
+            column[rows] = value
+            self.columns[name] = column
+
+    def rows(self, exppaths: Iterable, numbers: Iterable) -> np.array:
+        """Rows of (exppath, number) pairs"""
+        exppaths = [str(exppath) for exppath in exppaths]
+        for exppath in set(exppaths) & set(self._unloaded):
+            self._load(self._unloaded.pop(exppath))
+        if self._rows is None:
+            self._rows = {
+                (str(exppath), int(number)): ii
+                for ii, (exppath, number) in enumerate(zip(self.columns["exppath"], self.columns["number"]))}
+        return np.array([
+            self._rows[(exppath, int(number))]
+            for exppath, number in zip(exppaths, numbers)], dtype=int)
+
+    def group(self, row: int) -> h5py.Group:
+        exppath = self.columns["exppath"][row]
+        return self.files[exppath][f"epoch{int(self.columns['number'][row])}"]
+
+
+class Column:
+    """Epoch attribute read from the epoch's table row. scale is applied on read."""
+
+    def __init__(self, name: str = None, scale: float = None):
+        self.name = name
+        self.scale = scale
+
+    def __set_name__(self, owner, name):
+        if self.name is None:
+            self.name = name
+
+    def __get__(self, epoch, owner=None):
+        if epoch is None:
+            return self
+        value = epoch._table.value(self.name, epoch._row)
+        if self.scale is None or value is None:
+            return value
+        return value * self.scale
+
+    def __set__(self, epoch, value):
+        if self.scale is not None and value is not None:
+            value = value / self.scale
+        epoch._table.set(self.name, epoch._row, value)
@@ -29,6 +29,8 @@ def groupby(frame:pd.DataFrame, grpkeys) -> pd.DataFrame:
 	return pd.DataFrame(columns = [*grpkeys, "epoch"], data=data)
 
 def filter(epochs, **kwargs):
+	if isinstance(epochs, bt.EpochBlock):
+		return epochs.filter(**kwargs)
 	out = []
 	for epoch in epochs:
 		condition = all([
@@ -0,0 +1,117 @@
+"""
+Columnar parameter view of an epoch block.
+
+Built once per block. When every epoch is a row of the same EpochTable, a
+parameter is one fancy index into the table column; other parameters
+(peakamplitude, psth, ...) are read from the epochs once. Typed values,
+uniques and group codes are cached per parameter and dropped if the table is
+edited.
+"""
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from .epochtable import Column
+
+
+class ParamView:
+
+    def __init__(self, epochs: List):
+        self.epochs = epochs
+        self.n = len(epochs)
+        self.table = None
+        self.rows = None
+        self.epochtype = None
+
+        if self.n > 0:
+            types = {type(epoch) for epoch in epochs}
+            self.epochtype = types.pop() if len(types) == 1 else None
+            table = epochs[0]._table
+            if all(epoch._table is table for epoch in epochs):
+                self.table = table
+                self.rows = np.fromiter((epoch._row for epoch in epochs), dtype=int, count=self.n)
+
+        self._version = None if self.table is None else self.table.version
+        self._values: Dict[str, np.array] = dict()
+        self._uniques: Dict[str, np.array] = dict()
+        self._codes: Dict[str, Tuple[np.array, np.array]] = dict()
+
+    def _check(self) -> None:
+        # EDITS THROUGH THE TABLE INVALIDATE EVERYTHING CACHED
+        if self.table is not None and self.table.version != self._version:
+            self._values.clear()
+            self._uniques.clear()
+            self._codes.clear()
+            self._version = self.table.version
+
+    def raw(self, paramname: str) -> np.array:
+        """Values as stored, one per epoch"""
+        column = getattr(self.epochtype, paramname, None) if self.epochtype is not None else None
+        if self.table is not None and (isinstance(column, Column) or paramname == "number"):
+            name = paramname if paramname == "number" else column.name
+            values = self.table.columns.get(name)
+            if values is None:
+                return np.full(self.n, None, dtype=object)
+            values = values[self.rows]
+            if paramname != "number" and column.scale is not None:
+                try:
+                    values = values * column.scale
+                except TypeError:
+                    values = np.array([None if val is None else val * column.scale for val in values], dtype=object)
+            return values
+
+        values = np.empty(self.n, dtype=object)
+        values[:] = [getattr(epoch, paramname) for epoch in self.epochs]
+        return values
+
+    def get(self, paramname: str) -> np.array:
+        """Read only values as floats, or strings if any value isn't numeric"""
+        self._check()
+        values = self._values.get(paramname)
+        if values is None:
+            raw = self.raw(paramname)
+            try:
+                values = raw.astype(float)
+            except (TypeError, ValueError):
+                values = raw.astype(str)
+            values.setflags(write=False)
+            self._values[paramname] = values
+        return values
+
+    def codes(self, paramname: str) -> Tuple[np.array, np.array]:
+        """Sorted unique values and each epoch's position in them"""
+        self._check()
+        codes = self._codes.get(paramname)
+        if codes is None:
+            codes = np.unique(self.get(paramname), return_inverse=True)
+            self._codes[paramname] = codes
+            self._uniques[paramname] = codes[0]
+        return codes
+
+    def unique(self, paramname: str) -> np.array:
+        self._check()
+        uniques = self._uniques.get(paramname)
+        if uniques is None:
+            uniques = self.codes(paramname)[0]
+        return uniques
+
+    def groups(self, paramnames: List[str]) -> Dict[Tuple, np.array]:
+        """Positions of the epochs of each combination of values, in sorted key order"""
+        uniques, codes = zip(*[self.codes(paramname) for paramname in paramnames])
+        combined = np.ravel_multi_index(codes, dims=[len(values) for values in uniques])
+        keys, inverse = np.unique(combined, return_inverse=True)
+        order = np.argsort(inverse, kind="stable")
+        bounds = np.cumsum(np.bincount(inverse, minlength=len(keys)))[:-1]
+
+        groups = dict()
+        for key, positions in zip(keys, np.split(order, bounds)):
+            indices = np.unravel_index(key, [len(values) for values in uniques])
+            groups[tuple(values[ii] for values, ii in zip(uniques, indices))] = positions
+        return groups
+
+    def mask(self, **kwargs) -> np.array:
+        """Epochs whose stored values equal every keyword"""
+        mask = np.ones(self.n, dtype=bool)
+        for paramname, value in kwargs.items():
+            mask &= np.array(self.raw(paramname) == value, dtype=bool)
+        return mask
@@ -1,28 +1,29 @@
-from typing import List, Dict
+from typing import Dict, Iterable, List
 
 import numpy as np
-from ..funks.psth import calculate_psth
+from ..funks.psth import DEFAULT_PARAMS, PsthParams
 import h5py
 
 from .baseepoch import EpochBlock, IEpoch
+from .spiketrains import SpikeTrains, epoch_psths
 
 
 class SpikeEpoch(IEpoch):
-
-    def __init__(self, epochgrp: h5py.Group):
-        super().__init__(epochgrp)
-        self._spikegrp = epochgrp["Spikes"]
-        self._psth = None
+    __slots__ = ()
 
     @property
     def spikes(self) -> np.array:
-        return np.array(self._spikegrp[:], dtype=int)
+        if self._packed is not None:
+            return np.array(self._packed.spikes(self.number), dtype=int)
+        return np.array(self._epochgrp["Spikes"][:], dtype=int)
 
     @property
     def psth(self) -> np.array:
-        if self._psth is None:
-            self._psth = calculate_psth(self)
-        return self._psth
+        return self.get_psth()
+
+    def get_psth(self, psthparams: PsthParams = DEFAULT_PARAMS) -> np.array:
+        """Read only PSTH with psthparams' bin width and smoothing, memoized"""
+        return epoch_psths([self], psthparams)[0]
 
     @property
     def timetopeak(self) -> np.array:
@@ -69,25 +70,49 @@ class SpikeEpochs(EpochBlock):
         self._psth: np.array = None
         self._psths: np.array = None
         self._hillfit:np.array = None
+        self._spiketrains: SpikeTrains = None
+        self._psthparams: PsthParams = DEFAULT_PARAMS
+
+    def append(self, epoch) -> None:
+        super().append(epoch)
+        self._psth = None
+        self._psths = None
+        self._spiketrains = None
+
+    @property
+    def spiketrains(self) -> SpikeTrains:
+        """Spike indices of every epoch in one ragged array"""
+        if self._spiketrains is None:
+            self._spiketrains = SpikeTrains.from_epochs(self._epochs)
+        return self._spiketrains
+
+    @property
+    def psthparams(self) -> PsthParams:
+        """Bin width and smoothing of psth and psths"""
+        return self._psthparams
+
+    @psthparams.setter
+    def psthparams(self, psthparams: PsthParams) -> None:
+        self._psthparams = psthparams
+        self._psth = None
+        self._psths = None
 
     @property
     def psth(self):
-        inc = 100
         if self._psth is None:
             self._psth = np.mean(self.psths, axis=0)
         return self._psth
 
     @property
     def psths(self) -> np.array:
-        inc = 100
+        """Read only (epochs, trace_len // inc) PSTHs with the block's psthparams"""
         if self._psths is None:
-            self._psths = []
-            for trace in self._epochs:
-                if len(trace.psth) > 0 and trace.psth is not None:
-                    cpsth = np.pad(
-                        trace.psth, (0, int(self.trace_len // inc - len(trace.psth))))
-                    self._psths.append(cpsth)
-        return np.array(self._psths, dtype=float)
+            self._psths = self.get_psths(self._psthparams)
+        return self._psths
+
+    def get_psths(self, psthparams: PsthParams = DEFAULT_PARAMS) -> np.array:
+        """Read only (epochs, trace_len // inc) PSTHs for any bin width and smoothing, memoized per epoch"""
+        return _stack_psths(epoch_psths(self._epochs, psthparams), int(self.trace_len // psthparams.inc))
 
     @property
     def timetopeak(self) -> np.array:
@@ -95,4 +120,39 @@ class SpikeEpochs(EpochBlock):
 
     @property
     def peakamplitude(self) -> np.array:
-        return np.max(self.psth)
\ No newline at end of file
+        return np.max(self.psth)
+
+
+def _stack_psths(psths: List[np.array], nbins: int) -> np.array:
+    # EPOCHS WITHOUT A TRACE HAVE NO PSTH, THE REST ARE CUT OR ZERO PADDED TO NBINS
+    psths = [psth for psth in psths if len(psth) > 0]
+    out = np.zeros((len(psths), nbins))
+    for ii, psth in enumerate(psths):
+        n = min(len(psth), nbins)
+        out[ii, :n] = psth[:n]
+    out.setflags(write=False)
+    return out
+
+
+def spike_psths(blocks: Iterable[SpikeEpochs], psthparams: PsthParams = None) -> List[np.array]:
+    """PSTHs of every epoch of every block, computed together in one pass over their spikes.
+    Defaults to each block's psthparams. The PSTHs are also kept on each block so its psth
+    properties don't recompute."""
+    blocks = list(blocks)
+    bykey = dict()
+    for block in blocks:
+        bykey.setdefault(block.psthparams if psthparams is None else psthparams, []).append(block)
+
+    out = dict()
+    for params, group in bykey.items():
+        psths = epoch_psths([epoch for block in group for epoch in block], params)
+        start = 0
+        for block in group:
+            stop = start + len(block)
+            values = _stack_psths(psths[start:stop], int(block.trace_len // params.inc))
+            if params == block.psthparams:
+                block._psths = values
+                block._psth = None
+            out[id(block)] = values
+            start = stop
+    return [out[id(block)] for block in blocks]
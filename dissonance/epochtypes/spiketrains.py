@@ -0,0 +1,121 @@
+"""
+Ragged spike trains of many epochs.
+
+Spike indices of every epoch are held as one concatenated array with an
+offset per epoch (the CSR layout), alongside each epoch's trace length. Spikes
+of packed files are read with one range read per file, and every PSTH of the
+block is counted with a single bincount over (epoch, bin) codes, so building
+PSTHs scales with the number of spikes rather than with a Python loop over
+epochs.
+
+PSTHs are memoized per epoch and PsthParams in a process wide cache of
+DISSONANCE_PSTH_CACHE_MB megabytes (16 by default), so plots that switch bin
+width or smoothing only compute each setting once.
+"""
+import os
+from collections import defaultdict
+from typing import Iterable, List, Sequence
+
+import numpy as np
+
+from ..funks import psth
+from . import tracecache
+
+BUDGET_ENV = "DISSONANCE_PSTH_CACHE_MB"
+
+
+class SpikeTrains:
+    """
+    Args:
+        indices (np.array): Spike indices of every epoch, concatenated in epoch order.
+        offsets (np.array): n + 1 offsets, epoch ii's spikes are indices[offsets[ii]:offsets[ii+1]].
+        lengths (np.array): Trace length of each epoch in samples.
+    """
+
+    def __init__(self, indices: np.array, offsets: np.array, lengths: np.array):
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.n = len(self.lengths)
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, ii: int) -> np.array:
+        return self.indices[self.offsets[ii]:self.offsets[ii + 1]]
+
+    @classmethod
+    def from_epochs(cls, epochs: Iterable) -> "SpikeTrains":
+        """Spike trains of epochs, read in bulk from packed files and per epoch otherwise"""
+        epochs = list(epochs)
+        spikes: List[np.array] = [None] * len(epochs)
+        lengths = np.zeros(len(epochs), dtype=np.int64)
+
+        # PACKED FILES ARE READ IN BULK, ONE SPIKE READ PER FILE
+        byfile = defaultdict(list)
+        for ii, epoch in enumerate(epochs):
+            if epoch._packed is not None:
+                byfile[id(epoch._packed)].append(ii)
+            else:
+                ds = epoch._response_ds
+                lengths[ii] = 0 if ds is None else ds.shape[0]
+                values = epoch.spikes
+                spikes[ii] = np.zeros(0, dtype=np.int64) if values is None else values
+
+        for rows in byfile.values():
+            pck = epochs[rows[0]]._packed
+            numbers = [epochs[ii].number for ii in rows]
+            indices, counts = pck.read_spikes(numbers)
+            lengths[rows] = pck.table["tracelength"][[pck.rows[number] for number in numbers]]
+            for ii, values in zip(rows, np.split(indices, np.cumsum(counts)[:-1])):
+                spikes[ii] = values
+
+        counts = np.array([len(values) for values in spikes], dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        indices = np.concatenate(spikes) if len(spikes) > 0 else np.zeros(0, dtype=np.int64)
+        return cls(indices, offsets, lengths)
+
+    def counts(self, inc: int = 100, nbins: int = None) -> np.array:
+        """(epochs, nbins) spike counts in bins of inc samples, see psth.bin_spikes"""
+        return psth.bin_spikes(self.indices, self.offsets, self.lengths, inc, nbins)
+
+    def psths(self, baseline: np.array, params: psth.PsthParams = psth.DEFAULT_PARAMS, nbins: int = None) -> np.array:
+        """(epochs, nbins) PSTHs with baseline windows in samples, see psth.psths"""
+        return psth.psths(self.indices, self.offsets, self.lengths, baseline, params, nbins)
+
+
+def _default_budget() -> int:
+    return int(float(os.environ.get(BUDGET_ENV, 16)) * 1024 ** 2)
+
+
+# PSTHS OF EACH (EPOCH, PARAMETERS) FOR EVERY BLOCK, SO SWITCHING BACK TO A RESOLUTION IS A LOOKUP
+CACHE = tracecache.TraceCache(_default_budget())
+
+
+def epoch_psths(epochs: Sequence, params: psth.PsthParams = psth.DEFAULT_PARAMS) -> List[np.array]:
+    """Read only PSTH of each epoch, one bin per inc samples of its trace.
+
+    Memoized per epoch and parameters. Epochs not yet computed are read and binned together.
+    """
+    keys = [(epoch._filekey, epoch.number, params) for epoch in epochs]
+    out = [CACHE.get(key) for key in keys]
+    missing = [ii for ii, values in enumerate(out) if values is None]
+    if len(missing) == 0:
+        return out
+
+    trains = SpikeTrains.from_epochs([epochs[ii] for ii in missing])
+    values = trains.psths([epochs[ii].stimtime for ii in missing], params)
+    rowbins = psth.nbins_of(trains.lengths, params.inc)
+    for jj, ii in enumerate(missing):
+        row = values[jj, :rowbins[jj]].copy()
+        CACHE.put(keys[ii], row)
+        out[ii] = row
+    return out
+
+
+def set_budget(nbytes: int) -> None:
+    CACHE.set_budget(nbytes)
+
+
+def clear_cache() -> None:
+    CACHE.clear()
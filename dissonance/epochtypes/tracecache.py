@@ -0,0 +1,85 @@
+"""
+Process wide cache of epoch block trace matrices.
+
+EpochBlock.traces is keyed on the epochs it holds, so every block built over
+the same epochs (repeated plots of a cell, the mean trace, peak amplitude and
+time to peak) shares one matrix. Least recently used matrices are dropped once
+the cache holds more than its byte budget.
+
+The budget is DISSONANCE_TRACE_CACHE_MB megabytes (256 by default) and can be
+changed with set_budget. A budget of 0 turns the cache off.
+"""
+import os
+from collections import OrderedDict
+from threading import Lock
+from typing import Hashable
+
+import numpy as np
+
+BUDGET_ENV = "DISSONANCE_TRACE_CACHE_MB"
+
+
+class TraceCache:
+    """
+    Args:
+        budget (int): Most bytes held at once.
+    """
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.nbytes = 0
+        self._entries: "OrderedDict[Hashable, np.array]" = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> np.array:
+        """Cached matrix, None if missing"""
+        with self._lock:
+            values = self._entries.get(key)
+            if values is not None:
+                self._entries.move_to_end(key)
+            return values
+
+    def put(self, key: Hashable, values: np.array) -> None:
+        """Cache values read only. Matrices larger than the budget aren't kept."""
+        values.setflags(write=False)
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key).nbytes
+            if values.nbytes > self.budget:
+                return
+            self._entries[key] = values
+            self.nbytes += values.nbytes
+            self._evict()
+
+    def _evict(self) -> None:
+        while self.nbytes > self.budget and self._entries:
+            _, values = self._entries.popitem(last=False)
+            self.nbytes -= values.nbytes
+
+    def set_budget(self, budget: int) -> None:
+        with self._lock:
+            self.budget = budget
+            self._evict()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+
+def _default_budget() -> int:
+    return int(float(os.environ.get(BUDGET_ENV, 256)) * 1024 ** 2)
+
+
+CACHE = TraceCache(_default_budget())
+
+
+def set_budget(nbytes: int) -> None:
+    CACHE.set_budget(nbytes)
+
+
+def clear_cache() -> None:
+    CACHE.clear()
@@ -1,12 +1,15 @@
-from typing import List, Tuple
+from typing import Dict, Iterable, List, Tuple, Union
 
 import numpy as np
+import pandas as pd
 from ..funks.psth import calculate_psth
 from ..funks import hill
+from ..funks.wholemetrics import METRIC_COLUMNS, trace_metrics
 import h5py
 from scipy.stats import sem
 
 from .baseepoch import EpochBlock, IEpoch
+from .epochtable import Column, EpochTable
 
 
 def calc_width_at_half_max(values, holdingpotential):
@@ -28,53 +31,49 @@ def calc_width_at_half_max(values, holdingpotential):
     return end-start, (int(start),int(end))
 
 
+def _metrics_row(df: pd.DataFrame, ii: int) -> Dict:
+    # KEEPS TIMES AND WIDTHS AS INTS
+    return {column: df[column].values[ii] for column in METRIC_COLUMNS}
+
+
 class WholeEpoch(IEpoch):
+    __slots__ = ("_metrics",)
+
+    holdingpotential = Column()
+    backgroundval = Column()
 
-    def __init__(self, epochgrp:h5py.Group):
+    def __init__(self, epochgrp: h5py.Group = None, table: EpochTable = None, row: int = 0):
 
-        super().__init__(epochgrp)
-        self.holdingpotential = epochgrp.attrs.get("holdingpotential")
-        self.backgroundval = epochgrp.attrs.get("backgroundval")
-        self._widthathalfmax = None
-        self._timetopeak = None
-        self._peakamplitude = None
-        self._widthrange = None
+        super().__init__(epochgrp, table, row)
+        self._metrics = None
+
+    def _process_trace(self, values: np.array) -> np.array:
+        # SUBTRACT BASELINE BEFORE STIMULUS
+        return values - np.mean(values[:int(self.pretime)])
 
     @property
-    def trace(self):
-        vals = self._response_ds[:] 
-        return vals - np.mean(vals[:int(self.pretime)])
+    def metrics(self) -> Dict:
+        """Peak amplitude, time to peak and width at half max, from one read of the trace"""
+        if self._metrics is None:
+            self._metrics = _metrics_row(trace_metrics(
+                self.trace[None, :], inhibition=self.holdingpotential == "inhibition"), 0)
+        return self._metrics
 
     @property
     def timetopeak(self) -> float:
-        if self._timetopeak is None:
-            if self.holdingpotential == "inhibition":
-                self._timetopeak  = np.argmax(self.trace)
-            else: 
-                self._timetopeak  = np.argmin(self.trace)
-        return self._timetopeak
+        return self.metrics["timetopeak"]
 
     @property
     def widthrange(self) -> float:
-        if self._widthrange is None:
-            # set this property to set range as well
-            self.width_at_half_max
-        return self._widthrange
+        return (self.metrics["widthstart"], self.metrics["widthend"])
 
     @property
     def peakamplitude(self) -> float:
-        if self._peakamplitude is None:
-            if self.holdingpotential == "inhibition":
-                self._peakamplitude  = np.max(self.trace)
-            else: 
-                self._peakamplitude  = np.min(self.trace)
-        return self._peakamplitude
+        return self.metrics["peakamplitude"]
 
     @property
     def width_at_half_max(self) -> float:
-        if self._widthathalfmax is None:
-            self._widthathalfmax, self._widthrange = calc_width_at_half_max(self.trace, self.holdingpotential)
-        return self._widthathalfmax
+        return self.metrics["width_at_half_max"]
 
     @property
     def type(self) -> str:
@@ -88,42 +87,88 @@ class WholeEpochs(EpochBlock):
         super().__init__(epochs)
         self.holdingpotential = epochs[0].holdingpotential
         self.backgroundval = epochs[0].backgroundval
-        self._widthathalfmax = None
-        self._widthrange = None
+        self._metrics = None
+
+    def append(self, epoch) -> None:
+        super().append(epoch)
+        self._metrics = None
 
     @property
     def trace(self) -> float:
         return np.mean(self.traces, axis=0)
 
+    @property
+    def metrics(self) -> Dict:
+        """Peak amplitude, time to peak and width at half max of the mean trace"""
+        if self._metrics is None:
+            self._metrics = _metrics_row(trace_metrics(
+                self.trace[None, :], inhibition=self.holdingpotential == "inhibition"), 0)
+        return self._metrics
+
+    def epoch_metrics(self) -> pd.DataFrame:
+        """Metrics of every epoch, computed together on the trace matrix"""
+        lengths = self.get("pretime") + self.get("stimtime") + self.get("tailtime")
+        return trace_metrics(
+            self.traces,
+            lengths=lengths.astype(int),
+            inhibition=self.get("holdingpotential") == "inhibition")
+
     @property
     def widthrange(self) -> float:
-        if self._widthrange is None:
-            # set this property to set range as well
-            self.width_at_half_max
-        return self._widthrange
+        return (self.metrics["widthstart"], self.metrics["widthend"])
 
     @property
     def width_at_half_max(self) -> float:
-        if self._widthathalfmax is None:
-            self._widthathalfmax, self._widthrange = calc_width_at_half_max(self.trace, self.holdingpotential)
-        return self._widthathalfmax
+        return self.metrics["width_at_half_max"]
 
     @property 
     def peakamplitude(self) -> float:
-        if self.holdingpotential == "inhibition":
-            self._peakamplitude  = np.max(self.trace)
-        else: 
-            self._peakamplitude  = np.min(self.trace)
-        return self._peakamplitude
+        return self.metrics["peakamplitude"]
 
     @property 
     def timetopeak(self) -> float:
-        if self.holdingpotential == "inhibition":
-            self._timetopeak  = np.argmax(self.trace)
-        else: 
-            self._timetopeak  = np.argmin(self.trace)
-        return self._timetopeak
-
-
-
-           
+        return self.metrics["timetopeak"]
+
+
+def whole_metrics(items: Iterable[Union[WholeEpoch, WholeEpochs]]) -> pd.DataFrame:
+    """Metrics table with a row per epoch or block, computed in one pass over a trace matrix.
+    Epochs are read together as one block, blocks contribute their mean trace. The metrics are
+    also kept on each item so their properties don't recompute."""
+    items = list(items)
+    if len(items) == 0:
+        return pd.DataFrame(columns=METRIC_COLUMNS)
+
+    epochrows = [ii for ii, item in enumerate(items) if isinstance(item, IEpoch)]
+    blockrows = [ii for ii, item in enumerate(items) if not isinstance(item, IEpoch)]
+
+    rows = []
+    if len(epochrows) > 0:
+        block = WholeEpochs([items[ii] for ii in epochrows])
+        lengths = block.get("pretime") + block.get("stimtime") + block.get("tailtime")
+        rows.append((epochrows, block.traces, np.minimum(lengths.astype(int), block.trace_len)))
+    if len(blockrows) > 0:
+        traces = [items[ii].trace for ii in blockrows]
+        lengths = np.array([len(trace) for trace in traces])
+        matrix = np.zeros((len(traces), lengths.max()))
+        for jj, trace in enumerate(traces):
+            matrix[jj, :len(trace)] = trace
+        rows.append((blockrows, matrix, lengths))
+
+    # ONE MATRIX FOR EVERY ITEM, PADDED TO THE LONGEST
+    width = max(matrix.shape[1] for _, matrix, _ in rows)
+    order = np.concatenate([positions for positions, _, _ in rows])
+    traces = np.zeros((len(items), width))
+    lengths = np.zeros(len(items), dtype=int)
+    start = 0
+    for positions, matrix, rowlengths in rows:
+        traces[start:start + len(positions), :matrix.shape[1]] = matrix
+        lengths[start:start + len(positions)] = rowlengths
+        start += len(positions)
+    inhibition = np.array([items[ii].holdingpotential == "inhibition" for ii in order])
+
+    df = trace_metrics(traces, lengths=lengths, inhibition=inhibition)
+    df.index = order
+    df = df.sort_index()
+    for ii, item in enumerate(items):
+        item._metrics = _metrics_row(df, ii)
+    return df
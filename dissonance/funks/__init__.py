@@ -1,3 +1,4 @@
-from .spike_detection import detect_spikes
+from .spike_detection import detect_spikes, filter_trace
 from .hill import HillEquation
-from .weber import WeberEquation
\ No newline at end of file
+from .weber import WeberEquation
+from .psth import PsthParams, calculate_psth
@@ -1,21 +1,157 @@
+"""
+PSTH engine.
+
+Works from spike indices alone: the spike trains of many epochs are given as
+one concatenated index array with per-epoch offsets, binned together with a
+single bincount over (epoch, bin) codes, optionally smoothed with a Gaussian or
+exponential kernel by FFT convolution along each row, then scaled to spikes per
+second with the mean of the bins before the end of the baseline window
+subtracted per row.
+
+Parameters are a frozen PsthParams so they can key memoized results.
+"""
+from dataclasses import dataclass
+from typing import Tuple
+
 import numpy as np
-import matplotlib.pyplot as plt
+from scipy import fft
+
+KERNELS = ("gaussian", "exponential")
+
+
+@dataclass(frozen=True)
+class PsthParams:
+	"""
+	Args:
+		inc (int, optional): Bin width in samples.
+		kernel (str, optional): None, "gaussian" or "exponential" smoothing.
+		width (float, optional): Standard deviation of the gaussian or time constant of the
+			exponential in samples.
+		samplerate (float, optional): Samples per second, for rates in spikes per second.
+	"""
+	inc: int = 100
+	kernel: str = None
+	width: float = 0.0
+	samplerate: float = 10000.0
+
+	def __post_init__(self):
+		if int(self.inc) != self.inc or self.inc <= 0:
+			raise ValueError(f"Bin width must be a positive number of samples, not {self.inc}")
+		if self.kernel is not None and self.kernel not in KERNELS:
+			raise ValueError(f"Kernel must be one of {KERNELS}, not {self.kernel}")
+		if self.kernel is not None and self.width <= 0:
+			raise ValueError(f"{self.kernel} kernel needs a positive width")
+
+	@property
+	def scale(self) -> float:
+		"""Counts per bin to spikes per second"""
+		return self.samplerate / self.inc
+
+
+DEFAULT_PARAMS = PsthParams()
+
+
+def nbins_of(lengths: np.array, inc: int) -> np.array:
+	"""Bins covering each trace length, the last bin may be partial"""
+	return -(-np.asarray(lengths, dtype=np.int64) // inc)
+
+
+def bin_spikes(indices: np.array, offsets: np.array, lengths: np.array, inc: int = 100, nbins: int = None) -> np.array:
+	"""(epochs, nbins) spike counts in bins of inc samples.
+
+	A spike is counted once per index and only if it falls inside its epoch's trace.
+
+	Args:
+		indices (np.array): Spike indices of every epoch, concatenated.
+		offsets (np.array): n + 1 offsets of each epoch's spikes in indices.
+		lengths (np.array): Trace length of each epoch in samples.
+		inc (int, optional): Bin width in samples.
+		nbins (int, optional): Bins per row. Defaults to enough for the longest trace.
+	"""
+	indices = np.asarray(indices, dtype=np.int64)
+	lengths = np.asarray(lengths, dtype=np.int64)
+	n = len(lengths)
+	if nbins is None:
+		nbins = int(nbins_of(lengths, inc).max()) if n > 0 else 0
+
+	rows = np.repeat(np.arange(n), np.diff(offsets))
+	keep = (indices >= 0) & (indices < lengths[rows])
+	rows, indices = rows[keep], indices[keep]
+
+	# REPEATED SPIKE INDICES OF AN EPOCH COUNT ONCE
+	width = int(lengths.max()) if n > 0 else 0
+	codes = rows * width + indices
+	if np.any(np.diff(codes) <= 0):
+		codes = np.unique(codes)
+		rows, indices = codes // width, codes % width
+
+	bins = indices // inc
+	keep = bins < nbins
+	counts = np.bincount(rows[keep] * nbins + bins[keep], minlength=n * nbins)
+	return counts.reshape(n, nbins).astype(float)
+
+
+def kernel(params: PsthParams) -> Tuple[np.array, int]:
+	"""Smoothing kernel sampled at bin resolution, summing to 1, and the bin of its zero lag"""
+	width = params.width / params.inc
+	if params.kernel == "gaussian":
+		# CENTERED, CUT AT 4 STANDARD DEVIATIONS
+		half = max(int(np.ceil(4 * width)), 1)
+		taps = np.exp(-0.5 * (np.arange(-half, half + 1) / width) ** 2)
+		center = half
+	else:
+		# CAUSAL, CUT AT 5 TIME CONSTANTS
+		taps = np.exp(-np.arange(max(int(np.ceil(5 * width)), 1) + 1) / width)
+		center = 0
+	return taps / taps.sum(), center
+
+
+def smooth(counts: np.array, params: PsthParams) -> np.array:
+	"""Convolve every row with the params kernel by FFT. Rows are zero padded so nothing wraps around."""
+	if params.kernel is None or counts.size == 0:
+		return counts
+	taps, center = kernel(params)
+	nbins = counts.shape[1]
+	n = fft.next_fast_len(nbins + len(taps) - 1)
+	full = fft.irfft(fft.rfft(counts, n, axis=1) * fft.rfft(taps, n), n, axis=1)
+	return full[:, center:center + nbins]
+
+
+def psths(
+		indices: np.array, offsets: np.array, lengths: np.array, baseline: np.array,
+		params: PsthParams = DEFAULT_PARAMS, nbins: int = None) -> np.array:
+	"""(epochs, nbins) PSTHs of ragged spike trains.
+
+	Rates are in spikes per second with the mean of the first baseline // inc bins subtracted per row,
+	NaN if that window has no bins. Bins past the end of an epoch's trace are 0.
+
+	Args:
+		indices (np.array): Spike indices of every epoch, concatenated.
+		offsets (np.array): n + 1 offsets of each epoch's spikes in indices.
+		lengths (np.array): Trace length of each epoch in samples.
+		baseline (np.array): Baseline window of each epoch in samples.
+		params (PsthParams, optional): Bin width and smoothing.
+		nbins (int, optional): Bins per row. Defaults to enough for the longest trace.
+	"""
+	values = smooth(bin_spikes(indices, offsets, lengths, params.inc, nbins), params)
+	n, nbins = values.shape
+	rowbins = np.minimum(nbins_of(lengths, params.inc), nbins)
+
+	# BASELINE FROM THE CUMULATIVE VALUES
+	nbase = np.minimum(np.asarray(baseline, dtype=float) // params.inc, rowbins).astype(np.int64)
+	cumulative = np.cumsum(values, axis=1)
+	total = cumulative[np.arange(n), np.maximum(nbase - 1, 0)] if nbins > 0 else np.zeros(n)
+	means = np.full(n, np.nan)
+	np.divide(total, nbase, out=means, where=nbase > 0)
+
+	values = params.scale * (values - means[:, None])
+	values[np.arange(nbins)[None, :] >= rowbins[:, None]] = 0.0
+	return values
+
 
 def calculate_psth(epoch, inc=100, outputfile=None) -> np.array:
 	"""Bin and count number of spikes. Subtract baseline firing rate from final psth."""
-	#inc = 100 # 10 ms
-	try:
-		x = np.zeros(epoch.traces.shape)
-	except:
-		x = np.zeros(epoch.trace.shape)
-
-	x[epoch.spikes] = 1
-	psth = np.fromiter(
-		[
-			np.sum(x[ii:ii+inc])
-			for ii in range(0, epoch.trace.shape[0], inc)
-		], dtype=float)
-
-	# adjust for baseline
-	psth = 100 * (psth - np.mean(psth[:int(epoch.stimtime//100)]))
-	return psth 
+	spikes = np.asarray(epoch.spikes, dtype=np.int64)
+	return psths(
+		spikes, np.array([0, len(spikes)]), np.array([epoch.trace.shape[0]]),
+		[epoch.stimtime], PsthParams(inc=inc))[0]
@@ -23,8 +23,8 @@ REF_PERIOD_POINTS = round(REF_PERIOD / SAMPLE_INTERVAL)
 SEARCH_INTERVAL_POINTS = round(SEARCH_INTERVAL / SAMPLE_INTERVAL)
 
 
-def detect_spikes(R: np.array):
-    # PASS FILTERS
+def filter_trace(R: np.array) -> Tuple[np.array, np.array]:
+    """Pass filters used by detect_spikes. Returns (R_no_spikes, R_high_pass)."""
     R_no_spikes = low_pass_filter(
         high_pass_filter(
             R,
@@ -37,6 +37,12 @@ def detect_spikes(R: np.array):
         R,
         HIGHPASSCUT_SPIKES,
         SAMPLE_INTERVAL)
+    return R_no_spikes, R_high_pass
+
+
+def detect_spikes(R: np.array, filtered: Tuple[np.array, np.array] = None):
+    # PASS FILTERS - FILTERED CAN BE PASSED IN TO TIME THE FILTERS SEPARATELY
+    R_no_spikes, R_high_pass = filter_trace(R) if filtered is None else filtered
 
     # GET TRACE AND NOISE_STD
     trace = R_high_pass.copy()
@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+
+METRIC_COLUMNS = ["peakamplitude", "timetopeak", "width_at_half_max", "widthstart", "widthend"]
+
+
+def _first(cond: np.array) -> np.array:
+	"""Index of the first True in each row and whether there was one"""
+	return np.argmax(cond, axis=1), cond.any(axis=1)
+
+
+def _last(cond: np.array) -> np.array:
+	"""Index of the last True in each row and whether there was one"""
+	return cond.shape[1] - 1 - np.argmax(cond[:, ::-1], axis=1), cond.any(axis=1)
+
+
+def _chunk_metrics(traces: np.array, lengths: np.array, inhibition: np.array) -> np.array:
+	n, width = traces.shape
+	rows = np.arange(n)
+	idx = np.arange(width)[None, :]
+	valid = idx < lengths[:, None]
+
+	# PEAK IS THE MAX FOR INHIBITION, THE MIN OTHERWISE. PADDING NEVER WINS
+	signed = np.where(inhibition[:, None], traces, -traces)
+	signed[~valid] = -np.inf
+	ttp = np.argmax(signed, axis=1)
+	peak = traces[rows, ttp]
+	halfmax = peak / 2.0
+	negative = halfmax < 0
+
+	after = valid & (idx >= ttp[:, None])
+	# NEGATIVE HALF MAX: NEAREST CROSSINGS ABOVE HALF MAX EITHER SIDE OF THE PEAK
+	# OTHERWISE: CROSSINGS BELOW HALF MAX, THE START COUNTED BACK FROM THE END OF THE TRACE
+	above = traces > halfmax[:, None]
+	below = traces < halfmax[:, None]
+
+	last, found = _last(above & (idx <= ttp[:, None]))
+	startneg = np.where(found, last, ttp)
+	last, found = _last(below & valid & (idx > ttp[:, None]))
+	startpos = ttp - np.where(found, lengths - 1 - last, 0)
+
+	first, found = _first(np.where(negative[:, None], above, below) & after)
+	end = ttp + np.where(found, first - ttp, 0)
+	start = np.where(negative, startneg, startpos)
+
+	return np.column_stack([peak, ttp, end - start, start, end])
+
+
+def trace_metrics(traces: np.array, lengths: np.array = None, inhibition: np.array = False, chunksize: int = 256) -> pd.DataFrame:
+	"""Peak amplitude, time to peak and width at half max of every row of a trace matrix.
+
+	Matches calc_width_at_half_max row by row. Rows are processed in chunks to bound memory.
+
+	Args:
+		traces (np.array): (n, samples) baseline subtracted traces, padded at the end.
+		lengths (np.array, optional): Samples of each row that are data. Defaults to the full width.
+		inhibition (np.array, optional): Per row (or one for all) True if the holding potential is
+			"inhibition", so the peak is the maximum instead of the minimum.
+		chunksize (int, optional): Rows computed at once.
+
+	Returns:
+		pd.DataFrame: peakamplitude, timetopeak, width_at_half_max, widthstart and widthend per row.
+	"""
+	traces = np.asarray(traces, dtype=float)
+	n, width = traces.shape
+	lengths = np.full(n, width) if lengths is None else np.minimum(np.asarray(lengths, dtype=int), width)
+	inhibition = np.broadcast_to(np.asarray(inhibition, dtype=bool), (n,))
+
+	out = np.zeros((n, len(METRIC_COLUMNS)))
+	for start in range(0, n, chunksize):
+		stop = min(start + chunksize, n)
+		out[start:stop] = _chunk_metrics(traces[start:stop], lengths[start:stop], inhibition[start:stop])
+
+	df = pd.DataFrame(out, columns=METRIC_COLUMNS)
+	for column in METRIC_COLUMNS[1:]:
+		df[column] = df[column].astype(int)
+	return df
@@ -1,3 +1,8 @@
 from .symphonyreader import SymphonyReader
 from .dissonancereader import DissonanceReader, DissonanceUpdater
-from .ns_io import add_attributes, add_genotype, read_unchecked_file
\ No newline at end of file
+from .ns_io import add_attributes, add_genotype, read_unchecked_file
+from .batch import BatchConverter, ConversionManifest
+from .layout import StorageLayout, repack, benchmark_layouts
+from .rstarr import RstarrCalibration, get_calibration
+from .filters import Equal, NotEqual, In, Range, IsNull, NotNull
+from .archive import Archive, build_archive
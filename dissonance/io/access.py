@@ -0,0 +1,40 @@
+"""
+Read only and writable access to h5 files.
+
+Reading goes through open_readonly, which keeps HDF5's shared read lock by
+default so a reader never sees a file half way through an edit. Callers that
+read from a share without lock support can opt out with locking=False.
+Edits go through a short writable session that is closed as soon as the
+edit is done.
+"""
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+import h5py
+
+
+def open_readonly(path: Path, locking: bool = True) -> h5py.File:
+    """Read only handle.
+
+    Args:
+        locking (bool, optional): Skip HDF5 file locking when False, for shares that don't support
+            it. Every handle on a file in one process must use the same setting. Ignored on
+            h5py < 3.5. Defaults to True.
+    """
+    if locking:
+        return h5py.File(str(path), "r")
+    try:
+        return h5py.File(str(path), "r", locking=False)
+    except TypeError:
+        return h5py.File(str(path), "r")
+
+
+@contextmanager
+def writable(path: Path) -> Iterator[h5py.File]:
+    """Writable handle for the duration of an edit. Flushed and closed on exit."""
+    f = h5py.File(str(path), "r+")
+    try:
+        yield f
+    finally:
+        f.close()
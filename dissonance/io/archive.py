@@ -0,0 +1,377 @@
+"""
+Archive view over many dissonance files.
+
+An archive is a small h5 file that presents a set of day files as one:
+
+    files        path, size and mtime of every day file
+    epochindex   epoch index of every file stacked, with fileid and exppath columns
+                 and each epoch's offset and length in traces and spikes
+    experiments  external link per file to its experiment group
+    traces       virtual dataset of every trace end to end
+    spikes       virtual dataset of every spike train end to end
+
+Opening the archive is one file open and one index read. Day files are only
+opened when an epoch group is looked up through its link; traces read through
+the virtual datasets are read straight from the day files. Paths are stored
+relative to the archive so the archive moves with the data.
+
+    python -m dissonance.io.archive MappedData/WT MappedData/DR --output MappedData/archive.h5
+    python -m dissonance.io.archive --refresh MappedData/archive.h5
+"""
+import argparse
+import os
+import shutil
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterator, List, Tuple
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from . import epochindex, packed
+from .access import open_readonly
+from .dissonancereader import DissonanceReader
+from .filters import filter_mask
+
+FILES_NAME = "files"
+EXPERIMENTS_NAME = "experiments"
+TRACES_NAME = "traces"
+SPIKES_NAME = "spikes"
+
+FILES_DTYPE = np.dtype([
+    ("exppath", epochindex.STR_DTYPE),
+    ("path", epochindex.STR_DTYPE),
+    ("size", np.int64),
+    ("mtime", np.int64)])
+
+# DAY FILES KEPT OPEN AT ONCE, THE LEAST RECENTLY USED IS CLOSED BEYOND THIS
+MAX_OPEN = 32
+
+# INDEX COLUMNS ADDED BY THE ARCHIVE
+LOCATION_COLUMNS = ("fileid", "traceoffset", "tracelength", "spikeoffset", "spikelength")
+
+
+def _decode(val) -> str:
+    return val.decode() if isinstance(val, bytes) else val
+
+
+def _linkname(fileid: int) -> str:
+    return f"{EXPERIMENTS_NAME}/file{fileid}"
+
+
+def _relpath(filepath: Path, archivepath: Path) -> str:
+    return os.path.relpath(Path(filepath).resolve(), Path(archivepath).resolve().parent)
+
+
+def _file_record(filepath: Path, relpath: str) -> Tuple:
+    stat = Path(filepath).stat()
+    return (str(filepath), relpath, stat.st_size, stat.st_mtime_ns)
+
+
+def _frame_to_index(df: pd.DataFrame) -> np.array:
+    """Structured array in the epoch index conventions, see epochindex.column_dtype. Location
+    columns are int64."""
+    dtypes = []
+    for column in df.columns:
+        if column == "number" or column in LOCATION_COLUMNS:
+            dtypes.append((column, np.dtype(np.int64)))
+        else:
+            dtypes.append((column, epochindex.column_dtype(list(df[column].values))))
+
+    index = np.empty(df.shape[0], dtype=dtypes)
+    for column, dtype in dtypes:
+        index[column] = epochindex.column_values(list(df[column].values), dtype)
+    return index
+
+
+def _file_index(h5file: h5py.File) -> pd.DataFrame:
+    index = epochindex.read_index(h5file)
+    if index is None:
+        index = epochindex.index_to_frame(epochindex.build_index(h5file["experiment"]))
+    return index
+
+
+def _sources(h5file: h5py.File, relpath: str, numbers: np.array) -> Tuple[np.array, List, List]:
+    """Per epoch trace and spike offsets and lengths within the file's own sources, and the
+    virtual sources with their offsets."""
+    locations = np.zeros((len(numbers), 4), dtype=np.int64)
+    tracesources, spikesources = [], []
+    pck = packed.read_packed(h5file)
+    experiment = h5file["experiment"]
+
+    if pck is not None:
+        rows = pck.table[[pck.rows[number] for number in numbers]]
+        locations[:, 0] = rows["traceoffset"]
+        locations[:, 1] = rows["tracelength"]
+        locations[:, 2] = rows["spikeoffset"]
+        locations[:, 3] = rows["spikelength"]
+        tracesources.append((0, h5py.VirtualSource(relpath, pck._traces.name, shape=pck._traces.shape, dtype=pck._traces.dtype)))
+        spikesources.append((0, h5py.VirtualSource(relpath, pck._spikes.name, shape=pck._spikes.shape, dtype=pck._spikes.dtype)))
+        return locations, tracesources, spikesources
+
+    traceoffset, spikeoffset = 0, 0
+    for ii, number in enumerate(numbers):
+        epochgrp = experiment[f"epoch{number}"]
+        trace = epochgrp.get("Amp1")
+        spikes = epochgrp.get("Spikes")
+        ntrace = 0 if trace is None else trace.shape[0]
+        nspikes = -1 if spikes is None else spikes.shape[0]
+        locations[ii] = (traceoffset, ntrace, spikeoffset, nspikes)
+        if ntrace > 0:
+            tracesources.append((traceoffset, h5py.VirtualSource(relpath, trace.name, shape=trace.shape, dtype=trace.dtype)))
+            traceoffset += ntrace
+        if nspikes > 0:
+            spikesources.append((spikeoffset, h5py.VirtualSource(relpath, spikes.name, shape=spikes.shape, dtype=spikes.dtype)))
+            spikeoffset += nspikes
+    return locations, tracesources, spikesources
+
+
+def _write_index(h5file: h5py.File, files: np.array, frame: pd.DataFrame) -> None:
+    h5file.create_dataset(FILES_NAME, data=files)
+    ds = h5file.create_dataset(epochindex.INDEX_NAME, data=_frame_to_index(frame))
+    ds.attrs["nepochs"] = frame.shape[0]
+
+
+def _virtual_dataset(h5file: h5py.File, name: str, sources: List[Tuple[int, h5py.VirtualSource]], n: int) -> None:
+    # A TYPE EVERY SOURCE CONVERTS TO, FLOAT64 IF THERE ARE NONE
+    dtype = np.result_type(*[source.dtype for _, source in sources]) if len(sources) > 0 else np.float64
+    layout = h5py.VirtualLayout(shape=(n,), dtype=dtype)
+    for offset, source in sources:
+        layout[offset:offset + source.shape[0]] = source
+    h5file.create_virtual_dataset(name, layout, fillvalue=0.0)
+
+
+def build_archive(filepaths: List[Path], archivepath: Path) -> Path:
+    """Write an archive over filepaths, replacing any existing archive at archivepath.
+
+    Args:
+        filepaths (List[Path]): Dissonance files.
+        archivepath (Path): Archive file to write.
+
+    Returns:
+        Path: archivepath
+    """
+    archivepath = Path(archivepath)
+    frames, files = [], []
+    tracesources, spikesources = [], []
+    traceoffset, spikeoffset = 0, 0
+
+    for fileid, filepath in enumerate(filepaths):
+        relpath = _relpath(filepath, archivepath)
+        with open_readonly(filepath) as f:
+            index = _file_index(f)
+            locations, traces, spikes = _sources(f, relpath, index["number"].values)
+        files.append(_file_record(filepath, relpath))
+
+        # SHIFT FILE OFFSETS TO ARCHIVE OFFSETS
+        index["fileid"] = fileid
+        index["exppath"] = str(filepath)
+        index["traceoffset"] = locations[:, 0] + traceoffset
+        index["tracelength"] = locations[:, 1]
+        index["spikeoffset"] = locations[:, 2] + spikeoffset
+        index["spikelength"] = locations[:, 3]
+        frames.append(index)
+
+        tracesources.extend((offset + traceoffset, source) for offset, source in traces)
+        spikesources.extend((offset + spikeoffset, source) for offset, source in spikes)
+        traceoffset += sum(source.shape[0] for _, source in traces)
+        spikeoffset += sum(source.shape[0] for _, source in spikes)
+
+    frame = pd.concat(frames, ignore_index=True) if len(frames) > 0 else pd.DataFrame(columns=["number", *LOCATION_COLUMNS])
+    # WRITE ALONGSIDE AND SWAP IN, OPEN ARCHIVES KEEP READING THE OLD ONE
+    tmppath = archivepath.with_name(f"{archivepath.name}.{os.getpid()}.tmp")
+    with h5py.File(str(tmppath), "w") as f:
+        _write_index(f, np.array(files, dtype=FILES_DTYPE), frame)
+        grp = f.create_group(EXPERIMENTS_NAME)
+        for fileid, (_, relpath, _, _) in enumerate(files):
+            grp[f"file{fileid}"] = h5py.ExternalLink(relpath, "/experiment")
+        _virtual_dataset(f, TRACES_NAME, tracesources, traceoffset)
+        _virtual_dataset(f, SPIKES_NAME, spikesources, spikeoffset)
+    os.replace(tmppath, archivepath)
+    return archivepath
+
+
+class Archive:
+    """Read only view of an archive. Also a mapping of exppath to experiment group, so it can
+    stand in for EpochIO.files.
+
+    Epochs are read from their day files, so those are opened through the links. At most
+    maxopen of them are kept open, the least recently used is closed beyond that.
+
+    Args:
+        archivepath (Path): Archive written by build_archive.
+        maxopen (int, optional): Day files kept open at once.
+    """
+
+    def __init__(self, archivepath: Path, maxopen: int = MAX_OPEN):
+        self.archivepath = Path(archivepath)
+        self.file = open_readonly(self.archivepath)
+        self.files = self.file[FILES_NAME][:]
+        self.index = epochindex.index_to_frame(self.file[epochindex.INDEX_NAME][:])
+
+        self.exppaths = [_decode(exppath) for exppath in self.files["exppath"]]
+        self._fileids = {exppath: fileid for fileid, exppath in enumerate(self.exppaths)}
+        self._rows = {
+            (int(fileid), int(number)): ii
+            for ii, (fileid, number) in enumerate(zip(self.index["fileid"].values, self.index["number"].values))}
+        self.maxopen = maxopen
+        self._experiments: Dict[str, h5py.Group] = OrderedDict()
+        self._edited = False
+
+    def close(self) -> None:
+        self._experiments.clear()
+        if self.file:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, exppath: Path) -> bool:
+        return str(exppath) in self._fileids
+
+    def __getitem__(self, exppath: Path) -> h5py.Group:
+        """Experiment group of a day file, opened through its external link on first use"""
+        key = str(exppath)
+        experiment = self._experiments.get(key)
+        if experiment is not None and experiment.id.valid:
+            self._experiments.move_to_end(key)
+            return experiment
+
+        experiment = self.file[_linkname(self._fileids[key])]
+        self._experiments[key] = experiment
+        # EPOCHS OF A CLOSED FILE REOPEN IT THROUGH HERE WHEN NEXT READ
+        while len(self._experiments) > self.maxopen:
+            self.forget(next(iter(self._experiments)))
+        return experiment
+
+    def __iter__(self) -> Iterator[str]:
+        yield from self.exppaths
+
+    def __len__(self):
+        return len(self.exppaths)
+
+    def values(self) -> Iterator[h5py.Group]:
+        """Experiment groups opened so far"""
+        return iter(list(self._experiments.values()))
+
+    def filepath(self, exppath: Path) -> Path:
+        """Location of a day file, resolved relative to the archive"""
+        relpath = _decode(self.files["path"][self._fileids[str(exppath)]])
+        return self.archivepath.resolve().parent / relpath
+
+    def forget(self, exppath: Path) -> None:
+        """Drop the cached experiment group of a file, closing the day file if nothing else uses it"""
+        experiment = self._experiments.pop(str(exppath), None)
+        if experiment is not None and experiment.id.valid:
+            experiment.file.close()
+
+    def to_params(self, paramnames: List[str], filters: Dict = None) -> pd.DataFrame:
+        """Params table in the form of DissonanceReader.to_params, from the archive index alone"""
+        mask = filter_mask(self.index, filters, self.index.shape[0])
+        df = DissonanceReader._index_to_paramstable(self.index, paramnames, filters)
+        df["startdate"] = pd.to_datetime(df["startdate"])
+        df["exppath"] = [Path(exppath) for exppath in self.index["exppath"].values[mask]]
+        return df
+
+    def set(self, exppath: Path, numbers: List[int], paramname: str, value) -> None:
+        """Set paramname of epochs of a day file in the index, once the day file itself has been
+        edited. The file's size and mtime are taken again so it doesn't read as stale. Kept in
+        memory until flush."""
+        fileid = self._fileids[str(exppath)]
+        rows = [self._rows[(fileid, int(number))] for number in numbers]
+        if paramname not in self.index.columns:
+            self.index[paramname] = pd.Series([None] * self.index.shape[0], dtype=object)
+        elif self.index[paramname].dtype != object and not epochindex._is_number(value):
+            self.index[paramname] = self.index[paramname].astype(object)
+        self.index.loc[rows, paramname] = value
+        record = self.files[fileid]
+        self.files[fileid] = (record["exppath"], record["path"], *_file_record(self.filepath(exppath), record["path"])[2:])
+        self._edited = True
+
+    def flush(self) -> None:
+        """Write index and file records changed by set back to the archive"""
+        if not self._edited:
+            return
+        # WRITE ALONGSIDE AND SWAP IN AS IN BUILD_ARCHIVE, THE LINKS AND VIRTUAL DATASETS ARE COPIED AS IS
+        tmppath = self.archivepath.with_name(f"{self.archivepath.name}.{os.getpid()}.tmp")
+        shutil.copyfile(self.archivepath, tmppath)
+        with h5py.File(str(tmppath), "r+") as f:
+            del f[FILES_NAME]
+            del f[epochindex.INDEX_NAME]
+            _write_index(f, self.files, self.index)
+        os.replace(tmppath, self.archivepath)
+        self._edited = False
+
+    def _row(self, exppath: Path, number: int) -> pd.Series:
+        return self.index.iloc[self._rows[(self._fileids[str(exppath)], int(number))]]
+
+    def trace(self, exppath: Path, number: int) -> np.array:
+        row = self._row(exppath, number)
+        start = row["traceoffset"]
+        return self.file[TRACES_NAME][start:start + row["tracelength"]]
+
+    def spikes(self, exppath: Path, number: int) -> np.array:
+        row = self._row(exppath, number)
+        if row["spikelength"] < 0:
+            return None
+        start = row["spikeoffset"]
+        return self.file[SPIKES_NAME][start:start + row["spikelength"]]
+
+    def stale(self) -> List[Path]:
+        """Day files changed or missing since the archive was built"""
+        root = self.archivepath.resolve().parent
+        changed = []
+        for exppath, relpath, size, mtime in self.files:
+            filepath = root / _decode(relpath)
+            if not filepath.exists() or _file_record(filepath, relpath)[2:] != (size, mtime):
+                changed.append(Path(_decode(exppath)))
+        return changed
+
+
+def refresh_archive(archivepath: Path) -> List[Path]:
+    """Rebuild an archive if any of its day files changed. Returns the changed files.
+
+    Raises:
+        FileNotFoundError: A day file is missing. Build a new archive without it instead.
+    """
+    with Archive(archivepath) as archive:
+        changed = archive.stale()
+        # RESOLVED AGAINST THE ARCHIVE, NOT THE WORKING DIRECTORY
+        filepaths = [archive.filepath(exppath) for exppath in archive.exppaths]
+    missing = [filepath for filepath in filepaths if not filepath.exists()]
+    if len(missing) > 0:
+        raise FileNotFoundError(f"{archivepath}: {len(missing)} day files are missing: {', '.join(map(str, missing))}")
+    if len(changed) > 0:
+        build_archive(filepaths, archivepath)
+    return changed
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Build an archive view over dissonance files.")
+    parser.add_argument("paths", type=Path, nargs="+", help="Dissonance files or directories of them, or the archive with --refresh.")
+    parser.add_argument("--output", type=Path, default=None, help="Archive file to write.")
+    parser.add_argument("--refresh", action="store_true", help="Rebuild an existing archive if its files changed.")
+    ns = parser.parse_args(args)
+
+    if ns.refresh:
+        for archivepath in ns.paths:
+            changed = refresh_archive(archivepath)
+            print(f"{archivepath}: {len(changed)} changed files")
+        return
+
+    if ns.output is None:
+        parser.error("--output is required")
+    filepaths = []
+    for path in ns.paths:
+        filepaths.extend(sorted(path.glob("*.h5")) if path.is_dir() else [path])
+    filepaths = [filepath for filepath in filepaths if filepath.resolve() != ns.output.resolve()]
+    build_archive(filepaths, ns.output)
+    print(f"{ns.output}: {len(filepaths)} files")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+"""
+Batch conversion of Symphony directory trees into dissonance files.
+
+Files are fanned out over a process pool. A JSON manifest of finished
+conversions, keyed on the input path, size and mtime and the conversion
+options, lets reruns skip files that are already done.
+
+    python -m dissonance.io.batch EPhysData MappedData --nprocesses 6 --timings timings.jsonl
+"""
+import argparse
+import json
+import logging
+import multiprocessing as mp
+import os
+import time
+from dataclasses import asdict, dataclass
+from functools import partial
+from pathlib import Path
+from typing import Dict, Iterator, List, Tuple
+
+from .layout import add_layout_arguments, layout_from_args
+from .symphonyreader import SymphonyReader
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ConversionResult:
+    inputpath: Path
+    outputpath: Path
+    seconds: float = 0.0
+    nbytes: int = 0
+    error: str = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    @property
+    def mbps(self) -> float:
+        """Megabytes of raw Symphony data converted per second"""
+        if self.seconds == 0.0:
+            return 0.0
+        return self.nbytes / 1e6 / self.seconds
+
+
+def convert_file(inputpath: Path, outputpath: Path, timings: Path = None, **kwargs) -> ConversionResult:
+    """Convert a single Symphony file. Errors are returned, not raised, so one bad file doesn't stop a batch.
+
+    Output is written to a temporary file and moved into place once complete. In append mode
+    new epochs are added to the existing output file in place. Stage timings are appended to timings if given.
+    """
+    result = ConversionResult(inputpath, outputpath, nbytes=inputpath.stat().st_size)
+    if kwargs.get("append", False) and outputpath.exists():
+        partpath = outputpath
+    else:
+        partpath = outputpath.with_name(outputpath.name + ".part")
+    start = time.perf_counter()
+    try:
+        outputpath.parent.mkdir(parents=True, exist_ok=True)
+        sr = SymphonyReader(inputpath, timings=timings)
+        try:
+            sr.to_h5(partpath, **kwargs)
+        finally:
+            sr.fin.close()
+        if partpath != outputpath:
+            os.replace(partpath, outputpath)
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+        if partpath != outputpath and partpath.exists():
+            partpath.unlink()
+    result.seconds = time.perf_counter() - start
+    return result
+
+
+class ConversionManifest:
+    """Record of completed conversions stored as json next to the output files."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.entries: Dict[str, Dict] = dict()
+        if self.path.exists():
+            with open(self.path, "r") as fin:
+                self.entries = json.load(fin)
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def fingerprint(inputpath: Path) -> Dict:
+        stat = inputpath.stat()
+        return dict(size=stat.st_size, mtime=stat.st_mtime)
+
+    @staticmethod
+    def options_record(options: Dict = None) -> Dict:
+        """Conversion options as stored in the manifest, layouts by their description"""
+        options = dict() if options is None else options
+        return {key: str(val) for key, val in sorted(options.items())}
+
+    def is_done(self, inputpath: Path, outputpath: Path, options: Dict = None) -> bool:
+        """Whether inputpath was converted to outputpath with the same options and hasn't changed since"""
+        entry = self.entries.get(str(inputpath))
+        if entry is None or not outputpath.exists():
+            return False
+        fingerprint = self.fingerprint(inputpath)
+        return (
+            entry["size"] == fingerprint["size"]
+            and entry["mtime"] == fingerprint["mtime"]
+            and entry["outputpath"] == str(outputpath)
+            and entry.get("options") == self.options_record(options))
+
+    def mark_done(self, result: ConversionResult, options: Dict = None) -> None:
+        entry = self.fingerprint(result.inputpath)
+        entry["outputpath"] = str(result.outputpath)
+        entry["options"] = self.options_record(options)
+        entry["seconds"] = result.seconds
+        self.entries[str(result.inputpath)] = entry
+
+    def save(self) -> None:
+        # WRITE TO TEMP FILE FIRST SO AN INTERRUPTED SAVE DOESN'T LOSE THE MANIFEST
+        tmppath = self.path.with_name(self.path.name + ".tmp")
+        with open(tmppath, "w") as fout:
+            json.dump(self.entries, fout, indent=1)
+        os.replace(tmppath, self.path)
+
+
+class BatchConverter:
+    """Convert every Symphony file under rootdir, mirroring the folder layout in outputdir.
+
+    Args:
+        rootdir (Path): Directory of raw Symphony files. Subfolders (genotypes) are searched.
+        outputdir (Path): Directory for converted dissonance files.
+        nprocesses (int, optional): Size of the process pool. Defaults to 6.
+        manifestpath (Path, optional): Defaults to outputdir / "manifest.json".
+        exclude (List[str], optional): File names to skip.
+        timings (Path, optional): JSON lines file for per stage timings, see dissonance.io.timing.
+    """
+
+    def __init__(self, rootdir: Path, outputdir: Path, nprocesses: int = 6, manifestpath: Path = None, exclude: List[str] = None, timings: Path = None):
+        self.rootdir = Path(rootdir)
+        self.timings = timings
+        self.outputdir = Path(outputdir)
+        self.nprocesses = nprocesses
+        self.exclude = set() if exclude is None else set(exclude)
+        self.manifest = ConversionManifest(
+            self.outputdir / "manifest.json" if manifestpath is None else manifestpath)
+
+    def files(self) -> Iterator[Tuple[Path, Path]]:
+        for inputpath in sorted(self.rootdir.rglob("*.h5")):
+            if inputpath.name in self.exclude:
+                continue
+            yield inputpath, self.outputdir / inputpath.relative_to(self.rootdir)
+
+    def pending(self, options: Dict = None) -> List[Tuple[Path, Path]]:
+        """Files not yet converted with options, the keyword arguments of run"""
+        return [
+            (inputpath, outputpath)
+            for inputpath, outputpath in self.files()
+            if not self.manifest.is_done(inputpath, outputpath, options)]
+
+    def run(self, **kwargs) -> List[ConversionResult]:
+        """Convert pending files. Keyword arguments are passed through to SymphonyReader.to_h5."""
+        self.outputdir.mkdir(parents=True, exist_ok=True)
+        todo = self.pending(kwargs)
+        logger.info(f"Converting {len(todo)} files ({len(self.manifest)} already done).")
+
+        results = []
+        start = time.perf_counter()
+        for ii, result in enumerate(self._map(todo, kwargs)):
+            results.append(result)
+            if result.ok:
+                # SAVE AFTER EVERY FILE SO AN INTERRUPTED RUN CAN RESUME
+                self.manifest.mark_done(result, kwargs)
+                self.manifest.save()
+                logger.info(
+                    f"{ii+1}/{len(todo)} {result.inputpath.name}: {result.seconds:0.1f}s, {result.mbps:0.2f} MB/s")
+            else:
+                logger.error(f"{ii+1}/{len(todo)} FILEFAILED {result.inputpath}: {result.error}")
+
+        seconds = time.perf_counter() - start
+        nbytes = sum(result.nbytes for result in results if result.ok)
+        logger.info(
+            f"Converted {sum(result.ok for result in results)}/{len(results)} files, "
+            f"{nbytes/1e6:0.1f} MB in {seconds:0.1f}s ({nbytes/1e6/max(seconds, 1e-9):0.2f} MB/s)")
+        return results
+
+    def _map(self, todo: List[Tuple[Path, Path]], kwargs: Dict) -> Iterator[ConversionResult]:
+        if self.nprocesses == 1:
+            for inputpath, outputpath in todo:
+                yield convert_file(inputpath, outputpath, self.timings, **kwargs)
+        else:
+            func = partial(_convert_pair, timings=self.timings, kwargs=kwargs)
+            with mp.Pool(processes=self.nprocesses) as p:
+                yield from p.imap_unordered(func, todo)
+
+
+def _convert_pair(paths: Tuple[Path, Path], timings: Path, kwargs: Dict) -> ConversionResult:
+    return convert_file(*paths, timings, **kwargs)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Convert Symphony files to dissonance files.")
+    parser.add_argument("rootdir", type=Path)
+    parser.add_argument("outputdir", type=Path)
+    parser.add_argument("--nprocesses", type=int, default=6)
+    parser.add_argument("--manifest", type=Path, default=None)
+    parser.add_argument("--exclude", nargs="*", default=None)
+    parser.add_argument(
+        "--timings", type=Path, default=None,
+        help="Append per stage timings as JSON lines. Summarise with python -m dissonance.io.timing.")
+    parser.add_argument(
+        "--append", action="store_true",
+        help="Add new epochs to existing output files instead of rewriting them.")
+    parser.add_argument(
+        "--packed", action="store_true",
+        help="Also store each file's traces and spikes in one packed dataset.")
+    add_layout_arguments(parser)
+    ns = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s : %(message)s")
+    converter = BatchConverter(
+        ns.rootdir, ns.outputdir, nprocesses=ns.nprocesses, manifestpath=ns.manifest, exclude=ns.exclude,
+        timings=ns.timings)
+    results = converter.run(append=ns.append, layout=layout_from_args(ns), packtraces=ns.packed)
+    for result in results:
+        if not result.ok:
+            print(json.dumps({key: str(val) for key, val in asdict(result).items()}))
+
+
+if __name__ == "__main__":
+    main()
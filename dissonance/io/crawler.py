@@ -0,0 +1,211 @@
+"""
+Single pass metadata crawl of Symphony files.
+
+One visititems pass over the experiment group collects every epoch's
+protocol parameters, backgrounds, stimuli and response dataset paths. The
+records returned stand in for the Cell, Protocol and Epoch wrappers in
+symphonyreader, so conversion and metadata updates don't re-resolve groups
+or re-read attributes.
+"""
+import datetime
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Tuple
+
+import h5py
+
+# MODULE IMPORT, SYMPHONYREADER IMPORTS THIS MODULE
+from . import symphonyreader as sr
+
+
+def _attrs(obj) -> Dict:
+    return {key: sr.convert_if_bytes(val) for key, val in obj.attrs.items()}
+
+
+def _ticks_to_date(ticks) -> datetime.datetime:
+    return datetime.datetime(1, 1, 1) + datetime.timedelta(microseconds=int(ticks // 10))
+
+
+@dataclass
+class CrawledCell:
+    h5name: str
+    cellname: str
+    celltype: str
+    name: str = "epochGroup"
+
+
+@dataclass
+class CrawledProtocol:
+    h5name: str
+    name: str
+    parameters: Dict = field(default_factory=dict)
+
+    def __str__(self):
+        return f"EpochBlock({self.name})"
+
+    def __iter__(self):
+        yield from self.parameters.items()
+
+    def __getitem__(self, value):
+        return self.parameters[value]
+
+    def get(self, value, default=None):
+        return self.parameters.get(value, default)
+
+
+@dataclass
+class CrawledStimulus:
+    name: str
+    parameters: Dict = field(default_factory=dict)
+
+    def __getitem__(self, value):
+        return self.parameters[value]
+
+    def __iter__(self):
+        yield from self.parameters.items()
+
+
+class CrawledEpoch:
+    """Epoch metadata collected by the crawler. Same interface as symphonyreader.Epoch"""
+
+    name = "epoch"
+
+    def __init__(self, h5file: h5py.File, h5name: str, attrs: Dict):
+        self.file = h5file
+        self.h5name = h5name
+        self.attrs = attrs
+        self.parameters: Dict = dict()
+        self._backgrounds: Dict[str, Dict] = dict()
+        self._stimuli: Dict[str, CrawledStimulus] = dict()
+        self._responses: List[str] = []
+        self._tracetype: str = None
+
+    def __str__(self):
+        return f"Epoch({self.startdate})"
+
+    @property
+    def tracetype(self):
+        if self._tracetype is None:
+            val = self._backgrounds["Amp1"]["value"]
+            self._tracetype = "spiketrace" if float(val) == 0.0 else "wholetrace"
+        return self._tracetype
+
+    @property
+    def holdingpotential(self):
+        val = self._backgrounds["Amp1"]["value"]
+        if self.tracetype == "spiketrace":
+            return "nan"
+        elif val < 0:
+            return "excitation"
+        else:
+            return "inhibitiion"
+
+    @property
+    def backgrounds(self) -> Dict[str, Dict]:
+        return self._backgrounds
+
+    @property
+    def responses(self) -> Iterator["sr.Response"]:
+        for path in self._responses:
+            yield sr.Response(self.file[path])
+
+    @property
+    def stimuli(self) -> Iterator[CrawledStimulus]:
+        yield from self._stimuli.values()
+
+    @property
+    def startdate(self):
+        return _ticks_to_date(self.attrs["startTimeDotNetDateTimeOffsetTicks"])
+
+    @property
+    def enddate(self):
+        return _ticks_to_date(self.attrs["endTimeDotNetDateTimeOffsetTicks"])
+
+    @property
+    def ndf(self):
+        return self.parameters.get("ndf", "None")
+
+
+class SymphonyCrawler:
+    """Collect every epoch of a Symphony file in one visititems pass"""
+
+    def __init__(self, h5file: h5py.File):
+        self.file = h5file
+        self.experiment = sr.Experiment(h5file)
+
+        self.cells: Dict[str, CrawledCell] = dict()
+        self.protocols: Dict[Tuple[str, str], CrawledProtocol] = dict()
+        self.epochs: Dict[Tuple[str, str, str], CrawledEpoch] = dict()
+
+    def crawl(self) -> List[Tuple[CrawledCell, CrawledProtocol, CrawledEpoch]]:
+        """(cell, protocol, epoch) in the same order as SymphonyReader.walk"""
+        self.cells.clear()
+        self.protocols.clear()
+        self.epochs.clear()
+
+        self.experiment.group.visititems(self._visit)
+
+        # SOURCES ARE HARD LINKS SO MAY HAVE BEEN VISITED UNDER ANOTHER PATH
+        for cellkey in {key[0] for key in self.protocols}:
+            self._add_cell(cellkey)
+
+        return [
+            (self.cells[cellkey], self.protocols[(cellkey, blockkey)], epoch)
+            for (cellkey, blockkey, _), epoch in sorted(self.epochs.items())]
+
+    def _add_cell(self, cellkey: str):
+        group = self.experiment.group[f"epochGroups/{cellkey}"]
+        label = sr.convert_if_bytes(group["source"].attrs["label"])
+        celltype = sr.convert_if_bytes(group["source/properties"].attrs["type"])
+        self.cells[cellkey] = CrawledCell(
+            h5name=group.name,
+            cellname=label if isinstance(label, str) else "MissingCellName",
+            celltype=celltype if isinstance(celltype, str) else "MissingCellType")
+
+    def _epoch(self, parts: List[str]) -> CrawledEpoch:
+        return self.epochs[(parts[1], parts[3], parts[5])]
+
+    def _relative_parts(self, name: str) -> List[str]:
+        """Path parts starting at epochGroups/cell/epochBlocks. Objects linked from more than one place
+        are only visited once, possibly under another cell's source, so match the last occurrence."""
+        parts = name.split("/")
+        for k in range(len(parts) - 1, 1, -1):
+            if parts[k] == "epochBlocks" and parts[k - 2] == "epochGroups":
+                return parts[k - 2:]
+        return None
+
+    def _visit(self, name: str, obj):
+        parts = self._relative_parts(name)
+        if parts is None or len(parts) < 4:
+            return None
+        n = len(parts)
+        h5name = f"{self.experiment.group.name}/{'/'.join(parts)}"
+
+        # epochGroups/cell/epochBlocks/block
+        if n == 4:
+            self.protocols[(parts[1], parts[3])] = CrawledProtocol(
+                h5name=h5name,
+                name=sr.Protocol.re_name.match(h5name)[1])
+        # epochGroups/cell/epochBlocks/block/protocolParameters
+        elif n == 5 and parts[4] == "protocolParameters":
+            self.protocols[(parts[1], parts[3])].parameters = _attrs(obj)
+        # epochGroups/cell/epochBlocks/block/epochs/epoch
+        elif n == 6 and parts[4] == "epochs":
+            self.epochs[(parts[1], parts[3], parts[5])] = CrawledEpoch(
+                self.file, h5name, _attrs(obj))
+        elif n < 7 or parts[4] != "epochs":
+            return None
+        # .../epochs/epoch/protocolParameters
+        elif n == 7 and parts[6] == "protocolParameters":
+            self._epoch(parts).parameters = _attrs(obj)
+        # .../epochs/epoch/backgrounds/name
+        elif n == 8 and parts[6] == "backgrounds":
+            bgname = sr.Background.re_name.match(parts[7])[1]
+            self._epoch(parts).backgrounds[bgname] = _attrs(obj)
+        # .../epochs/epoch/responses/name
+        elif n == 8 and parts[6] == "responses":
+            self._epoch(parts)._responses.append(h5name)
+        # .../epochs/epoch/stimuli/name/parameters
+        elif n == 9 and parts[6] == "stimuli" and parts[8] == "parameters":
+            stimname = sr.Stimulus.re_name.match(parts[7])[1]
+            self._epoch(parts)._stimuli[parts[7]] = CrawledStimulus(stimname, _attrs(obj))
+        return None
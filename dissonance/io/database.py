@@ -0,0 +1,290 @@
+"""
+SQLite export of Symphony files.
+
+Experiments, cells, epoch blocks and epochs go into indexed tables, with
+every attribute a converted epoch gets as a column of epochs. Spike times go
+into their own table. Traces are stored as float64 BLOBs on request,
+otherwise epochs keep the raw file and response path.
+
+    python -m dissonance.io.database export EPhysData/WT epochs.sqlite --genotype WT
+    python -m dissonance.io.database query epochs.sqlite \\
+        "SELECT genotype, lightmean, COUNT(*) FROM epochs WHERE led='UV LED' AND protocolname='LedPulse' GROUP BY 1, 2"
+"""
+import argparse
+import json
+import sqlite3
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from dissonance.funks import detect_spikes
+
+# MODULE IMPORT, SYMPHONYREADER IMPORTS THIS MODULE
+from . import symphonyreader as sr
+
+EPOCH_COLUMNS = [
+    ("path", "TEXT"),
+    ("cellname", "TEXT"),
+    ("celltype", "TEXT"),
+    ("genotype", "TEXT"),
+    ("tracetype", "TEXT"),
+    ("protocolname", "TEXT"),
+    ("startdate", "TEXT"),
+    ("enddate", "TEXT"),
+    ("interpulseinterval", "REAL"),
+    ("led", "TEXT"),
+    ("lightamplitudeSU", "REAL"),
+    ("lightmeanSU", "REAL"),
+    ("lightamplitude", "REAL"),
+    ("lightmean", "REAL"),
+    ("numberofaverages", "REAL"),
+    ("pretime", "REAL"),
+    ("backgroundval", "REAL"),
+    ("stimtime", "REAL"),
+    ("samplerate", "REAL"),
+    ("tailtime", "REAL"),
+    ("ndf", "TEXT"),
+    ("holdingpotential", "TEXT"),
+]
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS experiments (
+    id INTEGER PRIMARY KEY,
+    filepath TEXT UNIQUE NOT NULL,
+    name TEXT
+);
+CREATE TABLE IF NOT EXISTS cells (
+    id INTEGER PRIMARY KEY,
+    experiment_id INTEGER NOT NULL REFERENCES experiments(id),
+    h5name TEXT NOT NULL,
+    cellname TEXT,
+    celltype TEXT,
+    genotype TEXT
+);
+CREATE TABLE IF NOT EXISTS epochblocks (
+    id INTEGER PRIMARY KEY,
+    cell_id INTEGER NOT NULL REFERENCES cells(id),
+    h5name TEXT NOT NULL,
+    protocolname TEXT,
+    parameters TEXT
+);
+CREATE TABLE IF NOT EXISTS epochs (
+    id INTEGER PRIMARY KEY,
+    experiment_id INTEGER NOT NULL REFERENCES experiments(id),
+    cell_id INTEGER NOT NULL REFERENCES cells(id),
+    epochblock_id INTEGER NOT NULL REFERENCES epochblocks(id),
+    number INTEGER NOT NULL,
+    {", ".join(f"{name} {sqltype}" for name, sqltype in EPOCH_COLUMNS)},
+    responsepath TEXT,
+    nsamples INTEGER,
+    trace BLOB
+);
+CREATE TABLE IF NOT EXISTS spikes (
+    epoch_id INTEGER NOT NULL REFERENCES epochs(id),
+    spiketime REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS cells_experiment ON cells(experiment_id);
+CREATE INDEX IF NOT EXISTS epochblocks_cell ON epochblocks(cell_id);
+CREATE INDEX IF NOT EXISTS epochs_experiment ON epochs(experiment_id);
+CREATE INDEX IF NOT EXISTS epochs_cell ON epochs(cell_id);
+CREATE INDEX IF NOT EXISTS epochs_epochblock ON epochs(epochblock_id);
+CREATE INDEX IF NOT EXISTS epochs_stimulus ON epochs(protocolname, led, lightamplitude, lightmean);
+CREATE INDEX IF NOT EXISTS epochs_genotype ON epochs(genotype, celltype);
+CREATE INDEX IF NOT EXISTS epochs_cellname ON epochs(cellname);
+CREATE INDEX IF NOT EXISTS epochs_startdate ON epochs(startdate);
+CREATE INDEX IF NOT EXISTS spikes_epoch ON spikes(epoch_id);
+"""
+
+
+def _sql_value(val):
+    """Python scalar sqlite3 can bind. nan is stored as NULL."""
+    if isinstance(val, (bytes, np.bytes_)):
+        return val.decode()
+    if isinstance(val, (np.integer, np.bool_)):
+        return int(val)
+    if isinstance(val, np.floating):
+        val = float(val)
+    if isinstance(val, float) and np.isnan(val):
+        return None
+    if isinstance(val, np.ndarray):
+        return json.dumps(val.tolist())
+    return val
+
+
+def connect(dbpath: Path) -> sqlite3.Connection:
+    """Open the database, creating the tables and indexes if they don't exist"""
+    conn = sqlite3.connect(str(dbpath))
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def _next_id(conn: sqlite3.Connection, table: str) -> int:
+    return conn.execute(f"SELECT COALESCE(MAX(id), 0) + 1 FROM {table}").fetchone()[0]
+
+
+def _insert(conn: sqlite3.Connection, table: str, columns: List[str], rows: Iterable[Tuple]) -> None:
+    conn.executemany(
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+        rows)
+
+
+def delete_experiment(conn: sqlite3.Connection, filepath: str) -> None:
+    """Remove an experiment and everything under it, so a file can be exported again"""
+    row = conn.execute("SELECT id FROM experiments WHERE filepath = ?", (filepath,)).fetchone()
+    if row is None:
+        return
+    experiment_id = row[0]
+    conn.execute(
+        "DELETE FROM spikes WHERE epoch_id IN (SELECT id FROM epochs WHERE experiment_id = ?)", (experiment_id,))
+    conn.execute("DELETE FROM epochs WHERE experiment_id = ?", (experiment_id,))
+    conn.execute(
+        "DELETE FROM epochblocks WHERE cell_id IN (SELECT id FROM cells WHERE experiment_id = ?)", (experiment_id,))
+    conn.execute("DELETE FROM cells WHERE experiment_id = ?", (experiment_id,))
+    conn.execute("DELETE FROM experiments WHERE id = ?", (experiment_id,))
+
+
+def export(reader: "sr.SymphonyReader", dbpath: Path, genotype: str = None, spikes: bool = False, traces: bool = False, batchsize: int = 500) -> int:
+    """Export every epoch of a Symphony file. Replaces the file's rows if it was exported before.
+
+    The whole file is one transaction, epochs and spikes are inserted with executemany in
+    batches of batchsize epochs.
+
+    Args:
+        reader (SymphonyReader): Open Symphony file.
+        dbpath (Path): SQLite database, created if it doesn't exist.
+        genotype (str, optional): Genotype of every cell. Defaults to "PleaseAddGenotype" as in conversion.
+        spikes (bool, optional): Detect spikes in spike traces and store the spike times.
+        traces (bool, optional): Store traces as float64 BLOBs. Otherwise only responsepath is kept.
+        batchsize (int, optional): Epochs per executemany.
+
+    Returns:
+        int: Number of epochs exported.
+    """
+    filepath = str(Path(reader.finpath).resolve())
+    columns = [
+        "id", "experiment_id", "cell_id", "epochblock_id", "number",
+        *(name for name, _ in EPOCH_COLUMNS),
+        "responsepath", "nsamples", "trace"]
+
+    conn = connect(dbpath)
+    reader.timer.start_file("to_db", reader.finpath, dbpath)
+    try:
+        with conn:
+            delete_experiment(conn, filepath)
+            experiment_id = _next_id(conn, "experiments")
+            conn.execute(
+                "INSERT INTO experiments (id, filepath, name) VALUES (?, ?, ?)",
+                (experiment_id, filepath, reader.exp.group.name))
+
+            cellids: Dict[str, int] = dict()
+            blockids: Dict[str, int] = dict()
+            nextcell = _next_id(conn, "cells")
+            nextblock = _next_id(conn, "epochblocks")
+            epoch_id = _next_id(conn, "epochs")
+
+            epochrows, spikerows = [], []
+            nepochs = 0
+            for ii, (cell, protocol, epoch) in enumerate(reader.reader()):
+                with reader.timer.stage("metadata", epoch.h5name):
+                    if cell.h5name not in cellids:
+                        cellids[cell.h5name] = nextcell
+                        _insert(conn, "cells", ["id", "experiment_id", "h5name", "cellname", "celltype", "genotype"], [(
+                            nextcell, experiment_id, cell.h5name, cell.cellname, cell.celltype,
+                            "PleaseAddGenotype" if genotype is None else genotype)])
+                        nextcell += 1
+                    if protocol.h5name not in blockids:
+                        blockids[protocol.h5name] = nextblock
+                        _insert(conn, "epochblocks", ["id", "cell_id", "h5name", "protocolname", "parameters"], [(
+                            nextblock, cellids[cell.h5name], protocol.h5name, protocol.name,
+                            json.dumps({key: _sql_value(val) for key, val in protocol}))])
+                        nextblock += 1
+
+                    attrs = reader._epoch_attrs(protocol, cell, epoch)
+                    if genotype is not None:
+                        attrs["genotype"] = genotype
+
+                response = next(iter(epoch.responses), None)
+                values, spiketimes = None, None
+                if response is not None and (traces or spikes):
+                    start = time.perf_counter()
+                    values = response.read()
+                    reader.timer.add("read", time.perf_counter() - start, epoch.h5name, values.nbytes)
+                    if spikes and epoch.tracetype == "spiketrace":
+                        with reader.timer.stage("detect", epoch.h5name):
+                            spiketimes, _ = detect_spikes(values)
+
+                epochrows.append((
+                    epoch_id, experiment_id, cellids[cell.h5name], blockids[protocol.h5name], ii,
+                    *(_sql_value(attrs[name]) for name, _ in EPOCH_COLUMNS),
+                    None if response is None else response.h5name,
+                    None if values is None else len(values),
+                    values.astype(np.float64).tobytes() if traces and values is not None else None))
+                if spiketimes is not None:
+                    spikerows.extend((epoch_id, float(spiketime)) for spiketime in spiketimes)
+                epoch_id += 1
+                nepochs += 1
+
+                if len(epochrows) >= batchsize:
+                    with reader.timer.stage("write"):
+                        _insert(conn, "epochs", columns, epochrows)
+                        _insert(conn, "spikes", ["epoch_id", "spiketime"], spikerows)
+                    epochrows, spikerows = [], []
+
+            with reader.timer.stage("write"):
+                _insert(conn, "epochs", columns, epochrows)
+                _insert(conn, "spikes", ["epoch_id", "spiketime"], spikerows)
+    finally:
+        conn.close()
+        reader.timer.end_file()
+    return nepochs
+
+
+def read_trace(blob: bytes) -> np.array:
+    return np.frombuffer(blob, dtype=np.float64)
+
+
+def query(dbpath: Path, sql: str, params: Tuple = ()) -> pd.DataFrame:
+    conn = sqlite3.connect(str(dbpath))
+    try:
+        return pd.read_sql_query(sql, conn, params=params)
+    finally:
+        conn.close()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Export Symphony files to SQLite or query the database.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    exportparser = subparsers.add_parser("export")
+    exportparser.add_argument("paths", type=Path, nargs="+", help="Symphony files or directories of them, then the database.")
+    exportparser.add_argument("--genotype", type=str, default=None)
+    exportparser.add_argument("--spikes", action="store_true", help="Detect and store spike times.")
+    exportparser.add_argument("--traces", action="store_true", help="Store traces as BLOBs.")
+
+    queryparser = subparsers.add_parser("query")
+    queryparser.add_argument("dbpath", type=Path)
+    queryparser.add_argument("sql", type=str)
+
+    ns = parser.parse_args(args)
+    if ns.command == "query":
+        print(query(ns.dbpath, ns.sql).to_string(index=False))
+        return
+
+    *paths, dbpath = ns.paths
+    for path in paths:
+        for filepath in (sorted(path.glob("*.h5")) if path.is_dir() else [path]):
+            reader = sr.SymphonyReader(filepath)
+            try:
+                nepochs = reader.to_db(dbpath, genotype=ns.genotype, spikes=ns.spikes, traces=ns.traces)
+            finally:
+                reader.fin.close()
+            print(f"{filepath}: {nepochs}")
+
+
+if __name__ == "__main__":
+    main()
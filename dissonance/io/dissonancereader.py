@@ -1,18 +1,44 @@
 import multiprocessing as mp
 import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from functools import partial
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, Iterator, List, Tuple
 
 import h5py
+import numpy as np
 import pandas as pd
 
+from . import edits, epochindex, paramscache, rstarr
+from .access import open_readonly, writable
+from .filters import compile_filters, filter_mask
+from ..epochtypes import epoch_factory
+
 RE_DATE = re.compile(r"^.*(\d{4}-\d{2}-\d{2})(\w\d?).*$")
 
 
+@dataclass
+class EpochRecord:
+    """Epoch detached from its file, trace and spikes already read"""
+    exppath: Path
+    number: int
+    tracetype: str
+    trace: np.array
+    spikes: np.array = None
+    params: Dict = field(default_factory=dict)
+
+
 class DissonanceReader:
 
-    def __init__(self, paths: List[Path]):
+    def __init__(self, paths: List[Path], cachedir: Path = None):
+        """
+        Args:
+            paths (List[Path]): Dissonance files or directories of them.
+            cachedir (Path, optional): Params table cache, see dissonance.io.paramscache.
+        """
+        self.cache = paramscache.ParamsCache(cachedir)
         self.experimentpaths = []
         for path in paths:
             if path.is_dir():
@@ -22,87 +48,266 @@ class DissonanceReader:
 
     @staticmethod
     def file_to_paramstable(filepath: Path, paramnames: List[str], filters: Dict = None):
-        try:
-            matches = RE_DATE.match(str(filepath))
-            prefix = matches[1].replace("-", "") + matches[2]
+        return DissonanceReader._scan_paramstable(filepath, paramnames, filters)[0]
 
-            data = []
-            h5file = h5py.File(str(filepath), "a")
-            experiment = h5file["experiment"]
-            for epochname in experiment:
-                epoch = experiment[epochname]
-
-                condition = all(
-                    [epoch.attrs.get(key) == val for key, val in filters.items()])
-                if condition:
-                    number = f"{int(epochname[5:]):04d}"
+    @staticmethod
+    def _scan_paramstable(filepath: Path, paramnames: List[str], filters: Dict = None) -> Tuple[pd.DataFrame, bool]:
+        """Params table of a file, None if no epoch matches, and whether the file could be read"""
+        filters = dict() if filters is None else filters
+        h5file = None
+        try:
+            # READ ONLY, SHARED LOCKS LET WORKERS AND OTHER READERS READ AT ONCE,
+            # OPENING FOR WRITING CAN ALSO TOUCH THE FILE AND INVALIDATE ITS CACHE ENTRY
+            h5file = open_readonly(filepath)
 
-                    params = {key: epoch.attrs.get(key) for key in paramnames}
-                    params["number"] = number
-                    params["tracetype"] = epoch.attrs["tracetype"]
-                    data.append(params)
+            # USE CONSOLIDATED INDEX IF THE FILE HAS ONE
+            index = epochindex.read_index(h5file)
+            if index is not None:
+                df = DissonanceReader._index_to_paramstable(index, paramnames, filters)
+            else:
+                df = DissonanceReader._attrs_to_paramstable(h5file, paramnames, filters)
 
-            if len(data) > 0:
-                df = pd.DataFrame.from_dict(data)
+            if df is not None and df.shape[0] > 0:
                 df["startdate"] = pd.to_datetime(df["startdate"])
                 df["exppath"] = filepath
                 print(f"{filepath}: {df.shape[0]}")
-                return df
+                return df, True
             else:
-                return None
+                return None, True
         except Exception as e:
             print(filepath)
             print(e)
-            return None
-
-    def to_epochs(self, **kwargs) -> List:
-        traces = []
-        for ii, filepath in enumerate(self.experimentpaths):
-            print(f"Loading {ii+1} / {len(self.experimentpaths)}: {filepath}")
-            traces.extend(self.h5_to_epochs(filepath, **kwargs))
-        return traces
-
-    def to_params(self, paramnames: List[str], filters: Dict, nprocesses: int = 5) -> pd.DataFrame:
-        dfs = []
-        func = partial(self.file_to_paramstable,
+            return None, False
+        finally:
+            if h5file is not None:
+                h5file.close()
+
+    @staticmethod
+    def _attrs_to_paramstable(h5file: h5py.File, paramnames: List[str], filters: Dict) -> pd.DataFrame:
+        experiment = h5file["experiment"]
+        epochnames = epochindex.epoch_names(experiment)
+
+        # READ FILTER ATTRIBUTES AS COLUMNS, THEN ONLY BUILD ROWS FOR MATCHING EPOCHS
+        filterkeys = list(dict.fromkeys(key for key, _ in compile_filters(filters)))
+        columns = {
+            key: pd.Series([experiment[name].attrs.get(key) for name in epochnames], dtype=object)
+            for key in filterkeys}
+        mask = filter_mask(columns, filters, len(epochnames))
+
+        data = []
+        for epochname in np.asarray(epochnames, dtype=object)[mask]:
+            epoch = experiment[epochname]
+            number = f"{int(epochname[5:]):04d}"
+
+            params = {key: epoch.attrs.get(key) for key in paramnames}
+            params["number"] = number
+            params["tracetype"] = epoch.attrs["tracetype"]
+            data.append(params)
+
+        if len(data) > 0:
+            return pd.DataFrame.from_dict(data)
+        return None
+
+    @staticmethod
+    def _index_to_paramstable(index: pd.DataFrame, paramnames: List[str], filters: Dict) -> pd.DataFrame:
+        index = index.loc[filter_mask(index, filters, index.shape[0])].reset_index(drop=True)
+
+        df = pd.DataFrame(index=index.index)
+        for key in paramnames:
+            df[key] = index[key] if key in index.columns else None
+        df["number"] = [f"{number:04d}" for number in index["number"].values]
+        df["tracetype"] = index["tracetype"]
+        return df
+
+    @staticmethod
+    def select_numbers(h5file: h5py.File, filters: Dict = None) -> np.array:
+        """Numbers of the epochs matching filters, from the epoch index if the file has one"""
+        index = epochindex.read_index(h5file)
+        if index is not None:
+            return index["number"].values[filter_mask(index, filters, index.shape[0])]
+
+        experiment = h5file["experiment"]
+        epochnames = epochindex.epoch_names(experiment)
+        filterkeys = list(dict.fromkeys(key for key, _ in compile_filters(filters)))
+        columns = {
+            key: pd.Series([experiment[name].attrs.get(key) for name in epochnames], dtype=object)
+            for key in filterkeys}
+        numbers = np.array([int(name[5:]) for name in epochnames], dtype=int)
+        return numbers[filter_mask(columns, filters, len(epochnames))]
+
+    @staticmethod
+    def _load_file(filepath: Path, filters: Dict, records: bool) -> Tuple[h5py.File, List]:
+        """Open a file read only and build its matching epochs. Records are read in full
+        and the file closed straight away."""
+        h5file = open_readonly(filepath)
+        try:
+            experiment = h5file["experiment"]
+            numbers = np.sort(DissonanceReader.select_numbers(h5file, filters))
+            epochs = [epoch_factory(experiment[f"epoch{number}"]) for number in numbers]
+            if not records:
+                return h5file, epochs
+
+            items = []
+            for epoch in epochs:
+                attrs = epoch._epochgrp.attrs
+                items.append(EpochRecord(
+                    exppath=filepath,
+                    number=epoch.number,
+                    tracetype=epoch.tracetype,
+                    trace=epoch.trace,
+                    spikes=epoch.spikes if epoch.tracetype == "spiketrace" else None,
+                    params={key: val for key, val in attrs.items() if np.ndim(val) == 0}))
+        except Exception:
+            h5file.close()
+            raise
+        h5file.close()
+        return None, items
+
+    def iter_epochs(self, filters: Dict = None, records: bool = False, prefetch: bool = True, maxopen: int = 2) -> Iterator:
+        """Stream matching epochs file by file, in file order then epoch number.
+
+        Args:
+            filters (Dict, optional): Attribute conditions, see dissonance.io.filters. Only matching
+                epochs are built.
+            records (bool, optional): Yield EpochRecords with the trace and spikes already read,
+                each file is closed once read. Otherwise yield SpikeEpoch and WholeEpoch objects
+                backed by the open read only file.
+            prefetch (bool, optional): Open and read the next file on a background thread while the
+                current one is consumed. h5py serialises its own calls, so this overlaps the
+                consumer's work with the next file's reads.
+            maxopen (int, optional): Most files open at once when yielding epoch objects, counting a
+                prefetched file. The oldest is closed when the limit is reached, so keep epochs only
+                while their file is among the most recent. None never closes files.
+
+        Yields:
+            IEpoch or EpochRecord
+        """
+        if maxopen is not None and maxopen < 1 + int(prefetch):
+            raise ValueError(f"maxopen must be at least {1 + int(prefetch)} with prefetch={prefetch}")
+
+        load = partial(self._load_file, filters=filters, records=records)
+        filepaths = list(self.experimentpaths)
+        opened = deque()
+        limit = None if maxopen is None else maxopen - int(prefetch)
+
+        def track(h5file):
+            if h5file is None:
+                return
+            opened.append(h5file)
+            while limit is not None and len(opened) > limit:
+                opened.popleft().close()
+
+        executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        pending = None
+        try:
+            if executor is not None and len(filepaths) > 0:
+                pending = executor.submit(load, filepaths[0])
+            for ii, filepath in enumerate(filepaths):
+                if executor is None:
+                    h5file, epochs = load(filepath)
+                else:
+                    h5file, epochs = pending.result()
+                    pending = None
+                track(h5file)
+
+                # START ON THE NEXT FILE WHILE THIS ONE IS CONSUMED
+                if executor is not None and ii + 1 < len(filepaths):
+                    pending = executor.submit(load, filepaths[ii + 1])
+                yield from epochs
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True)
+                # CLOSE A PREFETCHED FILE THAT WAS NEVER CONSUMED
+                if pending is not None and pending.exception() is None:
+                    h5file, _ = pending.result()
+                    if h5file is not None:
+                        h5file.close()
+            if maxopen is not None:
+                while opened:
+                    opened.popleft().close()
+
+    def to_epochs(self, filters: Dict = None) -> List:
+        """Every matching epoch as an epoch object. Files are kept open, read only."""
+        return list(self.iter_epochs(filters=filters, prefetch=False, maxopen=None))
+
+    def to_params(self, paramnames: List[str], filters: Dict, nprocesses: int = 5, usecache: bool = True) -> pd.DataFrame:
+        """Params table of every file. Files unchanged since they were last read come from the cache.
+
+        Args:
+            paramnames (List[str]): Epoch attributes to include.
+            filters (Dict): Attribute name to condition, see dissonance.io.filters. Evaluated in the
+                workers so only matching rows are built.
+            usecache (bool, optional): Read and update the params cache. Defaults to True.
+        """
+        tables = dict()
+        todo = []
+        for experimentpath in self.experimentpaths:
+            if usecache:
+                try:
+                    tables[experimentpath] = self.cache.get(experimentpath, paramnames, filters)
+                    continue
+                except KeyError:
+                    ...
+            todo.append(experimentpath)
+
+        func = partial(self._scan_paramstable,
                        paramnames=paramnames, filters=filters)
 
-        if nprocesses == 1:
-            for experimentpath in self.experimentpaths:
-                df = func(experimentpath)
-                dfs.append(df)
+        if nprocesses == 1 or len(todo) <= 1:
+            scanned = [func(experimentpath) for experimentpath in todo]
         else:
             with mp.Pool(processes=nprocesses) as p:
-                for df in p.map(func, self.experimentpaths):
-                    dfs.append(df)
+                scanned = p.map(func, todo)
+
+        for experimentpath, (df, ok) in zip(todo, scanned):
+            tables[experimentpath] = df
+            # FAILED FILES ARE RESCANNED NEXT TIME, EMPTY ONES ARE CACHED AS EMPTY
+            if usecache and ok:
+                self.cache.put(experimentpath, paramnames, filters, df)
 
-        return pd.concat(dfs)
+        return pd.concat([tables[experimentpath] for experimentpath in self.experimentpaths])
 
 
 class DissonanceUpdater:
     RE_DATE = re.compile(r"^.*(\d{4}-\d{2}-\d{2})(\w\d?).*$")
 
-    def __init__(self, disfilepath: Path):
+    def __init__(self, disfilepath: Path, cachedir: Path = None):
+        """
+        Args:
+            disfilepath (Path): Dissonance file to edit.
+            cachedir (Path, optional): Params table cache to keep in step with edits, see
+                dissonance.io.paramscache. Defaults to the default cache.
+        """
         self.filepath = disfilepath
+        self.cache = paramscache.ParamsCache(cachedir)
+
+    def _edited(self):
+        # DROP CACHED PARAMS TABLES IN CASE THE EDIT LEFT SIZE AND MTIME UNCHANGED
+        self.cache.invalidate(self.filepath)
 
     def update_cell_labels(self):
-        f = h5py.File(str(self.filepath), "r+")
         matches = self.RE_DATE.match(str(self.filepath))
-
         prefix = matches[1].replace("-", "") + matches[2]
-        for epochgrp in f["experiment"]:
-            epoch = f[f"experiment/{epochgrp}"]
-            epoch.attrs["cellname"] = f'{prefix}_{epoch.attrs["cellname"].split("_")[-1]}'
 
-    def undo_update_cell_labels(self):
-        f = h5py.File(self.filepath, "r+")
+        with writable(self.filepath) as f:
+            epochindex.mark_edited(f)
+            for epochgrp in f["experiment"]:
+                epoch = f[f"experiment/{epochgrp}"]
+                epoch.attrs["cellname"] = f'{prefix}_{epoch.attrs["cellname"].split("_")[-1]}'
 
-        for name in f["experiment"]:
-            epoch = f[f"experiment/{name}"]
-            cellname = epoch.attrs["cellname"]
-            epoch.attrs["cellname"] = cellname.split("_")[0]
+            epochindex.refresh_index(f)
+        self._edited()
 
-        f.close()
+    def undo_update_cell_labels(self):
+        with writable(self.filepath) as f:
+            epochindex.mark_edited(f)
+            for name in f["experiment"]:
+                epoch = f[f"experiment/{name}"]
+                cellname = epoch.attrs["cellname"]
+                epoch.attrs["cellname"] = cellname.split("_")[0]
+
+            epochindex.refresh_index(f)
+        self._edited()
 
     def add_attribute(self, paramname: str, paramval: object, filters: Dict) -> None:
         """Adding attribute to epochs in h5 file
@@ -111,24 +316,43 @@ class DissonanceUpdater:
                 filename (str): Path to h5py file
                 attr (pd.DataFrame): Indexed on params
         """
-        f = h5py.File(self.filepath, "r+")
+        with writable(self.filepath) as f:
+            epochindex.mark_edited(f)
+            for name in f["experiment"]:
+                epoch = f[f"experiment/{name}"]
+                if all([
+                        epoch.attrs[key] == val
+                        for key, val in filters.items()]):
+                    epoch.attrs[paramname] = paramval
 
-        for name in f["experiment"]:
-            epoch = f[f"experiment/{name}"]
-            if all([
-                    epoch.attrs[key] == val
-                    for key, val in filters.items()]):
-                epoch.attrs[paramname] = paramval
+            epochindex.refresh_index(f)
+        self._edited()
 
-        f.close()
+    def apply_edits(self, changes: pd.DataFrame, dryrun: bool = False) -> pd.DataFrame:
+        """Apply a changes table to this file in one pass, see dissonance.io.edits.
+        All or nothing, raises IOError if the edit failed. Returns the diff."""
+        changes = changes.assign(exppath=self.filepath)
+        result = edits.edit_file(Path(self.filepath), changes, dryrun=dryrun, cachedir=self.cache.cachedir)
+        if not result.ok:
+            raise IOError(f"{self.filepath} left unchanged. {result.error}")
+        return result.diff
 
-    def add_genotype(self, genotype):
-        f = h5py.File(self.filepath, "r+")
+    def update_rstarr(self, calibration: rstarr.RstarrCalibration = None) -> pd.DataFrame:
+        """Recompute lightamplitude and lightmean from the stored stimulus unit settings.
+        The raw Symphony file isn't needed. Returns the uncalibrated stimuli."""
+        with writable(self.filepath) as f:
+            converted = rstarr.recalibrate(f, calibration)
+        self._edited()
+        return rstarr.RstarrCalibration.unmatched(converted)
 
-        for name in f["experiment"]:
+    def add_genotype(self, genotype):
+        with writable(self.filepath) as f:
+            epochindex.mark_edited(f)
+            for name in f["experiment"]:
 
-            epoch = f[f"experiment/{name}"]
-            del epoch.attrs["genotype"]
-            epoch.attrs["genotype"] = genotype
+                epoch = f[f"experiment/{name}"]
+                del epoch.attrs["genotype"]
+                epoch.attrs["genotype"] = genotype
 
-        f.close()
+            epochindex.refresh_index(f)
+        self._edited()
@@ -0,0 +1,230 @@
+"""
+Bulk attribute edits of dissonance files.
+
+A changes table has one row per edit with columns exppath, paramname and
+value. The epochs a row applies to are picked by an optional number column
+and by any other columns, which are equality conditions on epoch attributes
+(empty cells are ignored). An optional filters column holds filter dicts
+(see dissonance.io.filters). A row with no conditions edits every epoch.
+
+    exppath,cellname,protocolname,paramname,value
+    MappedData/WT/2021-09-11A.h5,20210911A_Cell1,,genotype,WT
+    MappedData/WT/2021-09-11A.h5,20210911A_Cell2,LedPulse,celltype,RGC\\OFF-transient
+
+Each file is read once to work out the diff, then written in one pass. If a
+write or the epoch index rebuild fails the file's earlier writes are rolled
+back, so a file gets all of its edits or none. Files are edited in parallel.
+
+    python -m dissonance.io.edits changes.csv --dry-run
+    python -m dissonance.io.edits changes.csv --nprocesses 6
+"""
+import argparse
+import logging
+import multiprocessing as mp
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from . import epochindex, paramscache
+from .access import open_readonly, writable
+from .filters import filter_mask
+
+logger = logging.getLogger(__name__)
+
+# COLUMNS THAT AREN'T EPOCH CONDITIONS
+EDIT_COLUMNS = ("exppath", "paramname", "value", "number", "filters")
+DIFF_COLUMNS = ["exppath", "number", "paramname", "old", "new"]
+
+# MARKS AN ATTRIBUTE THAT DIDN'T EXIST BEFORE THE EDIT
+MISSING = "<missing>"
+
+
+@dataclass
+class EditResult:
+    exppath: Path
+    diff: pd.DataFrame
+    applied: bool = False
+    error: str = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def _is_empty(val) -> bool:
+    return val is None or (isinstance(val, float) and np.isnan(val))
+
+
+def _same(old, new) -> bool:
+    if isinstance(old, str) and old == MISSING:
+        return False
+    if _is_empty(old) and _is_empty(new):
+        return True
+    try:
+        return bool(old == new)
+    except (TypeError, ValueError):
+        return False
+
+
+def _to_python(val):
+    if isinstance(val, (bytes, np.bytes_)):
+        return val.decode()
+    if isinstance(val, np.generic):
+        return val.item()
+    return val
+
+
+def _row_conditions(row: pd.Series) -> Dict:
+    conditions = {
+        key: val for key, val in row.items()
+        if key not in EDIT_COLUMNS and not _is_empty(val)}
+    filters = row.get("filters")
+    if isinstance(filters, dict):
+        conditions.update(filters)
+    return conditions
+
+
+def _select(h5file: h5py.File, frame: pd.DataFrame, row: pd.Series) -> np.array:
+    number = row.get("number")
+    if not _is_empty(number):
+        numbers = np.array([int(number)])
+        return numbers[np.isin(numbers, frame["number"].values)]
+    conditions = _row_conditions(row)
+    return frame["number"].values[filter_mask(frame, conditions, frame.shape[0])]
+
+
+def _attribute_frame(h5file: h5py.File, changes: pd.DataFrame) -> pd.DataFrame:
+    """Epoch attributes needed to select the changes, one row per epoch"""
+    experiment = h5file["experiment"]
+    names = epochindex.epoch_names(experiment)
+    keys = set()
+    for _, row in changes.iterrows():
+        keys.update(_row_conditions(row).keys())
+
+    index = epochindex.read_index(h5file)
+    if index is not None and all(key in index.columns for key in keys):
+        return index
+
+    frame = pd.DataFrame({"number": [int(name[5:]) for name in names]})
+    for key in keys:
+        frame[key] = pd.Series([experiment[name].attrs.get(key) for name in names], dtype=object)
+    return frame
+
+
+def plan(h5file: h5py.File, exppath: Path, changes: pd.DataFrame) -> pd.DataFrame:
+    """Diff of the changes against the file. Later rows win where rows overlap."""
+    experiment = h5file["experiment"]
+    frame = _attribute_frame(h5file, changes)
+
+    edits: Dict[Tuple[int, str], object] = dict()
+    for _, row in changes.iterrows():
+        for number in _select(h5file, frame, row):
+            edits[(int(number), row["paramname"])] = _to_python(row["value"])
+
+    data = []
+    for (number, paramname), new in sorted(edits.items()):
+        attrs = experiment[f"epoch{number}"].attrs
+        old = _to_python(attrs[paramname]) if paramname in attrs else MISSING
+        if not _same(old, new):
+            data.append((exppath, number, paramname, old, new))
+    return pd.DataFrame(data, columns=DIFF_COLUMNS)
+
+
+def _write(h5file: h5py.File, diff: pd.DataFrame) -> None:
+    """Write the diff and refresh the epoch index. Any failure rolls the attributes back."""
+    experiment = h5file["experiment"]
+    written = []
+    try:
+        epochindex.mark_edited(h5file)
+        for number, paramname, old, new in diff[["number", "paramname", "old", "new"]].itertuples(index=False):
+            experiment[f"epoch{number}"].attrs[paramname] = new
+            written.append((number, paramname, old))
+        epochindex.refresh_index(h5file)
+    except Exception:
+        # ROLL BACK SO THE FILE IS LEFT AS IT WAS
+        for number, paramname, old in reversed(written):
+            attrs = experiment[f"epoch{number}"].attrs
+            if isinstance(old, str) and old == MISSING:
+                del attrs[paramname]
+            else:
+                attrs[paramname] = old
+        # AN INDEX LEFT HALF WRITTEN READS AS STALE, SO A FAILED REBUILD HERE IS SAFE
+        try:
+            epochindex.refresh_index(h5file)
+        except Exception:
+            logger.warning(f"{h5file.filename}: epoch index not rebuilt after rolling back")
+        raise
+
+
+def edit_file(exppath: Path, changes: pd.DataFrame, dryrun: bool = False, cachedir: Path = None) -> EditResult:
+    """Apply one file's changes in a single pass. Errors are returned, not raised.
+    Cached params tables of the file in cachedir (the default cache if None) are dropped."""
+    result = EditResult(exppath, pd.DataFrame(columns=DIFF_COLUMNS))
+    try:
+        if dryrun:
+            with open_readonly(exppath) as f:
+                result.diff = plan(f, exppath, changes)
+            return result
+
+        with writable(exppath) as f:
+            result.diff = plan(f, exppath, changes)
+            if result.diff.shape[0] > 0:
+                _write(f, result.diff)
+                result.applied = True
+        if result.applied:
+            paramscache.invalidate(exppath, cachedir)
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+    return result
+
+
+def _edit_group(item: Tuple[Path, pd.DataFrame], dryrun: bool, cachedir: Path = None) -> EditResult:
+    return edit_file(*item, dryrun=dryrun, cachedir=cachedir)
+
+
+def apply_edits(changes: pd.DataFrame, dryrun: bool = False, nprocesses: int = 5, cachedir: Path = None) -> Tuple[pd.DataFrame, List[EditResult]]:
+    """Apply a changes table, grouped by file and edited in parallel.
+
+    Args:
+        changes (pd.DataFrame): exppath, paramname and value columns plus epoch conditions.
+        dryrun (bool, optional): Only work out the diff, files are opened read only.
+        nprocesses (int, optional): Files edited at once.
+        cachedir (Path, optional): Params table cache to drop edited files from. Defaults to the default cache.
+
+    Returns:
+        Tuple[pd.DataFrame, List[EditResult]]: Diff of every file (exppath, number, paramname, old, new)
+            and the per file results, with errors of files left untouched.
+    """
+    groups = [(Path(exppath), frame) for exppath, frame in changes.groupby("exppath", sort=False)]
+    if nprocesses == 1 or len(groups) <= 1:
+        results = [_edit_group(item, dryrun, cachedir) for item in groups]
+    else:
+        with mp.Pool(processes=nprocesses) as p:
+            results = p.starmap(_edit_group, [(item, dryrun, cachedir) for item in groups])
+
+    diffs = [result.diff for result in results if result.diff.shape[0] > 0]
+    diff = pd.concat(diffs, ignore_index=True) if len(diffs) > 0 else pd.DataFrame(columns=DIFF_COLUMNS)
+    return diff, results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Apply a table of attribute edits to dissonance files.")
+    parser.add_argument("changes", type=Path, help="csv with exppath, paramname, value and epoch condition columns.")
+    parser.add_argument("--dry-run", action="store_true", help="Print the diff without writing.")
+    parser.add_argument("--nprocesses", type=int, default=5)
+    ns = parser.parse_args(args)
+
+    changes = pd.read_csv(ns.changes)
+    diff, results = apply_edits(changes, dryrun=ns.dry_run, nprocesses=ns.nprocesses)
+    print(diff.to_string(index=False))
+    for result in results:
+        if not result.ok:
+            print(f"FILEFAILED {result.exppath}: {result.error}")
+
+
+if __name__ == "__main__":
+    main()
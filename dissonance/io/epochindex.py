@@ -0,0 +1,255 @@
+"""
+Consolidated epoch index for dissonance files.
+
+Every scalar attribute of every experiment/epochN group is copied into a
+single compound dataset at the root of the file, one row per epoch. Reading
+the params table is then one dataset read instead of an attribute read per
+epoch per parameter.
+
+The experiment group carries a generation counter that every writer in
+dissonance bumps with mark_edited before it touches epoch attributes, and the
+index records the generation it was built at. Checking the index is then one
+attribute compare. An index from another generation, for example after an
+edit that was interrupted before the index was brought up to date, is treated
+as stale and readers fall back to the attributes. Tools outside dissonance
+(HDFView, plain h5py scripts) don't bump the generation, so rebuild the index
+after using them with this module.
+
+    python -m dissonance.io.epochindex MappedData/WT MappedData/DR
+"""
+import argparse
+import multiprocessing as mp
+from pathlib import Path
+from typing import Dict, Iterable, List
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from .access import writable
+
+INDEX_NAME = "epochindex"
+GENERATION_NAME = "generation"
+STR_DTYPE = h5py.string_dtype()
+
+# BOOL COLUMNS WITH MISSING VALUES ARE STORED AS INT8, MISSING AS -1
+MISSING_BOOL = -1
+
+
+def epoch_names(experiment: h5py.Group) -> List[str]:
+    return [name for name in experiment if name.startswith("epoch")]
+
+
+def _is_number(val) -> bool:
+    return isinstance(val, (int, float, np.integer, np.floating)) and not isinstance(val, (bool, np.bool_))
+
+
+def _is_bool(val) -> bool:
+    return isinstance(val, (bool, np.bool_))
+
+
+def _is_missing(val) -> bool:
+    return val is None or (isinstance(val, float) and np.isnan(val))
+
+
+def _to_str(val) -> str:
+    if val is None:
+        return ""
+    if isinstance(val, bytes):
+        return val.decode()
+    return str(val)
+
+
+def column_dtype(values: List) -> np.dtype:
+    """Index dtype of a column, None for epochs without the attribute. Types match the params table
+    read from the attributes: ints stay int64 and bools bool, unless values are missing, when ints
+    become float64 (nan) and bools int8 (MISSING_BOOL). Other numbers are float64 (nan), everything
+    else a string ("")."""
+    present = [val for val in values if not _is_missing(val)]
+    missing = len(present) < len(values)
+    if len(present) > 0 and all(_is_bool(val) for val in present):
+        return np.dtype(np.int8) if missing else np.dtype(np.bool_)
+    if all(_is_number(val) for val in present):
+        if len(present) > 0 and not missing and all(isinstance(val, (int, np.integer)) for val in present):
+            return np.dtype(np.int64)
+        return np.dtype(np.float64)
+    return STR_DTYPE
+
+
+def column_values(values: List, dtype: np.dtype) -> List:
+    """values in the column's dtype with missing values filled in"""
+    if dtype is STR_DTYPE:
+        return [_to_str(None if _is_missing(val) else val) for val in values]
+    if dtype == np.int8:
+        return [MISSING_BOOL if _is_missing(val) else int(val) for val in values]
+    if dtype == np.float64:
+        return [np.nan if _is_missing(val) else val for val in values]
+    return values
+
+
+def build_index(experiment: h5py.Group) -> np.array:
+    """Structured array of scalar epoch attributes, see column_dtype for the column types"""
+    names = epoch_names(experiment)
+    records = []
+    for name in names:
+        attrs = {
+            key: val for key, val in experiment[name].attrs.items()
+            if np.ndim(val) == 0}
+        attrs["number"] = int(name[5:])
+        records.append(attrs)
+
+    columns = list(dict.fromkeys(key for record in records for key in record))
+    values = {column: [record.get(column) for record in records] for column in columns}
+    dtypes = [(column, column_dtype(values[column])) for column in columns]
+
+    index = np.empty(len(records), dtype=dtypes)
+    for column, dtype in dtypes:
+        index[column] = column_values(values[column], dtype)
+    return index
+
+
+def generation(h5file: h5py.File) -> int:
+    """Counter bumped by every edit of the file's epoch attributes, 0 if it was never edited"""
+    return int(h5file["experiment"].attrs.get(GENERATION_NAME, 0))
+
+
+def mark_edited(h5file: h5py.File) -> bool:
+    """Bump the generation before editing epoch attributes, so the index reads as stale until it is
+    brought up to date. Returns whether the index was up to date before the edit."""
+    current = has_index(h5file)
+    h5file["experiment"].attrs[GENERATION_NAME] = generation(h5file) + 1
+    return current
+
+
+def _stamp(h5file: h5py.File) -> None:
+    h5file[INDEX_NAME].attrs[GENERATION_NAME] = generation(h5file)
+
+
+def write_index(h5file: h5py.File) -> None:
+    """Build or rebuild the epoch index from the epoch group attributes"""
+    index = build_index(h5file["experiment"])
+    if INDEX_NAME in h5file:
+        del h5file[INDEX_NAME]
+    h5file.create_dataset(INDEX_NAME, data=index)
+    _stamp(h5file)
+
+
+def has_index(h5file: h5py.File) -> bool:
+    """Index exists and was built at the file's current generation"""
+    if INDEX_NAME not in h5file:
+        return False
+    return h5file[INDEX_NAME].attrs.get(GENERATION_NAME) == generation(h5file)
+
+
+def refresh_index(h5file: h5py.File) -> None:
+    """Rebuild the index after bulk attribute edits, only if the file already has one"""
+    if INDEX_NAME in h5file:
+        write_index(h5file)
+
+
+def _fits(dtype: np.dtype, value: object) -> bool:
+    """Whether value can be written into a column of dtype without changing the column's type"""
+    if dtype is STR_DTYPE:
+        return not (_is_number(value) or _is_bool(value))
+    if dtype == np.float64:
+        return _is_number(value)
+    if dtype == np.int64:
+        return isinstance(value, (int, np.integer)) and not _is_bool(value)
+    return _is_bool(value)
+
+
+def update_index(h5file: h5py.File, numbers: Iterable[int], paramname: str, value: object, current: bool = None) -> None:
+    """Keep an existing index in step with an attribute edit. Rebuilds when the column type changes
+    or the index was already stale.
+
+    Args:
+        current (bool, optional): What mark_edited returned before the edit. Without it an index
+            marked as edited can't be told from a stale one and is rebuilt.
+    """
+    if not (has_index(h5file) if current is None else current):
+        refresh_index(h5file)
+        return
+    ds = h5file[INDEX_NAME]
+    index = ds[:]
+    if paramname not in index.dtype.names:
+        write_index(h5file)
+        return
+
+    dtype = STR_DTYPE if h5py.check_string_dtype(index.dtype[paramname]) is not None else index.dtype[paramname]
+    if not _fits(dtype, value):
+        write_index(h5file)
+        return
+
+    mask = np.isin(index["number"], list(numbers))
+    index[paramname][mask] = column_values([value], dtype)[0]
+    ds[...] = index
+    _stamp(h5file)
+
+
+def update_index_columns(h5file: h5py.File, numbers: Iterable[int], columns: Dict[str, np.array], current: bool = None) -> None:
+    """Keep an existing index in step with per epoch numeric edits, one value per number in each column.
+    Rebuilds when a column is missing or isn't numeric, or the index was already stale. current is
+    as in update_index."""
+    if not (has_index(h5file) if current is None else current):
+        refresh_index(h5file)
+        return
+    ds = h5file[INDEX_NAME]
+    index = ds[:]
+    for paramname in columns:
+        if paramname not in index.dtype.names or index.dtype[paramname] != np.float64:
+            write_index(h5file)
+            return
+
+    rows = {number: ii for ii, number in enumerate(index["number"])}
+    positions = np.array([rows[number] for number in numbers], dtype=int)
+    for paramname, values in columns.items():
+        index[paramname][positions] = values
+    ds[...] = index
+    _stamp(h5file)
+
+
+def read_index(h5file: h5py.File) -> pd.DataFrame:
+    """Epoch index as a DataFrame. None if the file has no up to date index."""
+    if not has_index(h5file):
+        return None
+    return index_to_frame(h5file[INDEX_NAME][:])
+
+
+def index_to_frame(index: np.array) -> pd.DataFrame:
+    """Structured index array as a DataFrame. Empty strings and missing bools become None."""
+    df = pd.DataFrame(index)
+    for column in index.dtype.names:
+        if h5py.check_string_dtype(index.dtype[column]) is not None:
+            df[column] = [
+                val.decode() if isinstance(val, bytes) else val
+                for val in df[column].values]
+            df.loc[df[column] == "", column] = None
+        elif index.dtype[column] == np.int8:
+            df[column] = pd.Series(
+                [None if val == MISSING_BOOL else bool(val) for val in df[column].values], dtype=object)
+    return df
+
+
+def index_file(filepath: Path) -> str:
+    with writable(filepath) as f:
+        write_index(f)
+        return f"{filepath}: {f[INDEX_NAME].shape[0]}"
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Add or rebuild the epoch index of dissonance files.")
+    parser.add_argument("paths", type=Path, nargs="+", help="Dissonance files or directories of them.")
+    parser.add_argument("--nprocesses", type=int, default=5)
+    ns = parser.parse_args(args)
+
+    filepaths = []
+    for path in ns.paths:
+        filepaths.extend(path.glob("*.h5") if path.is_dir() else [path])
+
+    with mp.Pool(processes=ns.nprocesses) as p:
+        for msg in p.imap_unordered(index_file, filepaths):
+            print(msg)
+
+
+if __name__ == "__main__":
+    main()
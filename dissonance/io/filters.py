@@ -0,0 +1,128 @@
+"""
+Filter expressions for parameter scans.
+
+Filters are a dict of attribute name to condition. A plain value is an
+equality check, None a null check and a list, tuple or set an "in" check.
+The classes below cover the rest:
+
+    filters = dict(
+        protocolname="LedPulse",
+        led=["UV LED", "Green LED"],
+        lightmean=Range(100, 1000),
+        genotype=NotEqual("PleaseAddGenotype"),
+        ndf=NotNull())
+
+Conditions are evaluated on whole attribute columns at once, so scans only
+build rows for matching epochs.
+"""
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+class Filter(ABC):
+
+    @abstractmethod
+    def mask(self, values: pd.Series) -> np.array:
+        """Boolean array, True where values match"""
+        ...
+
+    def match(self, value) -> bool:
+        return bool(self.mask(pd.Series([value], dtype=object))[0])
+
+
+@dataclass(frozen=True)
+class Equal(Filter):
+    """Equality check. Equal(None) only matches None, or the empty string missing strings are stored
+    as in epoch indexes, not nan. Use IsNull to match both."""
+    value: object
+
+    def mask(self, values: pd.Series) -> np.array:
+        if self.value is None:
+            if values.dtype != object:
+                return np.zeros(values.shape[0], dtype=bool)
+            return np.fromiter(
+                (val is None or (isinstance(val, (str, bytes)) and len(val) == 0) for val in values.values),
+                dtype=bool, count=values.shape[0])
+        return (values == self.value).values
+
+
+@dataclass(frozen=True)
+class NotEqual(Filter):
+    value: object
+
+    def mask(self, values: pd.Series) -> np.array:
+        return ~Equal(self.value).mask(values)
+
+
+@dataclass(frozen=True)
+class In(Filter):
+    values: Tuple
+
+    def __init__(self, values: Iterable):
+        object.__setattr__(self, "values", tuple(values))
+
+    def mask(self, values: pd.Series) -> np.array:
+        options = [val for val in self.values if val is not None]
+        mask = values.isin(options).values
+        if len(options) < len(self.values):
+            mask |= values.isna().values
+        return mask
+
+
+@dataclass(frozen=True)
+class Range(Filter):
+    """Numeric range, bounds are inclusive by default. Missing and non numeric values don't match."""
+    low: float = None
+    high: float = None
+    inclusive: bool = True
+
+    def mask(self, values: pd.Series) -> np.array:
+        numbers = pd.to_numeric(values, errors="coerce").values.astype(float)
+        mask = ~np.isnan(numbers)
+        if self.low is not None:
+            mask &= (numbers >= self.low) if self.inclusive else (numbers > self.low)
+        if self.high is not None:
+            mask &= (numbers <= self.high) if self.inclusive else (numbers < self.high)
+        return mask
+
+
+@dataclass(frozen=True)
+class IsNull(Filter):
+
+    def mask(self, values: pd.Series) -> np.array:
+        return values.isna().values
+
+
+@dataclass(frozen=True)
+class NotNull(Filter):
+
+    def mask(self, values: pd.Series) -> np.array:
+        return values.notna().values
+
+
+def as_filter(condition) -> Filter:
+    if isinstance(condition, Filter):
+        return condition
+    if condition is None:
+        return IsNull()
+    if isinstance(condition, (list, tuple, set, frozenset)):
+        return In(condition)
+    return Equal(condition)
+
+
+def compile_filters(filters: Dict) -> List[Tuple[str, Filter]]:
+    filters = dict() if filters is None else filters
+    return [(key, as_filter(condition)) for key, condition in filters.items()]
+
+
+def filter_mask(columns: Dict[str, pd.Series], filters: Dict, n: int) -> np.array:
+    """Rows of n matching every filter. Attributes missing from columns are treated as null."""
+    mask = np.ones(n, dtype=bool)
+    for key, condition in compile_filters(filters):
+        values = columns[key] if key in columns else pd.Series([None] * n, dtype=object)
+        mask &= condition.mask(values)
+    return mask
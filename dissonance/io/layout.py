@@ -0,0 +1,204 @@
+"""
+Storage layout of trace and spike datasets in dissonance files.
+
+Traces are written contiguous and uncompressed by default. A StorageLayout
+sets chunking, the built-in h5py filters (gzip/lzf with shuffle) and the
+trace dtype. Existing files can be rewritten with repack and layouts
+compared with benchmark_layouts.
+
+    python -m dissonance.io.layout repack in.h5 out.h5 --compression lzf --shuffle
+    python -m dissonance.io.layout benchmark in.h5 --workdir /tmp/layouts
+"""
+import argparse
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from ..epochtypes import SpikeEpochs, WholeEpochs, epoch_factory
+
+TRACE_DATASETS = ("Amp1",)
+SPIKE_DATASETS = ("Spikes",)
+
+
+@dataclass
+class StorageLayout:
+    """
+    Args:
+        chunks (int, optional): Samples per chunk. None is contiguous unless a filter needs chunks.
+        compression (str, optional): "gzip" or "lzf".
+        compression_opts (int, optional): gzip level 0-9.
+        shuffle (bool, optional): Byte shuffle before compressing.
+        tracedtype (str, optional): dtype of trace datasets. Spikes are always float64.
+    """
+    chunks: int = None
+    compression: str = None
+    compression_opts: int = None
+    shuffle: bool = False
+    tracedtype: str = "float64"
+
+    def __str__(self):
+        parts = [self.tracedtype]
+        if self.chunks is not None:
+            parts.append(f"chunks={self.chunks}")
+        if self.compression is not None:
+            parts.append(self.compression if self.compression_opts is None else f"{self.compression}{self.compression_opts}")
+        if self.shuffle:
+            parts.append("shuffle")
+        return "_".join(parts)
+
+    @property
+    def is_contiguous(self) -> bool:
+        return self.chunks is None and self.compression is None and not self.shuffle
+
+    def dataset_kwargs(self, n: int, trace: bool = True) -> Dict:
+        """Keyword arguments to h5py create_dataset for a dataset of n values"""
+        kwargs = dict(dtype=self.tracedtype if trace else float)
+        # FILTERS NEED CHUNKED STORAGE, EMPTY DATASETS CAN'T BE CHUNKED
+        if n == 0 or self.is_contiguous:
+            return kwargs
+        if self.chunks is not None:
+            kwargs["chunks"] = (min(self.chunks, n),)
+        if self.compression is not None:
+            kwargs["compression"] = self.compression
+            kwargs["compression_opts"] = self.compression_opts
+        kwargs["shuffle"] = self.shuffle
+        return kwargs
+
+
+DEFAULT_LAYOUT = StorageLayout()
+
+
+def _copy_attrs(src, dst):
+    for key, val in src.attrs.items():
+        dst.attrs[key] = val
+
+
+def _repack_group(src: h5py.Group, dst: h5py.Group, layout: StorageLayout):
+    _copy_attrs(src, dst)
+    for name, member in src.items():
+        if isinstance(member, h5py.Dataset) and name in (*TRACE_DATASETS, *SPIKE_DATASETS):
+            values = member[:]
+            ds = dst.create_dataset(
+                name, data=values,
+                **layout.dataset_kwargs(len(values), trace=name in TRACE_DATASETS))
+            _copy_attrs(member, ds)
+        elif isinstance(member, h5py.Group):
+            _repack_group(member, dst.create_group(name), layout)
+        else:
+            src.copy(member, dst, name=name)
+
+
+def repack(inputpath: Path, outputpath: Path, layout: StorageLayout) -> None:
+    """Rewrite a dissonance file with trace and spike datasets stored in layout"""
+    with h5py.File(inputpath, "r") as fin, h5py.File(outputpath, "w") as fout:
+        _repack_group(fin, fout, layout)
+
+
+def _time_reads(filepath: Path, nepochs: int = None) -> Dict:
+    with h5py.File(filepath, "r") as f:
+        experiment = f["experiment"]
+        names = [name for name in experiment if name.startswith("epoch")][:nepochs]
+        epochs = [epoch_factory(experiment[name]) for name in names]
+
+        start = time.perf_counter()
+        for epoch in epochs:
+            epoch.trace
+        epochtime = (time.perf_counter() - start) / max(len(epochs), 1)
+
+        blocktimes = []
+        for tracetype, blocktype in (("spiketrace", SpikeEpochs), ("wholetrace", WholeEpochs)):
+            block = [epoch for epoch in epochs if epoch.tracetype == tracetype]
+            if len(block) > 0:
+                start = time.perf_counter()
+                blocktype(block).traces
+                blocktimes.append(time.perf_counter() - start)
+
+    return dict(
+        nepochs=len(epochs),
+        epoch_trace_ms=epochtime * 1e3,
+        block_traces_ms=sum(blocktimes) * 1e3)
+
+
+def benchmark_layouts(filepath: Path, layouts: List[StorageLayout], workdir: Path, nepochs: int = None) -> pd.DataFrame:
+    """Repack filepath into each layout and report file size against read latency.
+
+    Args:
+        filepath (Path): Dissonance file to benchmark.
+        layouts (List[StorageLayout]): Layouts to compare.
+        workdir (Path): Directory for repacked copies. Put it on the share being tested.
+        nepochs (int, optional): Only time the first nepochs epochs.
+
+    Returns:
+        pd.DataFrame: layout, size_mb, epoch_trace_ms (mean IEpoch.trace) and block_traces_ms (EpochBlock.traces).
+    """
+    workdir = Path(workdir)
+    workdir.mkdir(parents=True, exist_ok=True)
+
+    data = []
+    for layout in layouts:
+        outputpath = workdir / f"{Path(filepath).stem}_{layout}.h5"
+        repack(filepath, outputpath, layout)
+        row = dict(layout=str(layout), size_mb=outputpath.stat().st_size / 1e6)
+        row.update(_time_reads(outputpath, nepochs))
+        data.append(row)
+
+    return pd.DataFrame.from_dict(data)
+
+
+BENCHMARK_LAYOUTS = [
+    StorageLayout(),
+    StorageLayout(tracedtype="float32"),
+    StorageLayout(chunks=10000),
+    StorageLayout(compression="lzf", shuffle=True),
+    StorageLayout(compression="gzip", compression_opts=4, shuffle=True),
+    StorageLayout(compression="lzf", shuffle=True, tracedtype="float32"),
+    StorageLayout(compression="gzip", compression_opts=4, shuffle=True, tracedtype="float32"),
+]
+
+
+def add_layout_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--chunks", type=int, default=None)
+    parser.add_argument("--compression", choices=["gzip", "lzf"], default=None)
+    parser.add_argument("--compression-opts", type=int, default=None)
+    parser.add_argument("--shuffle", action="store_true")
+    parser.add_argument("--tracedtype", choices=["float64", "float32"], default="float64")
+
+
+def layout_from_args(ns: argparse.Namespace) -> StorageLayout:
+    return StorageLayout(
+        chunks=ns.chunks,
+        compression=ns.compression,
+        compression_opts=ns.compression_opts,
+        shuffle=ns.shuffle,
+        tracedtype=ns.tracedtype)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Repack or benchmark dissonance file storage layouts.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    repackparser = subparsers.add_parser("repack")
+    repackparser.add_argument("inputpath", type=Path)
+    repackparser.add_argument("outputpath", type=Path)
+    add_layout_arguments(repackparser)
+
+    benchparser = subparsers.add_parser("benchmark")
+    benchparser.add_argument("inputpath", type=Path)
+    benchparser.add_argument("--workdir", type=Path, default=Path("layouts"))
+    benchparser.add_argument("--nepochs", type=int, default=None)
+
+    ns = parser.parse_args(args)
+    if ns.command == "repack":
+        repack(ns.inputpath, ns.outputpath, layout_from_args(ns))
+    else:
+        df = benchmark_layouts(ns.inputpath, BENCHMARK_LAYOUTS, ns.workdir, ns.nepochs)
+        print(df.to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
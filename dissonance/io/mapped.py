@@ -0,0 +1,66 @@
+"""
+Memory mapped trace access.
+
+Uncompressed, contiguous datasets are stored as one run of bytes in the file,
+so they can be read as a numpy view over a read only memory map of the file
+instead of being copied out through HDF5. Repeated reads of a trace are then
+free and the page cache is shared by every process mapping the same file.
+
+Only files opened read only are mapped. Chunked, compressed, virtual and
+external datasets, and datasets not yet written, are read through h5py as
+usual. Set DISSONANCE_MMAP=0 to turn mapping off.
+"""
+import mmap
+import os
+from typing import Dict, Tuple
+
+import h5py
+import numpy as np
+
+MMAP_ENV = "DISSONANCE_MMAP"
+
+_MAPS: Dict[Tuple[str, int], Tuple[h5py.h5f.FileID, mmap.mmap]] = dict()
+
+
+def enabled() -> bool:
+    return os.environ.get(MMAP_ENV, "1") != "0"
+
+
+def is_mappable(ds: h5py.Dataset) -> bool:
+    """Dataset is stored as plain contiguous bytes in a read only file on disk"""
+    if ds.file.mode != "r" or ds.file.driver != "sec2":
+        return False
+    if ds.chunks is not None or ds.is_virtual or ds.external is not None:
+        return False
+    if ds.dtype.kind not in "biuf":
+        return False
+    return ds.id.get_offset() is not None
+
+
+def _file_map(h5file: h5py.File) -> mmap.mmap:
+    key = (h5file.filename, h5file.id.id)
+    cached = _MAPS.get(key)
+    # IDS CAN BE REUSED ONCE A FILE IS CLOSED
+    if cached is None or not cached[0].valid:
+        for stale in [other for other, (fileid, _) in _MAPS.items() if not fileid.valid]:
+            del _MAPS[stale]
+        with open(h5file.filename, "rb") as fin:
+            cached = (h5file.id, mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ))
+        _MAPS[key] = cached
+    return cached[1]
+
+
+def dataset_view(ds: h5py.Dataset) -> np.array:
+    """Read only view of a dataset over the mapped file, None if it can't be mapped"""
+    if not enabled() or not is_mappable(ds):
+        return None
+    # OFFSETS ARE RELATIVE TO THE END OF THE USER BLOCK
+    offset = ds.file.userblock_size + ds.id.get_offset()
+    count = int(np.prod(ds.shape))
+    values = np.frombuffer(_file_map(ds.file), dtype=ds.dtype, count=count, offset=offset)
+    return values.reshape(ds.shape)
+
+
+def clear_cache() -> None:
+    """Drop cached maps. Views already handed out keep their map alive."""
+    _MAPS.clear()
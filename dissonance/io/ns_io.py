@@ -4,6 +4,8 @@ from typing import Dict, List
 
 import h5py
 
+from . import epochindex
+
 
 def read_unchecked_file(filepath:Path):
     """Read start dates to exclude. Header is startdate"""
@@ -23,17 +25,23 @@ def add_attributes(filename: str, searchon: List, paramname: str, attrs: Dict) -
     """
     f = h5py.File(filename, "a")
     experiment = f["experiment"]
-    for epoch in experiment:
+    epochindex.mark_edited(f)
+    for name in epochindex.epoch_names(experiment):
+        epoch = experiment[name]
         key = "_".join(map(str,
                            [epoch.attrs[search]
                             for search in searchon]))
         epoch.attrs[paramname] = attrs.get(key)
+    # KEEP THE EPOCH INDEX IN STEP WITH THE EDIT
+    epochindex.refresh_index(f)
     f.close()
 
 
 def add_genotype(filename, genotype):
     f = h5py.File(filename, "a")
     experiment = f["experiment"]
-    for epoch in experiment:
+    epochindex.mark_edited(f)
+    for epoch in epochindex.epoch_names(experiment):
         f[f"experiment/{epoch}"].attrs["genotype"] = genotype
+    epochindex.refresh_index(f)
     f.close()
\ No newline at end of file
@@ -0,0 +1,274 @@
+"""
+Packed trace layout for dissonance files.
+
+All traces of a file are concatenated into one dataset, as are all spike
+times, with an offset table giving each epoch's start and length. Reading a
+block of epochs is then a handful of large range reads instead of one
+dataset open and read per epoch. The datasets are chunked and resizable so
+epochs converted later are appended without rewriting the rest.
+
+    python -m dissonance.io.packed MappedData/WT --drop
+"""
+import argparse
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
+
+import h5py
+import numpy as np
+
+from . import mapped
+from .access import writable
+
+PACKED_NAME = "packed"
+OFFSETS_DTYPE = np.dtype([
+    ("number", np.int64),
+    ("traceoffset", np.int64),
+    ("tracelength", np.int64),
+    ("spikeoffset", np.int64),
+    ("spikelength", np.int64)])
+
+# GAP IN SAMPLES BELOW WHICH TWO RANGES ARE READ TOGETHER
+COALESCE_GAP = 20000
+
+# SAMPLES PER CHUNK OF THE RESIZABLE PACKED DATASETS
+PACK_CHUNKS = 2 ** 16
+
+_CACHE: Dict[Tuple[str, int], Tuple[h5py.h5f.FileID, "PackedTraces"]] = dict()
+
+
+class PackedTraces:
+    """Offset table and concatenated trace and spike datasets of one file"""
+
+    def __init__(self, group: h5py.Group):
+        self.group = group
+        self.table = group["offsets"][:]
+        self.rows = {int(number): ii for ii, number in enumerate(self.table["number"])}
+        self._traces: h5py.Dataset = group["traces"]
+        self._spikes: h5py.Dataset = group["spikes"]
+        # MAPPED VIEWS IF THE FILE IS READ ONLY AND UNCOMPRESSED, OTHERWISE READ THROUGH H5PY
+        self._tracevalues = mapped.dataset_view(self._traces)
+        self._spikevalues = mapped.dataset_view(self._spikes)
+
+    def __contains__(self, number: int) -> bool:
+        return number in self.rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def trace(self, number: int) -> np.array:
+        row = self.table[self.rows[number]]
+        start = row["traceoffset"]
+        if self._tracevalues is not None:
+            return self._tracevalues[start:start + row["tracelength"]]
+        return self._traces[start:start + row["tracelength"]]
+
+    def spikes(self, number: int) -> np.array:
+        row = self.table[self.rows[number]]
+        if row["spikelength"] < 0:
+            return None
+        start = row["spikeoffset"]
+        if self._spikevalues is not None:
+            return self._spikevalues[start:start + row["spikelength"]]
+        return self._spikes[start:start + row["spikelength"]]
+
+    def read_traces(self, numbers: Iterable[int], out: np.array) -> np.array:
+        """Fill row ii of out with the trace of numbers[ii]. Traces longer than out are cut, shorter are zero padded.
+
+        Epochs are sorted by offset and ranges closer than COALESCE_GAP are read together.
+
+        Returns:
+            np.array: Number of values filled in each row.
+        """
+        rows = self.table[[self.rows[number] for number in numbers]]
+        order = np.argsort(rows["traceoffset"], kind="stable")
+        width = out.shape[1]
+        lengths = np.minimum(rows["tracelength"], width)
+
+        for ranges in self._coalesce(rows, order):
+            start = rows["traceoffset"][ranges[0]]
+            stop = max(rows["traceoffset"][ii] + rows["tracelength"][ii] for ii in ranges)
+            values = (self._traces if self._tracevalues is None else self._tracevalues)[start:stop]
+            for ii in ranges:
+                offset = rows["traceoffset"][ii] - start
+                n = lengths[ii]
+                out[ii, :n] = values[offset:offset + n]
+                out[ii, n:] = 0.0
+        return lengths
+
+    def read_spikes(self, numbers: Iterable[int]) -> Tuple[np.array, np.array]:
+        """Spike indices of numbers concatenated in order, from one read spanning their ranges.
+
+        Returns:
+            Tuple[np.array, np.array]: Concatenated int spike indices and the number of spikes of each
+                epoch. Epochs without spikes have none.
+        """
+        rows = self.table[[self.rows[number] for number in numbers]]
+        lengths = np.maximum(rows["spikelength"], 0)
+        total = int(lengths.sum())
+        if total == 0:
+            return np.zeros(0, dtype=np.int64), lengths
+
+        offsets = rows["spikeoffset"][lengths > 0]
+        start = int(offsets.min())
+        stop = int((rows["spikeoffset"] + lengths)[lengths > 0].max())
+        values = (self._spikes if self._spikevalues is None else self._spikevalues)[start:stop]
+
+        # POSITION OF EVERY SPIKE IN THE SPAN READ
+        starts = np.cumsum(lengths) - lengths
+        positions = np.arange(total) + np.repeat(rows["spikeoffset"] - start - starts, lengths)
+        return np.asarray(values[positions], dtype=np.int64), lengths
+
+    @staticmethod
+    def _coalesce(rows: np.array, order: np.array) -> List[List[int]]:
+        groups = []
+        end = None
+        for ii in order:
+            start = rows["traceoffset"][ii]
+            if end is None or start - end > COALESCE_GAP:
+                groups.append([ii])
+            else:
+                groups[-1].append(ii)
+            end = max(start + rows["tracelength"][ii], end or 0)
+        return groups
+
+
+def read_packed(h5file: h5py.File) -> PackedTraces:
+    """Packed traces of an open file, None if the file isn't packed. Cached per open file."""
+    key = (h5file.filename, h5file.id.id)
+    cached = _CACHE.get(key)
+    # IDS CAN BE REUSED ONCE A FILE IS CLOSED
+    if cached is None or not cached[0].valid:
+        # DROP READERS OF FILES CLOSED SINCE, SO REOPENED FILES DON'T ACCUMULATE
+        for stale in [other for other, (fileid, _) in _CACHE.items() if not fileid.valid]:
+            del _CACHE[stale]
+        cached = (
+            h5file.id,
+            PackedTraces(h5file[PACKED_NAME]) if PACKED_NAME in h5file else None)
+        _CACHE[key] = cached
+    return cached[1]
+
+
+def clear_cache() -> None:
+    _CACHE.clear()
+
+
+def _append(ds: h5py.Dataset, values: np.array) -> None:
+    n = ds.shape[0]
+    ds.resize((n + len(values),))
+    ds[n:] = values
+
+
+def _is_appendable(group: h5py.Group) -> bool:
+    return all(group[name].maxshape[0] is None for name in ("offsets", "traces", "spikes"))
+
+
+def _trace_dtype(experiment: h5py.Group, numbers: List[int]) -> np.dtype:
+    for number in numbers:
+        epochgrp = experiment[f"epoch{number}"]
+        if "Amp1" in epochgrp:
+            return epochgrp["Amp1"].dtype
+    return np.dtype(float)
+
+
+def _create_group(h5file: h5py.File, name: str, tracedtype: np.dtype, chunks: int) -> h5py.Group:
+    grp = h5file.create_group(name)
+    grp.create_dataset("offsets", shape=(0,), maxshape=(None,), dtype=OFFSETS_DTYPE, chunks=True)
+    for name, dtype in (("traces", tracedtype), ("spikes", float)):
+        grp.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dtype, chunks=(chunks,))
+    return grp
+
+
+def pack(h5file: h5py.File, drop: bool = False, chunks: int = None, rebuild: bool = False) -> None:
+    """Append every epoch's Amp1 and Spikes not yet packed to the packed group.
+
+    The packed datasets are resizable and written one epoch at a time, so packing after an append
+    only writes the new epochs and never holds more than one trace in memory. Rows of epochs no
+    longer in the file are dropped from the offset table. Packed groups with fixed size datasets,
+    written before packs were appendable, are rewritten once.
+
+    Args:
+        h5file (h5py.File): Dissonance file opened for writing.
+        drop (bool, optional): Delete the per-epoch datasets once packed. The file only shrinks after a repack.
+        chunks (int, optional): Chunk size of new packed datasets. Defaults to PACK_CHUNKS.
+        rebuild (bool, optional): Write every epoch again into a new group, for when traces were rewritten.
+            The space of the old group is only reclaimed by a repack.
+    """
+    experiment = h5file["experiment"]
+    numbers = sorted(int(name[5:]) for name in experiment if name.startswith("epoch"))
+    existing = PackedTraces(h5file[PACKED_NAME]) if PACKED_NAME in h5file else None
+    clear_cache()
+
+    def source(number, name):
+        epochgrp = experiment[f"epoch{number}"]
+        if name in epochgrp:
+            return epochgrp[name][:]
+        if existing is not None and number in existing:
+            return existing.trace(number) if name == "Amp1" else existing.spikes(number)
+        return None
+
+    if existing is not None and _is_appendable(existing.group) and not rebuild:
+        grp = existing.group
+        keep = existing.table[np.isin(existing.table["number"], numbers)]
+        todo = [number for number in numbers if number not in existing]
+    else:
+        # NEW GROUP ALONGSIDE, SWAPPED IN ONCE WRITTEN
+        newname = f"{PACKED_NAME}_new"
+        if newname in h5file:
+            del h5file[newname]
+        tracedtype = existing._traces.dtype if existing is not None else _trace_dtype(experiment, numbers)
+        grp = _create_group(h5file, newname, tracedtype, PACK_CHUNKS if chunks is None else chunks)
+        keep = np.zeros(0, dtype=OFFSETS_DTYPE)
+        todo = numbers
+
+    traces, spikes = grp["traces"], grp["spikes"]
+    table = np.zeros(len(todo), dtype=OFFSETS_DTYPE)
+    for ii, number in enumerate(todo):
+        trace = source(number, "Amp1")
+        spike = source(number, "Spikes")
+        trace = np.zeros(0) if trace is None else trace
+
+        table[ii] = (
+            number,
+            traces.shape[0], len(trace),
+            spikes.shape[0], -1 if spike is None else len(spike))
+        _append(traces, trace)
+        if spike is not None:
+            _append(spikes, spike)
+
+    table = np.concatenate([keep, table])
+    grp["offsets"].resize((len(table),))
+    grp["offsets"][:] = table
+
+    if grp.name != f"/{PACKED_NAME}":
+        if existing is not None:
+            del h5file[PACKED_NAME]
+        h5file.move(grp.name, PACKED_NAME)
+
+    if drop:
+        for number in numbers:
+            epochgrp = experiment[f"epoch{number}"]
+            for name in ("Amp1", "Spikes"):
+                if name in epochgrp:
+                    del epochgrp[name]
+
+
+def pack_file(filepath: Path, drop: bool = False, chunks: int = None) -> None:
+    with writable(filepath) as f:
+        pack(f, drop=drop, chunks=chunks)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Pack the traces of dissonance files into one dataset.")
+    parser.add_argument("paths", type=Path, nargs="+", help="Dissonance files or directories of them.")
+    parser.add_argument("--drop", action="store_true", help="Delete per-epoch Amp1 and Spikes datasets.")
+    parser.add_argument("--chunks", type=int, default=None, help=f"Samples per chunk of new packed datasets, {PACK_CHUNKS} by default.")
+    ns = parser.parse_args(args)
+
+    for path in ns.paths:
+        for filepath in (path.glob("*.h5") if path.is_dir() else [path]):
+            pack_file(filepath, drop=ns.drop, chunks=ns.chunks)
+            print(filepath)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+On disk cache of per file params tables.
+
+DissonanceReader.to_params keeps each file's table keyed on the file's
+resolved path, size and mtime and the requested paramnames and filters.
+Unchanged files are read from the cache, modified files are rescanned.
+Files with no matching epochs are cached as empty so narrow filters don't
+rescan them. Edits through DissonanceUpdater, dissonance.io.edits and
+EpochIO.update also drop the file's entries explicitly, from the cache
+directory they were given, in case an edit doesn't change size or mtime.
+
+The cache lives in $DISSONANCE_CACHE or ~/.cache/dissonance/params.
+"""
+import hashlib
+import json
+import os
+import pickle
+from pathlib import Path
+from typing import Dict, List
+
+import pandas as pd
+
+from .filters import In, as_filter
+
+CACHE_ENV = "DISSONANCE_CACHE"
+
+
+def default_cachedir() -> Path:
+    if CACHE_ENV in os.environ:
+        return Path(os.environ[CACHE_ENV])
+    return Path.home() / ".cache" / "dissonance" / "params"
+
+
+def _digest(text: str) -> str:
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def _condition_key(condition) -> str:
+    # "IN" VALUES ARE SORTED SO SETS AND REORDERED LISTS SHARE A KEY
+    condition = as_filter(condition)
+    if isinstance(condition, In):
+        condition = In(sorted(condition.values, key=repr))
+    return repr(condition)
+
+
+def fingerprint(filepath: Path) -> Dict:
+    stat = Path(filepath).stat()
+    return dict(size=stat.st_size, mtime=stat.st_mtime_ns)
+
+
+class ParamsCache:
+    """
+    Args:
+        cachedir (Path, optional): Directory of cached tables. Defaults to default_cachedir().
+    """
+
+    def __init__(self, cachedir: Path = None):
+        self.cachedir = default_cachedir() if cachedir is None else Path(cachedir)
+
+    @staticmethod
+    def paramkey(paramnames: List[str], filters: Dict) -> str:
+        filters = dict() if filters is None else filters
+        return json.dumps([list(paramnames), sorted(
+            (key, _condition_key(condition)) for key, condition in filters.items())])
+
+    def _entrypath(self, filepath: Path, paramkey: str) -> Path:
+        # PATH DIGEST FIRST SO ALL ENTRIES OF A FILE CAN BE FOUND
+        return self.cachedir / f"{_digest(str(Path(filepath).resolve()))}_{_digest(paramkey)[:16]}.pkl"
+
+    def get(self, filepath: Path, paramnames: List[str], filters: Dict) -> pd.DataFrame:
+        """Cached table if the file is unchanged, None if it had no matching epochs. Raises KeyError otherwise."""
+        paramkey = self.paramkey(paramnames, filters)
+        entrypath = self._entrypath(filepath, paramkey)
+        try:
+            with open(entrypath, "rb") as fin:
+                entry = pickle.load(fin)
+        except Exception:
+            # MISSING, PARTIAL OR WRITTEN BY AN INCOMPATIBLE PANDAS
+            raise KeyError(filepath)
+
+        if entry["fingerprint"] != fingerprint(filepath) or entry["paramkey"] != paramkey:
+            raise KeyError(filepath)
+
+        if entry.get("empty", False):
+            return None
+        df = entry["df"]
+        if df is not None:
+            df["exppath"] = filepath
+        return df
+
+    def put(self, filepath: Path, paramnames: List[str], filters: Dict, df: pd.DataFrame) -> None:
+        """Cache a file's table, None for a file with no matching epochs"""
+        paramkey = self.paramkey(paramnames, filters)
+        entrypath = self._entrypath(filepath, paramkey)
+        self.cachedir.mkdir(parents=True, exist_ok=True)
+
+        entry = dict(fingerprint=fingerprint(filepath), paramkey=paramkey, df=df, empty=df is None)
+        tmppath = entrypath.with_name(f"{entrypath.name}.{os.getpid()}.tmp")
+        with open(tmppath, "wb") as fout:
+            pickle.dump(entry, fout, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmppath, entrypath)
+
+    def invalidate(self, filepath: Path) -> None:
+        """Drop every cached table of filepath"""
+        if not self.cachedir.exists():
+            return
+        for entrypath in self.cachedir.glob(f"{_digest(str(Path(filepath).resolve()))}_*.pkl"):
+            try:
+                entrypath.unlink()
+            except FileNotFoundError:
+                ...
+
+    def clear(self) -> None:
+        if not self.cachedir.exists():
+            return
+        for entrypath in self.cachedir.glob("*.pkl"):
+            entrypath.unlink()
+
+
+def invalidate(filepath: Path, cachedir: Path = None) -> None:
+    """Drop cached tables of filepath from the cache in cachedir, the default cache if None"""
+    ParamsCache(cachedir).invalidate(filepath)
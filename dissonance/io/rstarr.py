@@ -0,0 +1,263 @@
+"""
+Calibration of light stimuli from stimulus units (SU) to R*.
+
+The calibration table (data/rstarrmap.txt) maps protocol, led, light
+amplitude and light mean in stimulus units to R*, for epochs recorded
+between startdate and enddate. It is read the first time a lookup is made,
+not when dissonance is imported.
+
+    calibration = get_calibration()
+    calibration.lookup("LedPulse", "UV LED", 0.01, 0.0, "2021-06-01 12:00:00")
+    frame = calibration.convert(paramstable)
+    calibration.unmatched(frame)
+
+Converted files store the stimulus unit settings, so the whole archive can
+be recalibrated from the dissonance files alone:
+
+    python -m dissonance.io.rstarr MappedData/WT MappedData/DR --nprocesses 6
+"""
+import argparse
+import logging
+import multiprocessing as mp
+from functools import lru_cache, partial
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from . import epochindex
+from .access import writable
+
+logger = logging.getLogger(__name__)
+
+RSTARR_PATH = Path(__file__).parent.parent.parent / "data/rstarrmap.txt"
+KEYS = ["protocolname", "led", "lightamplitude", "lightmean"]
+SETTINGS = ["protocolname", "led", "lightamplitudeSU", "lightmeanSU", "startdate"]
+
+
+def _to_timestamp(date) -> pd.Timestamp:
+    if date is None:
+        return pd.NaT
+    return pd.Timestamp(date)
+
+
+class RstarrCalibration:
+    """Indexed lookup of the R* calibration table.
+
+    Rows match on protocol name, led, amplitude and mean (exact float match) and an epoch
+    date within [startdate, enddate], the whole end day included. Epochs without a date
+    match any range. Where several rows match, the row furthest down the table wins.
+
+    Args:
+        path (Path, optional): Tab separated calibration table. Defaults to data/rstarrmap.txt.
+    """
+
+    def __init__(self, path: Path = RSTARR_PATH):
+        self.path = Path(path)
+        self._table: pd.DataFrame = None
+        self._index: Dict[Tuple, List[Tuple]] = None
+
+    @property
+    def table(self) -> pd.DataFrame:
+        if self._table is None:
+            table = pd.read_csv(
+                self.path, sep="\t",
+                parse_dates=["startdate", "enddate"],
+                dtype=dict(
+                    protocolname=str,
+                    led=str,
+                    lightamplitude=float,
+                    lightamplitude_rstarr=float,
+                    lightmean=float,
+                    lightmean_rstarr=float))
+            table["enddate"] = table["enddate"] + pd.Timedelta(days=1)
+            table["row"] = np.arange(len(table))
+            self._table = table
+            logger.debug(f"Loaded {len(table)} R* calibrations from {self.path}")
+        return self._table
+
+    @property
+    def index(self) -> Dict[Tuple, List[Tuple]]:
+        """(protocolname, led, lightamplitude, lightmean) to [(startdate, enddate, amplitude R*, mean R*)]"""
+        if self._index is None:
+            index = dict()
+            table = self.table
+            for key, start, end, amp, mean in zip(
+                    zip(*(table[column].values for column in KEYS)),
+                    table["startdate"], table["enddate"],
+                    table["lightamplitude_rstarr"].values, table["lightmean_rstarr"].values):
+                index.setdefault(key, []).append((start, end, amp, mean))
+            self._index = index
+        return self._index
+
+    def lookup(self, protocolname: str, led: str, lightamplitude: float, lightmean: float, date=None) -> Tuple[float, float]:
+        """R* amplitude and mean of a single epoch.
+
+        Args:
+            date (str or datetime, optional): Epoch start date. Ignored if None.
+
+        Returns:
+            Tuple[float, float]: (lightamplitude, lightmean) in R*, None if there is no calibration.
+        """
+        date = _to_timestamp(date)
+        candidates = self.index.get(
+            (protocolname, led, float(lightamplitude), float(lightmean)), [])
+        for start, end, amp, mean in reversed(candidates):
+            if pd.isnull(date) or start <= date < end:
+                return amp, mean
+        return None
+
+    def convert(self, frame: pd.DataFrame, amplitudecol: str = "lightamplitudeSU", meancol: str = "lightmeanSU", datecol: str = "startdate") -> pd.DataFrame:
+        """Convert every row of a params table to R* in one pass.
+
+        Args:
+            frame (pd.DataFrame): Needs protocolname, led and the amplitude and mean columns.
+            amplitudecol (str, optional): Column of light amplitudes in stimulus units.
+            meancol (str, optional): Column of light means in stimulus units.
+            datecol (str, optional): Column of epoch start dates. Not checked if missing from frame.
+
+        Returns:
+            pd.DataFrame: Copy of frame with lightamplitude and lightmean in R* (nan if unmatched)
+                and a boolean rstarrmatched column.
+        """
+        keys = pd.DataFrame({
+            "protocolname": frame["protocolname"].values,
+            "led": frame["led"].values,
+            "lightamplitude": frame[amplitudecol].astype(float).values,
+            "lightmean": frame[meancol].astype(float).values,
+            "position": np.arange(len(frame))})
+        dates = (
+            pd.to_datetime(frame[datecol].values, errors="coerce")
+            if datecol in frame.columns
+            else pd.DatetimeIndex([pd.NaT] * len(frame)))
+
+        matches = keys.merge(self.table, on=KEYS, how="inner")
+        date = dates[matches["position"].values]
+        valid = (
+            pd.isnull(date)
+            | ((matches["startdate"].values <= date) & (date < matches["enddate"].values)))
+        matches = (
+            matches.loc[np.asarray(valid)]
+            .sort_values(["position", "row"])
+            .drop_duplicates("position", keep="last"))
+
+        amplitude = np.full(len(frame), np.nan)
+        mean = np.full(len(frame), np.nan)
+        positions = matches["position"].values
+        amplitude[positions] = matches["lightamplitude_rstarr"].values
+        mean[positions] = matches["lightmean_rstarr"].values
+
+        out = frame.copy()
+        out["lightamplitude"] = amplitude
+        out["lightmean"] = mean
+        out["rstarrmatched"] = False
+        out.iloc[positions, out.columns.get_loc("rstarrmatched")] = True
+        return out
+
+    @staticmethod
+    def unmatched(converted: pd.DataFrame, amplitudecol: str = "lightamplitudeSU", meancol: str = "lightmeanSU") -> pd.DataFrame:
+        """Distinct uncalibrated stimuli in the output of convert, with the number of epochs of each"""
+        columns = ["protocolname", "led", amplitudecol, meancol]
+        rows = converted.loc[~converted["rstarrmatched"], columns]
+        return (
+            rows.groupby(columns, dropna=False)
+            .size()
+            .rename("nepochs")
+            .reset_index())
+
+
+@lru_cache(maxsize=None)
+def get_calibration(path: Path = RSTARR_PATH) -> RstarrCalibration:
+    """Shared calibration, the table is loaded on first lookup"""
+    return RstarrCalibration(path)
+
+
+def read_settings(h5file: h5py.File) -> pd.DataFrame:
+    """Stimulus unit settings of every epoch, from the epoch index if the file has one"""
+    index = epochindex.read_index(h5file)
+    if index is not None:
+        frame = pd.DataFrame({"number": index["number"].values})
+        for column in SETTINGS:
+            frame[column] = index[column].values if column in index.columns else None
+        return frame
+
+    data = []
+    experiment = h5file["experiment"]
+    for name in epochindex.epoch_names(experiment):
+        attrs = experiment[name].attrs
+        row = {column: attrs.get(column) for column in SETTINGS}
+        row["number"] = int(name[5:])
+        data.append(row)
+    return pd.DataFrame(data, columns=["number", *SETTINGS])
+
+
+def recalibrate(h5file: h5py.File, calibration: RstarrCalibration = None) -> pd.DataFrame:
+    """Rewrite lightamplitude and lightmean of every epoch from its stored stimulus unit settings.
+
+    Epochs without lightamplitudeSU or lightmeanSU (converted before they were stored) aren't touched.
+    Uncalibrated epochs are set to nan.
+
+    Args:
+        h5file (h5py.File): Dissonance file opened for writing.
+        calibration (RstarrCalibration, optional): Defaults to the shared calibration.
+
+    Returns:
+        pd.DataFrame: Settings of the updated epochs with their R* values and rstarrmatched.
+    """
+    calibration = get_calibration() if calibration is None else calibration
+    settings = read_settings(h5file)
+    settings = settings.loc[
+        settings.lightamplitudeSU.notna() & settings.lightmeanSU.notna()].reset_index(drop=True)
+    converted = calibration.convert(settings)
+
+    experiment = h5file["experiment"]
+    current = epochindex.mark_edited(h5file)
+    for number, amplitude, mean in zip(
+            converted["number"].values, converted["lightamplitude"].values, converted["lightmean"].values):
+        attrs = experiment[f"epoch{number}"].attrs
+        attrs["lightamplitude"] = amplitude
+        attrs["lightmean"] = mean
+
+    epochindex.update_index_columns(
+        h5file, converted["number"].values,
+        dict(lightamplitude=converted["lightamplitude"].values, lightmean=converted["lightmean"].values),
+        current)
+    return converted
+
+
+def recalibrate_file(filepath: Path, path: Path = RSTARR_PATH) -> Tuple[Path, int, pd.DataFrame]:
+    """Recalibrate one file. Returns the path, number of epochs updated and the unmatched stimuli."""
+    with writable(filepath) as f:
+        converted = recalibrate(f, get_calibration(path))
+    return filepath, converted.shape[0], RstarrCalibration.unmatched(converted)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Recompute R* light levels of dissonance files from the calibration table.")
+    parser.add_argument("paths", type=Path, nargs="+", help="Dissonance files or directories of them.")
+    parser.add_argument("--table", type=Path, default=RSTARR_PATH, help="Calibration table.")
+    parser.add_argument("--nprocesses", type=int, default=5)
+    ns = parser.parse_args(args)
+
+    filepaths = []
+    for path in ns.paths:
+        filepaths.extend(path.glob("*.h5") if path.is_dir() else [path])
+
+    func = partial(recalibrate_file, path=ns.table)
+    unmatched = []
+    with mp.Pool(processes=ns.nprocesses) as p:
+        for filepath, nepochs, missing in p.imap_unordered(func, filepaths):
+            print(f"{filepath}: {nepochs} epochs, {missing.nepochs.sum()} uncalibrated")
+            unmatched.append(missing)
+
+    if len(unmatched) > 0:
+        unmatched = pd.concat(unmatched)
+        if unmatched.shape[0] > 0:
+            columns = [column for column in unmatched.columns if column != "nepochs"]
+            print(unmatched.groupby(columns).nepochs.sum().reset_index().to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,40 +1,25 @@
 import datetime
 import logging
 import re
+import time
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Dict, Iterator
+from queue import Queue
+from threading import Thread
+from typing import Dict, Iterator, List, Tuple
 
 import h5py
 import numpy as np
-import pandas as pd
-from dissonance.funks import detect_spikes
-
-logger = logging.getLogger(__name__)
-
-
-fout = open("log2.txt", "w+")
-
-
-def get_rstarr_map():
-    rstarrdf = pd.read_csv(
-        Path(__file__).parent.parent.parent / "data/rstarrmap.txt", "\t",
-        parse_dates=["startdate", "enddate"],
-        dtype=dict(
-            protocolname=str,
-            led=str,
-            lightamplitude=float,
-            lightamplitude_rstarr=float,
-            lightmean=float,
-            lightmean_rstarr=float))
-    rstarrmap = dict()
-    for _, row in rstarrdf.iterrows():
-        rstarrmap[(row["protocolname"], row["led"], row["lightamplitude"], row["lightmean"])] = (
-            row["lightamplitude_rstarr"], row["lightmean_rstarr"])
-    return rstarrmap
+from dissonance.funks import detect_spikes, filter_trace
 
+from . import database, epochindex, packed
+from .access import open_readonly
+from .crawler import SymphonyCrawler
+from .layout import DEFAULT_LAYOUT, StorageLayout
+from .rstarr import get_calibration
+from .timing import ConversionTimer
 
-RSTARRMAP = get_rstarr_map()
-
+logger = logging.getLogger(__name__)
 
 S1 = np.dtype("|S1")
 
@@ -264,10 +249,51 @@ class Response:
         return f"Response({self.name})"
 
     @property
-    def data(self):
-        vals = np.array(self.group["data"][:], dtype=[
-                        ('v', '<f8'), ('units', '<U16')])
-        return vals['v']
+    def data(self) -> np.array:
+        return self.read()
+
+    @property
+    def quantityfield(self) -> str:
+        """Name of the numeric field in the compound data dataset"""
+        fields = self.group["data"].dtype.fields
+        if fields is None:
+            return None
+        for name, (dtype, _) in fields.items():
+            if dtype.kind in "fiu":
+                return name
+
+    @property
+    def units(self) -> str:
+        """Units are stored on every sample, only the first is read"""
+        ds = self.group["data"]
+        if ds.dtype.fields is None or "units" not in ds.dtype.fields or ds.shape[0] == 0:
+            return None
+        return convert_if_bytes(ds[0]["units"])
+
+    @property
+    def samplerate(self) -> float:
+        return self._parameters["samplerate"]
+
+    def read(self, out: np.array = None) -> np.array:
+        """Read only the numeric field of the data dataset straight into a float buffer.
+
+        Args:
+            out (np.array, optional): Float64 buffer to reuse. Reallocated if too small.
+
+        Returns:
+            np.array: View on the first len(response) values of the buffer.
+        """
+        ds = self.group["data"]
+        n = ds.shape[0]
+        if out is None or out.shape[0] < n:
+            out = np.empty(n, dtype=float)
+
+        field = self.quantityfield
+        if field is None:
+            ds.read_direct(out, dest_sel=np.s_[:n])
+        else:
+            ds.read_direct(out[:n].view([(field, "<f8")]))
+        return out[:n]
 
     @property
     def parameters(self) -> Dict:
@@ -308,56 +334,252 @@ class Stimulus:
             yield key, convert_if_bytes(val)
 
 
+def _timed_detect_spikes(values: np.array) -> Tuple[Tuple, float, float]:
+    """detect_spikes for the process pool, with filter and detection seconds"""
+    start = time.perf_counter()
+    filtered = filter_trace(values)
+    middle = time.perf_counter()
+    spikes = detect_spikes(values, filtered)
+    return spikes, middle - start, time.perf_counter() - middle
+
+
 class SymphonyReader:
 
-    def __init__(self, path):
+    def __init__(self, path, crawl: bool = True, timings: Path = None):
+        """
+        Args:
+            path (Path): Symphony file.
+            crawl (bool, optional): Collect epoch metadata in a single pass over the file. Otherwise the
+                Experiment, Cell, Protocol and Epoch wrappers are walked. Defaults to True.
+            timings (Path, optional): JSON lines file to append per stage timings to. See dissonance.io.timing.
+        """
         self.finpath = path
-        self.fin = h5py.File(path)
+        self.fin = open_readonly(path)
         self.exp = Experiment(self.fin)
         self.fout = None
-
-    def reader(self):
-        ii = 0
+        self.crawl = crawl
+        self._crawled: List[Tuple] = None
+        self._buffer: np.array = None
+        self.layout: StorageLayout = DEFAULT_LAYOUT
+        # (startdate, protocolname, led, lightamplitude, lightmean) OF EPOCHS WITHOUT AN R* CALIBRATION
+        self.unmatched: List[Tuple] = []
+        self.timer = ConversionTimer(timings)
+
+    def reader(self) -> Iterator[Tuple]:
+        if not self.crawl:
+            yield from self.walk()
+            return
+
+        # CRAWL ONCE, REUSED BY EVERY CONVERSION OR UPDATE
+        if self._crawled is None:
+            with self.timer.stage("crawl"):
+                self._crawled = SymphonyCrawler(self.fin).crawl()
+        yield from self._crawled
+
+    def walk(self) -> Iterator[Tuple]:
         for cell in self.exp.children:
             for protocol in cell.children:
                 for epoch in protocol.children:
                     yield cell, protocol, epoch
 
-    def to_h5(self, outputpath: Path):
+    def to_h5(self, outputpath: Path, nprocesses: int = 1, queuesize: int = 32, append: bool = False, layout: StorageLayout = None, packtraces: bool = False):
+        """Convert symphony file to dissonance file.
+
+        Args:
+            outputpath (Path): Dissonance file to write.
+            append (bool, optional): Only convert epochs missing from an existing output file.
+                Epochs are matched on their raw h5 path, existing groups aren't touched. Defaults to False.
+            layout (StorageLayout, optional): Chunking, compression and dtype of trace datasets.
+                Defaults to contiguous float64.
+            packtraces (bool, optional): Also write all traces and spikes into one packed dataset each.
+                After an append only the new epochs are added to the packed datasets.
+            nprocesses (int, optional): Processes used for spike detection. When greater than 1
+                reading, spike detection and writing run as a pipeline. Can't be used from
+                inside a daemonic pool worker. Defaults to 1.
+            queuesize (int, optional): Max traces held between the reader and writer stages.
+        """
+        mode = "a" if append else "w"
+        self.layout = DEFAULT_LAYOUT if layout is None else layout
+        self.timer.start_file("to_h5", self.finpath, outputpath)
         try:
-            self.fout = h5py.File(outputpath, mode="w")
-            expgrp = self.fout.create_group("experiment")
-            for ii, (cell, protocol, epoch) in enumerate(self.reader()):
+            if nprocesses > 1:
+                self._to_h5_pipelined(outputpath, nprocesses, queuesize, mode, packtraces)
+            else:
+                self._to_h5_serial(outputpath, mode, packtraces)
+        finally:
+            self.timer.end_file()
+
+    def _to_h5_serial(self, outputpath: Path, mode: str = "w", packtraces: bool = False):
+        try:
+            self.fout = h5py.File(outputpath, mode=mode)
+            expgrp = self.fout.require_group("experiment")
+            epochindex.mark_edited(self.fout)
+            for ii, (cell, protocol, epoch) in self._new_epochs(expgrp):
 
                 epochgrp = expgrp.create_group(f"epoch{ii}")
 
                 # ADD EPOCH ATTRIBUTES
-                self._update_attrs(protocol, cell, epoch, epochgrp)
+                with self.timer.stage("metadata", epochgrp.name):
+                    self._update_attrs(protocol, cell, epoch, epochgrp)
 
                 # ADD RESPONSE DATA - CACHE SPIKES
                 self._update_response(epoch, epochgrp)
 
                 # ADD GROUP FOR EACH STIMULUS
-                self._update_stimuli(epoch, epochgrp)
+                with self.timer.stage("metadata", epochgrp.name):
+                    self._update_stimuli(epoch, epochgrp)
 
-        except Exception as e:
+            self._finish_file(packtraces)
+
+        finally:
             if self.fout is not None:
                 self.fout.close()
-            raise e
+
+    def _finish_file(self, packtraces: bool = False):
+        with self.timer.stage("index"):
+            epochindex.write_index(self.fout)
+        if packtraces or packed.PACKED_NAME in self.fout:
+            with self.timer.stage("pack"):
+                packed.pack(self.fout)
+
+    def _to_h5_pipelined(self, outputpath: Path, nprocesses: int, queuesize: int, mode: str = "w", packtraces: bool = False):
+        """Reader stage walks the raw file and writes metadata, a process pool detects spikes
+        and a writer thread creates the response datasets. The bounded queue keeps memory flat."""
+        queue = Queue(maxsize=queuesize)
+        errors = []
+        writer = Thread(target=self._response_writer, args=(queue, errors), daemon=True)
+        try:
+            self.fout = h5py.File(outputpath, mode=mode)
+            expgrp = self.fout.require_group("experiment")
+            epochindex.mark_edited(self.fout)
+            writer.start()
+            with ProcessPoolExecutor(max_workers=nprocesses) as pool:
+                try:
+                    for ii, (cell, protocol, epoch) in self._new_epochs(expgrp):
+                        if errors:
+                            break
+
+                        epochgrp = expgrp.create_group(f"epoch{ii}")
+
+                        # ADD EPOCH ATTRIBUTES
+                        with self.timer.stage("metadata", epochgrp.name):
+                            self._update_attrs(protocol, cell, epoch, epochgrp)
+
+                        # QUEUE RESPONSE DATA - SPIKES DETECTED IN POOL
+                        isspiketrace = epoch.tracetype == "spiketrace"
+                        for response in epoch.responses:
+                            start = time.perf_counter()
+                            values = response.data
+                            self.timer.add("read", time.perf_counter() - start, epochgrp.name, values.nbytes)
+                            future = (
+                                pool.submit(_timed_detect_spikes, values)
+                                if isspiketrace else None)
+                            queue.put((epochgrp, response, values, future))
+
+                        # ADD GROUP FOR EACH STIMULUS
+                        with self.timer.stage("metadata", epochgrp.name):
+                            self._update_stimuli(epoch, epochgrp)
+                finally:
+                    queue.put(None)
+                    writer.join()
+
+            if errors:
+                raise errors[0]
+            self._finish_file(packtraces)
         finally:
-            self.fout.close()
+            if self.fout is not None:
+                self.fout.close()
+
+    def _response_writer(self, queue: Queue, errors: List):
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            if errors:
+                continue
+            epochgrp, response, values, future = item
+            try:
+                spikes = None
+                if future is not None:
+                    spikes, filterseconds, detectseconds = future.result()
+                    self.timer.add("filter", filterseconds, epochgrp.name)
+                    self.timer.add("detect", detectseconds, epochgrp.name)
+                with self.timer.stage("write", epochgrp.name, values.nbytes):
+                    self._write_response(epochgrp, response, values, spikes)
+            except Exception as e:
+                errors.append(e)
+
+    @staticmethod
+    def _epoch_names(expgrp: h5py.Group) -> Dict[str, str]:
+        """Map raw epoch path to epoch group name in the dissonance file. Groups without a path
+        can't be matched to a raw epoch and are left out."""
+        names = dict()
+        for name in expgrp:
+            path = expgrp[name].attrs.get("path") if name.startswith("epoch") else None
+            if path is not None:
+                names[path] = name
+        return names
+
+    @staticmethod
+    def _is_complete(epoch: "Epoch", epochgrp: h5py.Group, pck: packed.PackedTraces = None) -> bool:
+        """Whether every response, spike and stimulus of epoch was written to epochgrp.
+        Traces and spikes moved into the packed datasets count as written."""
+        number = int(epochgrp.name.split("/")[-1][5:])
+        inpacked = pck is not None and number in pck
+        for response in epoch.responses:
+            if response.name not in epochgrp and not (inpacked and response.name == "Amp1"):
+                return False
+        if epoch.tracetype == "spiketrace" and "Spikes" not in epochgrp:
+            if not (inpacked and pck.spikes(number) is not None):
+                return False
+        return all(stimuli.name in epochgrp for stimuli in epoch.stimuli)
+
+    def _new_epochs(self, expgrp: h5py.Group) -> Iterator[Tuple]:
+        """Epochs in the raw file that aren't already in expgrp, numbered after existing epochs.
+
+        Groups left partly written by an interrupted or failed run are deleted and converted again.
+        """
+        existing = self._epoch_names(expgrp)
+        pck = packed.read_packed(expgrp.file)
+        for cell, protocol, epoch in self.reader():
+            name = existing.get(epoch.h5name)
+            if name is not None and not self._is_complete(epoch, expgrp[name], pck):
+                logger.warning(f"Rebuilding partly written {expgrp[name].name}")
+                del expgrp[name]
+                del existing[epoch.h5name]
+
+        # NUMBER AFTER EVERY GROUP, INCLUDING ONES WITHOUT A PATH THAT WEREN'T MATCHED,
+        # AND AFTER PACKED ROWS SO A DELETED EPOCH'S NUMBER ISN'T REUSED
+        names = epochindex.epoch_names(expgrp)
+        for name in names:
+            if "path" not in expgrp[name].attrs:
+                logger.warning(f"{expgrp[name].name} has no raw epoch path, left as is")
+        numbers = [int(name[5:]) for name in names]
+        if pck is not None:
+            numbers.extend(int(number) for number in pck.table["number"])
+        ii = max(numbers) + 1 if len(numbers) > 0 else 0
+
+        for cell, protocol, epoch in self.reader():
+            if epoch.h5name in existing:
+                continue
+            yield ii, (cell, protocol, epoch)
+            ii += 1
 
     def update_metadata(self, outputpath, attrs=False, responses=False, stimuli=False):
+        self.timer.start_file("update_metadata", self.finpath, outputpath)
         try:
             self.fout = h5py.File(outputpath, mode="r+")
             expgrp = self.fout["experiment"]
+            epochindex.mark_edited(self.fout)
+            epochnames = self._epoch_names(expgrp)
             for ii, (cell, protocol, epoch) in enumerate(self.reader()):
 
-                epochgrp = expgrp[f"epoch{ii}"]
+                epochgrp = expgrp[epochnames.get(epoch.h5name, f"epoch{ii}")]
 
                 # ADD EPOCH ATTRIBUTES
                 if attrs:
-                    self._update_attrs(protocol, cell, epoch, epochgrp)
+                    with self.timer.stage("metadata", epochgrp.name):
+                        self._update_attrs(protocol, cell, epoch, epochgrp)
 
                 # ADD RESPONSE DATA - CACHE SPIKES
                 if responses:
@@ -365,22 +587,36 @@ class SymphonyReader:
 
                 # ADD GROUP FOR EACH STIMULUS
                 if stimuli:
-                    self._update_stimuli(epoch, epochgrp)
+                    with self.timer.stage("metadata", epochgrp.name):
+                        self._update_stimuli(epoch, epochgrp)
+
+            with self.timer.stage("index"):
+                epochindex.write_index(self.fout)
+            if responses and packed.PACKED_NAME in self.fout:
+                with self.timer.stage("pack"):
+                    packed.pack(self.fout, rebuild=True)
 
         except Exception as e:
             if self.fout is not None:
                 self.fout.close()
+            self.timer.end_file()
             raise e
 
         self.fout.close()
+        self.timer.end_file()
 
     def update_rstarr(self, outputpath):
+        """Re-read light settings from the raw file. If only the calibration table changed use
+        DissonanceUpdater.update_rstarr or python -m dissonance.io.rstarr, which don't need the raw file."""
+        self.timer.start_file("update_rstarr", self.finpath, outputpath)
         try:
             self.fout = h5py.File(outputpath, mode="r+")
             expgrp = self.fout["experiment"]
+            epochindex.mark_edited(self.fout)
+            epochnames = self._epoch_names(expgrp)
             for ii, (cell, protocol, epoch) in enumerate(self.reader()):
 
-                epochgrp = expgrp[f"epoch{ii}"]
+                epochgrp = expgrp[epochnames.get(epoch.h5name, f"epoch{ii}")]
                 try:
                     del epochgrp.attrs["lightamplitude"]
                 except KeyError:
@@ -398,14 +634,20 @@ class SymphonyReader:
                 except KeyError:
                     ...
 
-                self._rstarr_conversion(protocol, epoch, epochgrp)
+                with self.timer.stage("metadata", epochgrp.name):
+                    self._rstarr_conversion(protocol, epoch, epochgrp)
+
+            with self.timer.stage("index"):
+                epochindex.write_index(self.fout)
 
         except Exception as e:
             if self.fout is not None:
                 self.fout.close()
+            self.timer.end_file()
             raise e
 
         self.fout.close()
+        self.timer.end_file()
 
     def _update_stimuli(self, epoch: h5py.Group, epochgrp: h5py.Group):
         for stimuli in epoch.stimuli:
@@ -414,53 +656,82 @@ class SymphonyReader:
                 stimds.attrs[key.lower()] = val
 
     def _update_response(self, epoch: h5py.Group, epochgrp: h5py.Group):
+        isspiketrace = epoch.tracetype == "spiketrace"
         for response in epoch.responses:
-            values = response.data
-            ds = epochgrp.create_dataset(
-                name=response.name, data=values, dtype=float)
+            # REUSE READ BUFFER - VALUES ARE WRITTEN BEFORE THE NEXT READ
+            start = time.perf_counter()
+            values = response.read(out=self._buffer)
+            self._buffer = values.base
+            self.timer.add("read", time.perf_counter() - start, epochgrp.name, values.nbytes)
+
+            spikes = None
+            if isspiketrace:
+                with self.timer.stage("filter", epochgrp.name):
+                    filtered = filter_trace(values)
+                with self.timer.stage("detect", epochgrp.name):
+                    spikes = detect_spikes(values, filtered)
 
-            # for key, val in response:
-            #    ds.attrs[key] = val
+            with self.timer.stage("write", epochgrp.name, values.nbytes):
+                self._write_response(epochgrp, response, values, spikes)
 
-            ds.attrs["path"] = response.h5name
+    def _write_response(self, epochgrp: h5py.Group, response: "Response", values: np.array, spikes: Tuple = None):
+        ds = epochgrp.create_dataset(
+            name=response.name, data=values,
+            **self.layout.dataset_kwargs(len(values)))
 
-            if epoch.tracetype == "spiketrace":
-                spikes, violationidx = detect_spikes(values)
+        # for key, val in response:
+        #    ds.attrs[key] = val
 
-                spds = epochgrp.create_dataset(
-                    name="Spikes",
-                    data=spikes,
-                    dtype=float)
+        ds.attrs["path"] = response.h5name
 
-                spds.attrs["violation_idx"] = (
-                    violationidx.astype(float))
+        if spikes is not None:
+            spiketimes, violationidx = spikes
+
+            spds = epochgrp.create_dataset(
+                name="Spikes",
+                data=spiketimes,
+                **self.layout.dataset_kwargs(len(spiketimes), trace=False))
+
+            spds.attrs["violation_idx"] = (
+                violationidx.astype(float))
 
     def _update_attrs(self, protocol: h5py.Group, cell: h5py.Group, epoch: h5py.Group, epochgrp: h5py.Group):
         # ADD EPOCH ATTRIBUTES
-        epochgrp.attrs["path"] = epoch.h5name
-        epochgrp.attrs["cellname"] = cell.cellname
-        epochgrp.attrs["celltype"] = cell.celltype
-        epochgrp.attrs["genotype"] = "PleaseAddGenotype"
-        epochgrp.attrs["tracetype"] = epoch.tracetype
-        epochgrp.attrs["protocolname"] = protocol.name
-        epochgrp.attrs["startdate"] = str(epoch.startdate)
-        epochgrp.attrs["enddate"] = str(epoch.enddate)
-        epochgrp.attrs["interpulseinterval"] = protocol["interpulseInterval"]
-        epochgrp.attrs["led"] = protocol["led"]
-
-        self._rstarr_conversion(protocol, epoch, epochgrp)
-
-        epochgrp.attrs["numberofaverages"] = protocol.get(
+        for key, val in self._epoch_attrs(protocol, cell, epoch).items():
+            epochgrp.attrs[key] = val
+
+    def _epoch_attrs(self, protocol, cell, epoch) -> Dict:
+        """Attributes of a converted epoch, in the order they are written"""
+        attrs = dict()
+        attrs["path"] = epoch.h5name
+        attrs["cellname"] = cell.cellname
+        attrs["celltype"] = cell.celltype
+        attrs["genotype"] = "PleaseAddGenotype"
+        attrs["tracetype"] = epoch.tracetype
+        attrs["protocolname"] = protocol.name
+        attrs["startdate"] = str(epoch.startdate)
+        attrs["enddate"] = str(epoch.enddate)
+        attrs["interpulseinterval"] = protocol["interpulseInterval"]
+        attrs["led"] = protocol["led"]
+
+        attrs.update(self._rstarr_attrs(protocol, epoch))
+
+        attrs["numberofaverages"] = protocol.get(
             "numberOfAverages", 0.0)
-        epochgrp.attrs["pretime"] = protocol.get("preTime", 0.0)
-        epochgrp.attrs["backgroundval"] = epoch.backgrounds["Amp1"]["value"]
-        epochgrp.attrs["stimtime"] = protocol.get("stimTime", 0.0)
-        epochgrp.attrs["samplerate"] = protocol.get("sampleRate", 0.0)
-        epochgrp.attrs["tailtime"] = protocol.get("tailTime", 0.0)
-        epochgrp.attrs["ndf"] = epoch.ndf
-        epochgrp.attrs["holdingpotential"] = epoch.holdingpotential
+        attrs["pretime"] = protocol.get("preTime", 0.0)
+        attrs["backgroundval"] = epoch.backgrounds["Amp1"]["value"]
+        attrs["stimtime"] = protocol.get("stimTime", 0.0)
+        attrs["samplerate"] = protocol.get("sampleRate", 0.0)
+        attrs["tailtime"] = protocol.get("tailTime", 0.0)
+        attrs["ndf"] = epoch.ndf
+        attrs["holdingpotential"] = epoch.holdingpotential
+        return attrs
 
     def _rstarr_conversion(self, protocol, epoch, epochgrp):
+        for key, val in self._rstarr_attrs(protocol, epoch).items():
+            epochgrp.attrs[key] = val
+
+    def _rstarr_attrs(self, protocol, epoch) -> Dict:
         # SOMTIMES LIGHT AMPLITUDE IS CALLED SOMETHING ELSE
         lightamp = protocol.get("lightAmplitude", None)
         if lightamp is None:
@@ -474,19 +745,25 @@ class SymphonyReader:
             lightmean = 0.0
             logging.info(f"{str(epoch.startdate)}: no lightmean.")
 
-        epochgrp.attrs["lightamplitudeSU"] = lightamp
-        epochgrp.attrs["lightmeanSU"] = lightmean
-
-        try:
-            epochgrp.attrs["lightamplitude"], epochgrp.attrs["lightmean"] = (
-                RSTARRMAP[
-                    (protocol.name, protocol["led"], lightamp, lightmean)])
-        except KeyError:
-            logging.info(
-                f"RStarrConversionError: {','.join(map(str, (protocol.name, protocol['led'],lightamp, lightmean)))}")
-            fout.write(
-                f"RStarrConversionError,{','.join(map(str, (epoch.startdate, protocol.name, protocol['led'],lightamp, lightmean)))}\n")
-            epochgrp.attrs["lightamplitude"], epochgrp.attrs["lightmean"] = -10000, -10000
-
-    def to_db(self):
-        ...
+        rstarr = get_calibration().lookup(
+            protocol.name, protocol["led"], lightamp, lightmean, epoch.startdate)
+        if rstarr is None:
+            key = (str(epoch.startdate), protocol.name, protocol["led"], lightamp, lightmean)
+            logger.warning(f"RStarrConversionError: {','.join(map(str, key))}")
+            self.unmatched.append(key)
+            rstarr = (np.nan, np.nan)
+
+        return dict(
+            lightamplitudeSU=lightamp,
+            lightmeanSU=lightmean,
+            lightamplitude=rstarr[0],
+            lightmean=rstarr[1])
+
+    def to_db(self, dbpath: Path, genotype: str = None, spikes: bool = False, traces: bool = False, batchsize: int = 500) -> int:
+        """Export epochs to a SQLite database, see dissonance.io.database.export.
+
+        Returns:
+            int: Number of epochs exported.
+        """
+        return database.export(
+            self, dbpath, genotype=genotype, spikes=spikes, traces=traces, batchsize=batchsize)
@@ -0,0 +1,156 @@
+"""
+Per stage timing of conversions.
+
+SymphonyReader records seconds and bytes for each stage of each epoch
+(metadata, read, filter, detect, write) and of each file (crawl, index,
+pack). Records are appended to a JSON lines file, one line per epoch and
+one summary line per file, so parallel conversions can share a sink.
+
+    python -m dissonance.io.batch EPhysData MappedData --timings timings.jsonl
+    python -m dissonance.io.timing timings.jsonl --top 20
+"""
+import argparse
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List
+
+import pandas as pd
+
+STAGES = ("crawl", "metadata", "read", "filter", "detect", "write", "index", "pack")
+
+
+class ConversionTimer:
+    """Accumulate stage timings for one file at a time. Safe to use from the pipelined writer thread.
+
+    Args:
+        sink (Path, optional): JSON lines file appended to when a file finishes. Timings are
+            still accumulated without a sink and can be read from summary().
+    """
+
+    def __init__(self, sink: Path = None):
+        self.sink = None if sink is None else Path(sink)
+        self._lock = threading.Lock()
+        self._reset(None, None, None)
+
+    def _reset(self, operation: str, inputpath: Path, outputpath: Path):
+        self.operation = operation
+        self.inputpath = inputpath
+        self.outputpath = outputpath
+        self.epochs: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+        self.seconds: Dict[str, float] = defaultdict(float)
+        self.nbytes: Dict[str, int] = defaultdict(int)
+        self._start = time.perf_counter()
+
+    def start_file(self, operation: str, inputpath: Path, outputpath: Path) -> None:
+        self._reset(operation, inputpath, outputpath)
+
+    def add(self, stage: str, seconds: float, epoch: str = None, nbytes: int = 0) -> None:
+        with self._lock:
+            self.seconds[stage] += seconds
+            self.nbytes[stage] += nbytes
+            if epoch is not None:
+                record = self.epochs[epoch]
+                record[stage] += seconds
+                if nbytes:
+                    record[f"{stage}_bytes"] = int(record.get(f"{stage}_bytes", 0)) + nbytes
+
+    @contextmanager
+    def stage(self, stage: str, epoch: str = None, nbytes: int = 0) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start, epoch, nbytes)
+
+    def summary(self) -> Dict:
+        wall = time.perf_counter() - self._start
+        nbytes = self.nbytes["read"]
+        return dict(
+            kind="file",
+            operation=self.operation,
+            inputpath=str(self.inputpath),
+            outputpath=str(self.outputpath),
+            nepochs=len(self.epochs),
+            wall=wall,
+            seconds={stage: self.seconds[stage] for stage in STAGES if stage in self.seconds},
+            nbytes={stage: val for stage, val in self.nbytes.items() if val},
+            mbps=nbytes / 1e6 / wall if wall > 0 else 0.0)
+
+    def end_file(self) -> Dict:
+        """Write the epoch and file records to the sink and return the file summary"""
+        summary = self.summary()
+        if self.sink is not None:
+            lines = [
+                json.dumps(dict(
+                    kind="epoch",
+                    operation=self.operation,
+                    inputpath=str(self.inputpath),
+                    epoch=epoch,
+                    **record))
+                for epoch, record in self.epochs.items()]
+            lines.append(json.dumps(summary))
+            # ONE WRITE PER FILE SO PROCESSES SHARING THE SINK DON'T INTERLEAVE
+            with open(self.sink, "a") as fout:
+                fout.write("\n".join(lines) + "\n")
+        return summary
+
+
+def read_timings(path: Path) -> List[Dict]:
+    with open(path, "r") as fin:
+        return [json.loads(line) for line in fin if line.strip()]
+
+
+def files_frame(records: List[Dict]) -> pd.DataFrame:
+    """One row per file, one column per stage in seconds"""
+    data = []
+    for record in records:
+        if record["kind"] != "file":
+            continue
+        row = {key: record[key] for key in ("operation", "inputpath", "nepochs", "wall", "mbps")}
+        row["mb"] = record["nbytes"].get("read", 0) / 1e6
+        row.update(record["seconds"])
+        data.append(row)
+    return pd.DataFrame(data)
+
+
+def report(path: Path, top: int = 10) -> str:
+    """Total time per stage and the files taking longest"""
+    df = files_frame(read_timings(path))
+    if df.shape[0] == 0:
+        return "No file records."
+
+    stages = [stage for stage in STAGES if stage in df.columns]
+    totals = df[stages].sum()
+    stagetable = pd.DataFrame(dict(
+        seconds=totals,
+        share=totals / max(totals.sum(), 1e-9),
+        per_epoch_ms=totals / max(df.nepochs.sum(), 1) * 1e3))
+
+    lines = [
+        f"{df.shape[0]} files, {int(df.nepochs.sum())} epochs, {df.mb.sum():0.1f} MB read, "
+        f"{df.wall.sum():0.1f}s ({df.mb.sum() / max(df.wall.sum(), 1e-9):0.2f} MB/s)",
+        "",
+        stagetable.to_string(float_format=lambda x: f"{x:0.3f}"),
+        "",
+        f"Slowest {top} files:",
+        (
+            df.sort_values("wall", ascending=False)
+            .head(top)[["inputpath", "operation", "nepochs", "wall", "mbps", *stages]]
+            .to_string(index=False, float_format=lambda x: f"{x:0.2f}"))]
+    return "\n".join(lines)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Summarise conversion timings.")
+    parser.add_argument("path", type=Path, help="JSON lines written by a conversion with --timings.")
+    parser.add_argument("--top", type=int, default=10, help="Number of slowest files to list.")
+    ns = parser.parse_args(args)
+    print(report(ns.path, ns.top))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import h5py
+import pytest
+
+from dissonance.io import batch
+from dissonance.io.batch import BatchConverter
+
+
+class FakeReader:
+    """Stands in for SymphonyReader. Inputs containing "bad" fail part way through writing."""
+    converted = []
+
+    def __init__(self, inputpath, timings=None):
+        self.inputpath = inputpath
+        self.fin = h5py.File(inputpath, "r")
+
+    def to_h5(self, outputpath, **kwargs):
+        FakeReader.converted.append(self.inputpath.name)
+        with h5py.File(outputpath, "w") as f:
+            f.create_group("experiment")
+        if "bad" in self.inputpath.name:
+            raise ValueError("bad file")
+
+
+class TestBatchConverter:
+
+    @pytest.fixture(autouse=True)
+    def setup(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(batch, "SymphonyReader", FakeReader)
+        FakeReader.converted = []
+        self.rootdir = tmp_path / "EPhysData"
+        self.outputdir = tmp_path / "MappedData"
+        (self.rootdir / "WT").mkdir(parents=True)
+        for name in ("2021-09-11A.h5", "2021-09-12A.h5"):
+            self.write_input(self.rootdir / "WT" / name, 1)
+
+    @staticmethod
+    def write_input(path, n):
+        with h5py.File(path, "w") as f:
+            f.create_dataset("data", data=list(range(n)))
+
+    def run(self, **kwargs):
+        FakeReader.converted = []
+        return BatchConverter(self.rootdir, self.outputdir, nprocesses=1).run(**kwargs)
+
+    def test_resume(self):
+        assert all(result.ok for result in self.run())
+        assert sorted(FakeReader.converted) == ["2021-09-11A.h5", "2021-09-12A.h5"]
+
+        # UNCHANGED FILES ARE SKIPPED, CHANGED ONES REDONE
+        assert self.run() == []
+        self.write_input(self.rootdir / "WT" / "2021-09-12A.h5", 10)
+        self.run()
+        assert FakeReader.converted == ["2021-09-12A.h5"]
+
+        # DIFFERENT OPTIONS REDO EVERY FILE
+        self.run(packtraces=True)
+        assert len(FakeReader.converted) == 2
+        assert self.run(packtraces=True) == []
+
+    def test_failed_file_leaves_no_output(self):
+        self.write_input(self.rootdir / "WT" / "bad.h5", 1)
+        results = {result.inputpath.name: result for result in self.run()}
+        assert not results["bad.h5"].ok
+        assert not (self.outputdir / "WT" / "bad.h5").exists()
+        assert not (self.outputdir / "WT" / "bad.h5.part").exists()
+
+        # FAILED FILES AREN'T RECORDED, SO THEY ARE RETRIED
+        self.run()
+        assert FakeReader.converted == ["bad.h5"]
@@ -0,0 +1,77 @@
+import shutil
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from dissonance.io import DissonanceReader, edits, epochindex
+
+
+class TestEpochIndex:
+
+    def setup_method(self):
+        self.h5file = h5py.File("epochindex.h5", "w", driver="core", backing_store=False)
+        experiment = self.h5file.create_group("experiment")
+        for number in range(4):
+            experiment.create_group(f"epoch{number}").attrs.update(dict(
+                cellname=f"Cell{number % 2}", lightmean=float(number), tracetype="spiketrace"))
+        epochindex.write_index(self.h5file)
+
+    def teardown_method(self):
+        self.h5file.close()
+
+    def test_generation(self):
+        assert epochindex.has_index(self.h5file)
+
+        # AN EDIT STARTED BUT NEVER FINISHED LEAVES THE INDEX STALE
+        assert epochindex.mark_edited(self.h5file)
+        self.h5file["experiment/epoch0"].attrs["lightmean"] = 100.0
+        assert epochindex.read_index(self.h5file) is None
+
+        epochindex.refresh_index(self.h5file)
+        assert epochindex.read_index(self.h5file).lightmean.tolist() == [100.0, 1.0, 2.0, 3.0]
+
+        # VALUE ONLY EDITS ARE PATCHED IN WITHOUT A REBUILD
+        current = epochindex.mark_edited(self.h5file)
+        self.h5file["experiment/epoch1"].attrs["cellname"] = "Cell9"
+        epochindex.update_index(self.h5file, [1], "cellname", "Cell9", current)
+        assert epochindex.read_index(self.h5file).cellname.tolist() == ["Cell0", "Cell9", "Cell0", "Cell1"]
+        assert epochindex.generation(self.h5file) == 2
+
+    def test_edits_keep_index_current(self):
+        changes = pd.DataFrame(dict(cellname=["Cell1"], paramname=["genotype"], value=["WT"]))
+        diff = edits.plan(self.h5file, "epochindex.h5", changes)
+        edits._write(self.h5file, diff)
+        index = epochindex.read_index(self.h5file)
+        assert index.genotype.tolist() == [None, "WT", None, "WT"]
+        assert np.array_equal(index.number.values, [0, 1, 2, 3])
+
+
+class TestIndexTypes:
+
+    def test_params_match_attributes(self, tmp_path):
+        indexed, plain = tmp_path / "indexed.h5", tmp_path / "plain.h5"
+        with h5py.File(indexed, "w") as f:
+            experiment = f.create_group("experiment")
+            for number in range(3):
+                attrs = experiment.create_group(f"epoch{number}").attrs
+                attrs.update(dict(
+                    cellname="Cell1", startdate=f"2021-09-11 10:00:0{number}", tracetype="wholetrace",
+                    lightmean=float(number), numberofaverages=5, ledon=True, led="UV LED"))
+                # MISSING ON ONE EPOCH
+                if number > 0:
+                    attrs.update(dict(amp=number, flipped=number == 1, celltype="RGC"))
+            epochindex.write_index(f)
+        shutil.copy(indexed, plain)
+        with h5py.File(plain, "r+") as f:
+            del f[epochindex.INDEX_NAME]
+
+        paramnames = [
+            "cellname", "startdate", "lightmean", "numberofaverages", "ledon", "amp", "flipped", "celltype", "led"]
+        frames = [
+            DissonanceReader([path]).to_params(paramnames, dict(), nprocesses=1, usecache=False).drop(columns="exppath")
+            for path in (indexed, plain)]
+        pd.testing.assert_frame_equal(*frames)
+        assert frames[0].numberofaverages.dtype == np.int64
+        assert frames[0].ledon.dtype == bool
+        assert frames[0].flipped.tolist() == [None, True, False]
@@ -0,0 +1,68 @@
+import h5py
+import numpy as np
+
+from dissonance.epochtypes import EpochTable, SpikeEpochs, epoch_factory, table_epochs
+
+
+class TestEpochTable:
+
+    def setup_method(self):
+        self.h5file = h5py.File("epochtable.h5", "w", driver="core", backing_store=False)
+        experiment = self.h5file.create_group("experiment")
+        for number, tracetype in enumerate(["spiketrace", "wholetrace"]):
+            epochgrp = experiment.create_group(f"epoch{number}")
+            epochgrp.attrs.update(dict(
+                tracetype=tracetype, cellname="Cell1", lightamplitude=1.0, lightmean=2.0,
+                pretime=50.0, stimtime=10.0, tailtime=40.0, startdate=f"2021-09-11 10:00:0{number}"))
+            epochgrp.create_dataset("Amp1", data=np.arange(1000, dtype=float))
+        self.files = {"epochtable.h5": experiment}
+
+    def teardown_method(self):
+        self.h5file.close()
+
+    def test_handles_match_group_epochs(self):
+        table = EpochTable.from_files(self.files)
+        epochs = table_epochs(table, table.rows(["epochtable.h5"] * 2, [0, 1]))
+        for epoch in epochs:
+            other = epoch_factory(self.files["epochtable.h5"][f"epoch{epoch.number}"])
+            assert type(epoch) is type(other)
+            assert (epoch.cellname, epoch.pretime, epoch.pctcontrast) == (other.cellname, other.pretime, other.pctcontrast)
+            assert np.array_equal(epoch.trace, other.trace)
+        assert not hasattr(epochs[0], "__dict__")
+
+    def test_set_widens_column(self):
+        table = EpochTable.from_files(self.files)
+        epoch = table_epochs(table, table.rows(["epochtable.h5"], [1]))[0]
+        epoch.lightmean = "unknown"
+        assert table.value("lightmean", 1) == "unknown"
+        assert table.value("lightmean", 0) == 2.0
+
+    def test_block_params(self):
+        table = EpochTable.from_files(self.files)
+        block = SpikeEpochs(table_epochs(table, table.rows(["epochtable.h5"] * 3, [0, 0, 0])))
+        assert block.get("pretime").tolist() == [500.0] * 3
+        assert block.get_unique("cellname").tolist() == ["Cell1"]
+        assert list(block.groupby(["cellname", "lightmean"]).keys()) == [("Cell1", 2.0)]
+
+        table.set("cellname", 0, "Cell2")
+        assert block.get_unique("cellname").tolist() == ["Cell2"]
+        assert len(block.filter(cellname="Cell1")) == 0
+
+    def test_files_load_on_first_query(self):
+        other = h5py.File("other.h5", "w", driver="core", backing_store=False)
+        try:
+            experiment = other.create_group("experiment")
+            experiment.create_group("epoch0").attrs.update(dict(tracetype="spiketrace", cellname="Cell2", ledon=True))
+            table = EpochTable.from_files({**self.files, "other.h5": experiment})
+            assert len(table) == 0
+
+            rows = table.rows(["epochtable.h5"], [1])
+            assert len(table) == 2
+            epoch = table_epochs(table, rows)[0]
+
+            # ROWS HANDED OUT EARLIER STAY PUT AS FILES ARE ADDED
+            assert table.rows(["other.h5"], [0]).tolist() == [2]
+            assert (epoch.number, epoch.cellname) == (1, "Cell1")
+            assert table.value("cellname", 2) == "Cell2" and table.value("ledon", 2)
+        finally:
+            other.close()
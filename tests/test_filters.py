@@ -0,0 +1,37 @@
+import numpy as np
+import pandas as pd
+
+from dissonance.io.filters import Equal, In, IsNull, NotEqual, NotNull, Range, filter_mask
+
+
+class TestFilters:
+
+    def setup_method(self):
+        self.frame = pd.DataFrame(dict(
+            led=["UV LED", "Green LED", "UV LED", None],
+            lightmean=[0.0, 100.0, 1000.0, np.nan]))
+
+    def test_plain_values(self):
+        assert filter_mask(self.frame, dict(led="UV LED"), 4).tolist() == [True, False, True, False]
+        assert filter_mask(self.frame, dict(led=None), 4).tolist() == [False, False, False, True]
+        assert filter_mask(self.frame, dict(led=["UV LED", "Green LED"]), 4).tolist() == [True, True, True, False]
+
+    def test_expressions(self):
+        assert filter_mask(self.frame, dict(lightmean=Range(100, 1000)), 4).tolist() == [False, True, True, False]
+        assert filter_mask(self.frame, dict(lightmean=Range(low=100, inclusive=False)), 4).tolist() == [False, False, True, False]
+        assert filter_mask(self.frame, dict(led=NotEqual("UV LED")), 4).tolist() == [False, True, False, True]
+        assert filter_mask(self.frame, dict(led=In(["Green LED", None])), 4).tolist() == [False, True, False, True]
+        assert filter_mask(self.frame, dict(lightmean=NotNull()), 4).tolist() == [True, True, True, False]
+
+    def test_missing_attribute_is_null(self):
+        assert filter_mask(self.frame, dict(ndf=IsNull()), 4).all()
+        assert not filter_mask(self.frame, dict(ndf="None"), 4).any()
+
+    def test_equal_none_is_not_nan(self):
+        assert not filter_mask(self.frame, dict(lightmean=Equal(None)), 4).any()
+        assert filter_mask(self.frame, dict(lightmean=IsNull()), 4).tolist() == [False, False, False, True]
+        assert filter_mask(self.frame, dict(lightmean=NotEqual(None)), 4).all()
+
+        values = pd.Series([1.0, None, np.nan, ""], dtype=object)
+        assert Equal(None).mask(values).tolist() == [False, True, False, True]
+        assert Equal(None).match(None) and not Equal(None).match(np.nan)
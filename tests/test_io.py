@@ -1,8 +1,5 @@
-from nbformat import write
 import pytest
-from functools import partial
 import logging
-from multiprocessing import Pool
 from pathlib import Path
 
 from dissonance import epochtypes, io, viewer
@@ -43,20 +40,12 @@ class TestIO():
         root_dir = Path(r"/home/joe/Projects/DataStore/EPhysData")
         out_dir = Path(r"/home/joe/Projects/DataStore/MappedData")
         for folder in folders:
-            wdir = root_dir / folder
+            converter = io.BatchConverter(
+                root_dir / folder, out_dir / folder,
+                nprocesses=nprocesses, exclude=exclude)
+            for result in converter.run():
+                print(result)
 
-            wodir = (out_dir / folder)
-            wodir.mkdir(parents=True, exist_ok=True)
-
-            files = [file for file in wdir.glob(
-                "*.h5") if file.name not in exclude]
-            func = partial(write_file, wodir=wodir)
-
-            with Pool(nprocesses) as p:
-                for x in p.imap(func, files):
-
-                    print(x)
-    
     def test_to_h5(self):
         root_dir = Path(r"/home/joe/Projects/DataStore/EPhysData")
         out_dir = Path(r"/home/joe/Projects/DataStore/MappedData")
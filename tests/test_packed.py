@@ -0,0 +1,64 @@
+import h5py
+import numpy as np
+
+from dissonance.io import packed
+
+
+class TestPack:
+
+    def setup_method(self):
+        self.rng = np.random.default_rng(0)
+        self.h5file = h5py.File("packed.h5", "w", driver="core", backing_store=False)
+        self.experiment = self.h5file.create_group("experiment")
+        self.traces = dict()
+        for number in range(3):
+            self.add_epoch(number)
+
+    def teardown_method(self):
+        self.h5file.close()
+        packed.clear_cache()
+
+    def add_epoch(self, number):
+        epochgrp = self.experiment.create_group(f"epoch{number}")
+        self.traces[number] = self.rng.normal(size=100 + number)
+        epochgrp.create_dataset("Amp1", data=self.traces[number])
+        epochgrp.create_dataset("Spikes", data=np.arange(number, dtype=float))
+
+    def check(self):
+        pck = packed.read_packed(self.h5file)
+        assert sorted(pck.rows) == sorted(self.traces)
+        for number, trace in self.traces.items():
+            assert np.array_equal(pck.trace(number), trace)
+            assert np.array_equal(pck.spikes(number), np.arange(number))
+        # EVERY TRACE IS STORED ONCE
+        assert pck._traces.shape[0] == sum(len(trace) for trace in self.traces.values())
+
+    def test_append_only_writes_new_epochs(self):
+        packed.pack(self.h5file, drop=True)
+        self.check()
+
+        self.add_epoch(3)
+        packed.pack(self.h5file, drop=True)
+        self.check()
+
+        # EPOCHS DELETED SINCE ARE DROPPED FROM THE OFFSET TABLE
+        del self.experiment["epoch1"]
+        del self.traces[1]
+        packed.pack(self.h5file)
+        assert 1 not in packed.read_packed(self.h5file)
+
+    def test_fixed_size_packs_are_rewritten(self):
+        # PACK WRITTEN BEFORE THE DATASETS WERE RESIZABLE
+        grp = self.h5file.create_group(packed.PACKED_NAME)
+        table = np.zeros(3, dtype=packed.OFFSETS_DTYPE)
+        offset = 0
+        for number in range(3):
+            table[number] = (number, offset, len(self.traces[number]), 0, -1)
+            offset += len(self.traces[number])
+        grp.create_dataset("offsets", data=table)
+        grp.create_dataset("traces", data=np.concatenate([self.traces[number] for number in range(3)]))
+        grp.create_dataset("spikes", data=np.zeros(0))
+
+        packed.pack(self.h5file)
+        self.check()
+        assert self.h5file[packed.PACKED_NAME]["traces"].maxshape == (None,)
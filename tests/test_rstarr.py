@@ -0,0 +1,35 @@
+import pandas as pd
+
+from dissonance.io.rstarr import RstarrCalibration
+
+
+class TestRstarr:
+
+    def test_lookup(self):
+        calibration = RstarrCalibration()
+        assert calibration.lookup("LedPulse", "Green LED", 0.012, 0.0, "2021-06-01") == (10.0, 0.0)
+        assert calibration.lookup("LedPulse", "Green LED", 0.012, 0.0) == (10.0, 0.0)
+        # OUTSIDE THE CALIBRATION DATE RANGE
+        assert calibration.lookup("LedPulse", "Green LED", 0.012, 0.0, "2023-06-01") is None
+        assert calibration.lookup("LedPulse", "Red LED", 0.012, 0.0) is None
+
+    def test_convert(self):
+        calibration = RstarrCalibration()
+        frame = pd.DataFrame(dict(
+            protocolname=["LedPulse", "LedPulse", "LedPulse"],
+            led=["Green LED", "Green LED", "Red LED"],
+            lightamplitudeSU=[0.012, 0.012, 0.012],
+            lightmeanSU=[0.0, 0.0, 0.0],
+            startdate=["2021-06-01 10:00:00", "2023-06-01 10:00:00", "2021-06-01 10:00:00"]))
+
+        converted = calibration.convert(frame)
+        assert converted.rstarrmatched.tolist() == [True, False, False]
+        assert converted.lightamplitude.iloc[0] == 10.0
+        assert converted.lightamplitude.isnull().sum() == 2
+
+        for _, row in converted.iterrows():
+            expected = calibration.lookup(
+                row.protocolname, row.led, row.lightamplitudeSU, row.lightmeanSU, row.startdate)
+            assert row.rstarrmatched == (expected is not None)
+
+        assert calibration.unmatched(converted).nepochs.sum() == 2
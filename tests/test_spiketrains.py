@@ -0,0 +1,77 @@
+import h5py
+import numpy as np
+
+from dissonance.epochtypes import EpochTable, SpikeEpochs, SpikeTrains, spike_psths, table_epochs
+from dissonance.epochtypes import spiketrains
+from dissonance.funks import psth
+from dissonance.funks.psth import PsthParams
+
+
+def calculate_psth(epoch, inc=100):
+    # PER EPOCH LOOP THE ENGINE REPLACED, RATES IN SPIKES PER SECOND AT 10KHZ
+    x = np.zeros(epoch.trace.shape)
+    x[epoch.spikes] = 1
+    psth = np.array([np.sum(x[ii:ii + inc]) for ii in range(0, epoch.trace.shape[0], inc)])
+    return 10000 / inc * (psth - np.mean(psth[:int(epoch.stimtime // inc)]))
+
+
+class TestSpikeTrains:
+
+    def setup_method(self):
+        rng = np.random.default_rng(0)
+        self.h5file = h5py.File("spiketrains.h5", "w", driver="core", backing_store=False)
+        experiment = self.h5file.create_group("experiment")
+        for number in range(4):
+            epochgrp = experiment.create_group(f"epoch{number}")
+            epochgrp.attrs.update(dict(
+                tracetype="spiketrace", cellname=f"Cell{number % 2}", lightamplitude=1.0, lightmean=2.0,
+                pretime=50.0, stimtime=100.0, tailtime=50.0, startdate=f"2021-09-11 10:00:0{number}"))
+            epochgrp.create_dataset("Amp1", data=np.zeros(2000))
+            epochgrp.create_dataset("Spikes", data=np.sort(rng.integers(0, 2000, 30 * number)))
+        self.table = EpochTable.from_files({"spiketrains.h5": experiment})
+        self.table.rows(["spiketrains.h5"] * 4, range(4))
+
+    def teardown_method(self):
+        self.h5file.close()
+        spiketrains.clear_cache()
+
+    def test_psths_match_calculate_psth(self):
+        epochs = table_epochs(self.table, range(4))
+        trains = SpikeTrains.from_epochs(epochs)
+        psths = trains.psths([epoch.stimtime for epoch in epochs])
+        for epoch, psth in zip(epochs, psths):
+            assert np.array_equal(trains[epochs.index(epoch)], epoch.spikes)
+            assert np.allclose(psth, calculate_psth(epoch))
+
+    def test_repeated_and_outside_spikes(self):
+        trains = SpikeTrains(np.array([5, 5, 150, 250, -1]), np.array([0, 5]), np.array([200]))
+        assert trains.counts(100).tolist() == [[1.0, 1.0]]
+
+    def test_block_psths(self):
+        blocks = [SpikeEpochs(table_epochs(self.table, rows)) for rows in ([0, 2], [1, 3])]
+        expected = [np.array([calculate_psth(epoch) for epoch in block]) for block in blocks]
+        for block, psths in zip(blocks, expected):
+            assert np.allclose(block.psths, psths)
+
+        for block in blocks:
+            block._psths = None
+        for block, psths, batched in zip(blocks, expected, spike_psths(blocks)):
+            assert block.psths is batched
+            assert np.allclose(batched, psths)
+
+    def test_bin_widths_are_memoized(self):
+        block = SpikeEpochs(table_epochs(self.table, range(4)))
+        for inc in (50, 100, 250):
+            psths = block.get_psths(PsthParams(inc=inc))
+            assert psths.shape == (4, 2000 // inc)
+            assert np.allclose(psths, [calculate_psth(epoch, inc) for epoch in block])
+            assert block.get_psths(PsthParams(inc=inc))[1].tolist() == psths[1].tolist()
+        assert len(spiketrains.CACHE) == 12
+
+    def test_smoothing(self):
+        counts = SpikeTrains.from_epochs(table_epochs(self.table, range(4))).counts(10)
+        for kernel, width in (("gaussian", 50), ("exponential", 30)):
+            params = PsthParams(inc=10, kernel=kernel, width=width)
+            taps, center = psth.kernel(params)
+            expected = [np.convolve(row, taps)[center:center + counts.shape[1]] for row in counts]
+            assert np.allclose(psth.smooth(counts, params), expected)
@@ -0,0 +1,81 @@
+import uuid
+
+import h5py
+import numpy as np
+import pytest
+
+from dissonance.io import SymphonyReader
+
+
+def make_symphony(path, nepochs=2, n=2000, seed=0):
+    """Minimal Symphony file of one cell with LedPulse spike and LedPulseFamily whole cell epochs"""
+    rng = np.random.default_rng(seed)
+    ticks = 637700000000000000
+    with h5py.File(path, "w") as f:
+        cellgrp = f.create_group(f"experiment-{uuid.uuid4()}/epochGroups/epochGroup-{uuid.uuid4()}")
+        source = cellgrp.create_group("source")
+        source.attrs["label"] = "Cell1"
+        source.create_group("properties").attrs["type"] = "RGC\\ON-sustained"
+        for protocolname, amp1 in (("LedPulse", 0.0), ("LedPulseFamily", -60.0)):
+            blockgrp = cellgrp.create_group(f"epochBlocks/edu.wisc.sinhalab.protocols.{protocolname}-{uuid.uuid4()}")
+            blockgrp.create_group("protocolParameters").attrs.update(dict(
+                interpulseInterval=1.0, led="Green LED", lightAmplitude=0.012, lightMean=0.0, preTime=50.0,
+                stimTime=10.0, tailTime=140.0, sampleRate=10000.0, numberOfAverages=2.0))
+            for _ in range(nepochs):
+                epochgrp = blockgrp.create_group(f"epochs/epoch-{uuid.uuid4()}")
+                epochgrp.attrs["startTimeDotNetDateTimeOffsetTicks"] = ticks
+                epochgrp.attrs["endTimeDotNetDateTimeOffsetTicks"] = ticks + 2000000
+                ticks += 3000000
+                epochgrp.create_group("protocolParameters").attrs["ndf"] = "None"
+                epochgrp.create_group(f"backgrounds/Amp1-{uuid.uuid4()}").attrs.update(dict(value=amp1, units=b"pA"))
+                response = epochgrp.create_group(f"responses/Amp1-{uuid.uuid4()}")
+                response.attrs["sampleRate"] = 10000.0
+                response.attrs["sampleRateUnits"] = b"Hz"
+                data = np.empty(n, dtype=[("quantity", "<f8"), ("units", "S2")])
+                data["quantity"] = rng.normal(0, 1, n)
+                data["units"] = b"pA"
+                response.create_dataset("data", data=data)
+                stimulus = epochgrp.create_group(f"stimuli/Green LED-{uuid.uuid4()}")
+                stimulus.create_group("parameters").attrs.update(dict(amplitude=0.012, mean=0.0))
+
+
+class TestAppend:
+
+    @pytest.fixture(autouse=True)
+    def setup(self, tmp_path):
+        self.rawpath = tmp_path / "2021-09-11A.h5"
+        self.outputpath = tmp_path / "out.h5"
+        make_symphony(self.rawpath)
+        self.convert()
+
+    def convert(self, **kwargs):
+        sr = SymphonyReader(self.rawpath)
+        try:
+            sr.to_h5(self.outputpath, **kwargs)
+        finally:
+            sr.fin.close()
+
+    def test_partial_and_pathless_groups(self):
+        with h5py.File(self.outputpath, "r+") as f:
+            experiment = f["experiment"]
+            paths = {experiment[name].attrs["path"] for name in experiment}
+            # EPOCH WRITTEN WITHOUT ITS TRACE AND TWO GROUPS THAT NEVER GOT THEIR ATTRIBUTES
+            del experiment["epoch1/Amp1"]
+            experiment.create_group("epoch9")
+            experiment.create_group("epoch10")
+
+        self.convert(append=True)
+
+        with h5py.File(self.outputpath, "r") as f:
+            experiment = f["experiment"]
+            assert "epoch1" not in experiment
+            assert set(experiment) == {"epoch0", "epoch2", "epoch3", "epoch9", "epoch10", "epoch11"}
+            assert len(experiment["epoch9"].attrs) == 0 and len(experiment["epoch10"].attrs) == 0
+            written = [name for name in experiment if "path" in experiment[name].attrs]
+            assert {experiment[name].attrs["path"] for name in written} == paths
+            assert all("Amp1" in experiment[name] for name in written)
+
+        # NOTHING LEFT TO ADD
+        self.convert(append=True)
+        with h5py.File(self.outputpath, "r") as f:
+            assert len(f["experiment"]) == 6